@@ -1,12 +1,23 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_from_directory
 from flask_cors import CORS
 from character import Character
 from character_pool import CharacterPool
 from persona import Persona
 from narrator import Narrator
 from narrator_manager import NarratorManager
+from router import get_router
+from response_cache import get_response_cache
+from tools import get_tool_registry
+from scheduler import SchedulerFull, SchedulerTimeout, get_scheduler
+from jobs import get_jobs
+from summarizer import get_summarizer
+from memory import get_store
+from metrics import get_metrics
+from session import SessionStore, VALID_TIMES
+from state_store import open_shared_store, open_store
 import os
 import json
+import time
 
 app = Flask(__name__, static_folder=os.path.abspath('.'))
 CORS(app)
@@ -15,7 +26,7 @@ CORS(app)
 character_pool = CharacterPool()
 
 # Add initial Lyra character only if it doesn't already exist
-if not character_pool.get_character("Lyra"):
+if not character_pool.has_character("Lyra"):
     character_pool.add_character(Character(
         name="Lyra",
         intro="*A shimmer in the air coalesces into a glowing figure. She smiles.*",
@@ -28,39 +39,94 @@ if not character_pool.get_character("Lyra"):
     ))
 # Add more default characters as needed
 
-# Set initial time for all characters
-for character in character_pool.list_characters():
-    # Only set time if it hasn't been set (current_day will be 0 if not set)
-    if not hasattr(character, 'current_day') or character.current_day == 0:
-        character.set_time(day=1, time_of_day="morning")
+# Per-user conversation state; characters themselves stay shared and read-only.
+# Under several worker processes (serve.py) sessions live in the shared state store
+session_store = SessionStore(store=open_shared_store("sessions"))
+SESSION_COOKIE = "talkbot_session"
 
-# Initialize narrator manager with the character pool
-narrator_manager = NarratorManager(character_pool)
+# Initialize narrator manager with the character pool; stories' conversations are
+# kept with the other sessions when those are shared between workers
+narrator_manager = NarratorManager(character_pool,
+                                   session_store=session_store if session_store.store is not None else None)
+
+# Requests against a narrator run one at a time, in order, on the scheduler's workers
+narrator_scheduler = get_scheduler()
+NARRATOR_TIMEOUT = 120  # Seconds a narrator request may wait for its result
+
+# Slow generations can run as background jobs whose results are fetched from /jobs/<id>
+job_manager = get_jobs()
+JOB_WAIT_LIMIT = 60  # Longest a long-poll or event stream waits in one request
+
+# Per-stage latency histograms served at /metrics; TALKBOT_METRICS=1 turns them on
+metrics = get_metrics()
 
 # Create a default narrator if none exists
 if not narrator_manager.list_narrators():
     default_narrator = narrator_manager.create_narrator("default_story", "dolphin3")
     # Add all existing characters to the default narrator
-    for character in character_pool.list_characters():
-        default_narrator.add_character(character)
+    for record in character_pool.list_records():
+        default_narrator.add_character_name(record["name"])
     narrator_manager.set_active_narrator("default_story")
 
-PERSONA_FILE = "personas.json"
+PERSONA_FILE = "personas.json"  # Legacy file, imported once into the state store
+persona_store = open_store("personas", os.path.join("state", "personas"))
 
 def load_personas():
-    if os.path.exists(PERSONA_FILE):
-        with open(PERSONA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return {p['name']: Persona(p['name'], p['description']) for p in data}
-    return {}
+    """Load personas from the state store, importing the legacy JSON file on first run"""
+    if persona_store.is_empty() and os.path.exists(PERSONA_FILE):
+        try:
+            with open(PERSONA_FILE, "r", encoding="utf-8") as f:
+                for p in json.load(f):
+                    persona_store.put("personas", p['name'], p)
+            persona_store.compact()
+        except Exception as e:
+            print(f"Error loading personas: {e}")
+    return {name: Persona(p['name'], p['description']) for name, p in persona_store.collection("personas").items()}
+
+def save_persona(persona):
+    persona_store.put("personas", persona.name, persona.to_dict())
 
-def save_personas():
-    with open(PERSONA_FILE, "w", encoding="utf-8") as f:
-        json.dump([p.to_dict() for p in personas.values()], f, indent=2)
-
-# In-memory persona store for prototype
 personas = load_personas()
 
+@app.errorhandler(SchedulerFull)
+def narrator_busy(e):
+    return jsonify({"error": str(e)}), 429
+
+@app.errorhandler(SchedulerTimeout)
+def narrator_timeout(e):
+    return jsonify({"error": str(e)}), 503
+
+@app.before_request
+def start_request_timer():
+    if metrics.enabled:
+        g.request_started = time.perf_counter()
+
+@app.before_request
+def refresh_shared_state():
+    """Pick up changes other worker processes made; a no-op with a single process"""
+    character_pool.refresh()
+    narrator_manager.refresh(narrator_scheduler)  # Changed narrators reload between their turns
+    if persona_store.changed():
+        loaded = load_personas()
+        for name in [n for n in personas if n not in loaded]:
+            del personas[name]
+        personas.update(loaded)
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses are timed to their first byte
+    if metrics.enabled and 'request_started' in g:
+        endpoint = request.url_rule.rule if request.url_rule else None
+        metrics.observe_request(endpoint, response.status_code, time.perf_counter() - g.request_started)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics_text():
+    """Prometheus metrics: per-stage and request latency, prompt sizes and model token rates"""
+    if not metrics.enabled:
+        return jsonify({"error": "Metrics are disabled; set TALKBOT_METRICS=1 to enable them"}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Route for serving the homepage
 @app.route('/')
 def home():
@@ -95,21 +161,78 @@ def serve_image(path):
 def get_characters():
     """Get the list of available characters"""
     character_list = []
-    for char in character_pool.list_characters():
+    # Use the metadata records so listing never loads a character's memory backends
+    for record in character_pool.list_records():
         # Fix character profile paths to ensure they point to the correct image location
-        profile_path = char.profile
+        profile_path = record["profile"]
         # If profile is just a name without path, prepend the correct path
         if not profile_path.startswith('/'):
             profile_path = f"/page/image/{profile_path}.png"
         
         character_list.append({
-            "name": char.name,
-            "intro": char.intro,
+            "name": record["name"],
+            "intro": record["intro"],
             "profile": profile_path,
-            "background": char.background
+            "background": record["background"]
         })
     return jsonify({"characters": character_list})
 
+def get_session_id(data):
+    """Identify which conversation a request belongs to, starting a new one if needed"""
+    return ((data or {}).get('session_id')
+            or request.headers.get('X-Session-Id')
+            or request.cookies.get(SESSION_COOKIE)
+            or session_store.new_session_id())
+
+def with_session_cookie(response, session):
+    """Let browser clients keep their conversation without sending a session id"""
+    response.set_cookie(SESSION_COOKIE, session.session_id, httponly=True, samesite='Lax')
+    return response
+
+def apply_chat_settings(session, data):
+    """Apply the persona and time settings sent with a chat request to a conversation"""
+    # Persona support
+    persona_name = data.get('persona')
+    if persona_name and persona_name in personas:
+        persona = personas[persona_name]
+        session.user_name = persona.name
+        session.user_persona = persona.description
+    else:
+        session.user_name = "Guest"
+        session.user_persona = "A curious visitor to the website."
+    # Custom time mechanic: set day/time_of_day from frontend if provided
+    if 'day' in data and isinstance(data['day'], int):
+        session.current_day = data['day']
+    if 'time_of_day' in data and isinstance(data['time_of_day'], str):
+        if data['time_of_day'] in VALID_TIMES:
+            session.time_of_day = data['time_of_day']
+
+def sse_event(event, data):
+    """Format a single Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def job_links(job):
+    """Where a client follows a submitted job"""
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events"
+    }
+
+def job_accepted(job):
+    """202 response pointing the client at a submitted job"""
+    return jsonify(job_links(job)), 202
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+def sse_response(events):
+    """Wrap a generator of SSE messages in a streaming response"""
+    return Response(events, mimetype='text/event-stream', headers=SSE_HEADERS)
+
 @app.route('/chat', methods=['POST'])
 def chat():
     """Process a chat message and get a response"""
@@ -120,32 +243,58 @@ def chat():
     if not character:
         return jsonify({"error": f"Character {data['character']} not found"}), 404
     message = data['message']
-    # Persona support
-    persona_name = data.get('persona')
-    if persona_name and persona_name in personas:
-        persona = personas[persona_name]
-        character.user_name = persona.name
-        character.user_persona = persona.description
-    else:
-        character.user_name = "Guest"
-        character.user_persona = "A curious visitor to the website."
-    # Custom time mechanic: set day/time_of_day from frontend if provided
-    if 'day' in data and isinstance(data['day'], int):
-        character.current_day = data['day']
-    if 'time_of_day' in data and isinstance(data['time_of_day'], str):
-        if data['time_of_day'] in character.VALID_TIMES:
-            character.time_of_day = data['time_of_day']
+    session = session_store.get_or_create(get_session_id(data), character)
     try:
-        response = character.talk(message)
-        character.advance_time()
-        return jsonify({
-            "response": response,
-            "day": character.current_day,
-            "time_of_day": character.time_of_day
-        })
+        # Turns within one conversation run in order; other conversations aren't blocked
+        with session.lock:
+            apply_chat_settings(session, data)
+            response = character.talk(message, session=session)
+            session.advance_time()
+            session_store.save(session)
+            return with_session_cookie(jsonify({
+                "response": response,
+                "day": session.current_day,
+                "time_of_day": session.time_of_day,
+                "session_id": session.session_id,
+                "context_usage": session.context_usage
+            }), session)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Process a chat message and stream the response as Server-Sent Events"""
+    data = request.json
+    if not data or 'message' not in data or 'character' not in data:
+        return jsonify({"error": "Missing message or character parameter"}), 400
+    character = character_pool.get_character(data['character'])
+    if not character:
+        return jsonify({"error": f"Character {data['character']} not found"}), 404
+    message = data['message']
+    session = session_store.get_or_create(get_session_id(data), character)
+
+    def generate():
+        try:
+            with session.lock:
+                apply_chat_settings(session, data)
+                parts = []
+                for text in character.talk_stream(message, session=session):
+                    parts.append(text)
+                    yield sse_event("token", {"text": text})
+                session.advance_time()
+                session_store.save(session)
+                yield sse_event("done", {
+                    "response": "".join(parts).strip(),
+                    "day": session.current_day,
+                    "time_of_day": session.time_of_day,
+                    "session_id": session.session_id,
+                    "context_usage": session.context_usage
+                })
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+
+    return with_session_cookie(sse_response(generate()), session)
+
 @app.route('/character/time', methods=['POST'])
 def update_time():
     """Update a character's time of day"""
@@ -156,33 +305,109 @@ def update_time():
     if not character:
         return jsonify({"error": f"Character {data['character']} not found"}), 404
     action = data['action']
+    session = session_store.get_or_create(get_session_id(data), character)
     try:
-        if action == 'next_time':
-            character.advance_time()
-        elif action == 'prev_time':
-            current_index = character.VALID_TIMES.index(character.time_of_day)
-            if current_index > 0:
-                character.time_of_day = character.VALID_TIMES[current_index - 1]
+        with session.lock:
+            if action == 'next_time':
+                session.advance_time()
+            elif action == 'prev_time':
+                session.rewind_time()
+            elif action == 'next_day':
+                session.next_day()
+            elif action == 'prev_day':
+                if session.current_day > 1:
+                    session.current_day -= 1
+                    session.time_of_day = VALID_TIMES[0]
             else:
-                character.time_of_day = character.VALID_TIMES[-1]
-                if character.current_day > 1:
-                    character.current_day -= 1
-        elif action == 'next_day':
-            character.current_day += 1
-            character.time_of_day = character.VALID_TIMES[0]
-        elif action == 'prev_day':
-            if character.current_day > 1:
-                character.current_day -= 1
-                character.time_of_day = character.VALID_TIMES[0]
-        else:
-            return jsonify({"error": f"Invalid action: {action}"}), 400
-        return jsonify({
-            "day": character.current_day,
-            "time_of_day": character.time_of_day
-        })
+                return jsonify({"error": f"Invalid action: {action}"}), 400
+            session_store.save(session)
+            return with_session_cookie(jsonify({
+                "day": session.current_day,
+                "time_of_day": session.time_of_day,
+                "session_id": session.session_id
+            }), session)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/memory/summarizer', methods=['GET'])
+def summarizer_stats():
+    """Report queue depth and lag of the background memory summarizer"""
+    return jsonify(get_summarizer().stats())
+
+@app.route('/memory/cache', methods=['GET'])
+def memory_cache_stats():
+    """Report hit rates of the shared query embedding cache and per-character result caches"""
+    with character_pool.lock:
+        resident = list(character_pool.resident.values())
+    return jsonify({
+        "embeddings": get_store().embedding_cache.stats(),
+        "results": {c.name: c.long_term_memory.cache_stats() for c in resident}
+    })
+
+@app.route('/memory/summarize', methods=['POST'])
+def summarize_memory():
+    """Summarize a conversation's short-term memory into long-term memory as a background job"""
+    data = request.json
+    if not data or 'character' not in data:
+        return jsonify({"error": "Missing character parameter"}), 400
+    character = character_pool.get_character(data['character'])
+    if not character:
+        return jsonify({"error": f"Character {data['character']} not found"}), 404
+    session = session_store.get_or_create(get_session_id(data), character)
+
+    def summarize():
+        # Wait for any turn in progress so the summary covers it
+        with session.lock:
+            return {"summary": character.summarize_and_store_memory(session)}
+
+    response, status = job_accepted(job_manager.submit("summarize", summarize))
+    return with_session_cookie(response, session), status
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Get the status and result of a background job
+    With ?wait=<seconds> the request long-polls until the job finishes
+    """
+    wait = min(request.args.get('wait', 0, type=float), JOB_WAIT_LIMIT)
+    job = job_manager.wait(job_id, wait) if wait > 0 else job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": f"Job '{job_id}' not found or expired"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Stream a job's completion as Server-Sent Events"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": f"Job '{job_id}' not found or expired"}), 404
+
+    def generate():
+        current = job
+        yield sse_event("status", current.to_dict())
+        deadline = time.monotonic() + JOB_WAIT_LIMIT
+        while True:
+            # The job may run in another worker process, so it is looked up again each time
+            current = job_manager.wait(job_id, min(15, max(0, deadline - time.monotonic()))) or current
+            if current.done:
+                break
+            if time.monotonic() >= deadline:
+                yield sse_event("timeout", {"id": current.id, "status": current.status})
+                return
+            yield ": keep-alive\n\n"
+        yield sse_event("done", current.to_dict())
+
+    return sse_response(generate())
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a job that hasn't started yet"""
+    if not job_manager.get(job_id):
+        return jsonify({"error": f"Job '{job_id}' not found or expired"}), 404
+    if not job_manager.cancel(job_id):
+        return jsonify({"error": "Job has already started"}), 409
+    return jsonify({"success": True})
+
 @app.route('/personas', methods=['GET'])
 def get_personas():
     return jsonify({"personas": [p.to_dict() for p in personas.values()]})
@@ -194,7 +419,7 @@ def create_persona():
         return jsonify({"error": "Missing name or description"}), 400
     persona = Persona(data['name'], data['description'])
     personas[data['name']] = persona
-    save_personas()
+    save_persona(persona)
     return jsonify(persona.to_dict()), 201
 
 @app.route('/persona/<name>', methods=['PUT'])
@@ -205,7 +430,7 @@ def edit_persona(name):
     if not data or 'description' not in data:
         return jsonify({"error": "Missing description"}), 400
     personas[name].description = data['description']
-    save_personas()
+    save_persona(personas[name])
     return jsonify(personas[name].to_dict())
 
 @app.route('/persona/<name>', methods=['DELETE'])
@@ -213,7 +438,7 @@ def delete_persona(name):
     if name not in personas:
         return jsonify({"error": "Persona not found"}), 404
     del personas[name]
-    save_personas()
+    persona_store.delete("personas", name)
     return '', 204
 
 @app.route('/character', methods=['POST'])
@@ -224,7 +449,7 @@ def create_character():
         return jsonify({"error": "Missing required fields"}), 400
     
     # Check if character already exists
-    if character_pool.get_character(data['name']):
+    if character_pool.has_character(data['name']):
         return jsonify({"error": f"Character '{data['name']}' already exists"}), 400
     
     try:
@@ -294,16 +519,16 @@ def get_active_narrator():
     # Get current characters in the active narrator's scene
     characters_present = []
     for char_name in active_narrator.story_state["characters_present"]:
-        character = active_narrator.characters.get(char_name)
-        if character:
+        record = character_pool.get_record(char_name) if char_name in active_narrator.characters else None
+        if record:
             # Fix character profile paths
-            profile_path = character.profile
+            profile_path = record["profile"]
             if not profile_path.startswith('/'):
                 profile_path = f"/page/image/{profile_path}.png"
                 
             characters_present.append({
-                "name": character.name,
-                "intro": character.intro,
+                "name": record["name"],
+                "intro": record["intro"],
                 "profile": profile_path
             })
     
@@ -315,6 +540,25 @@ def get_active_narrator():
         "characters_present": characters_present
     })
 
+@app.route('/narrator/router', methods=['GET'])
+def get_router_stats():
+    """Report how responders were picked and how often the routing LLM call was skipped"""
+    return jsonify(get_router().stats())
+
+@app.route('/narrator/cache', methods=['GET'])
+def get_response_cache_stats():
+    """Report hit rates of the cache of routing and scene direction replies"""
+    return jsonify(get_response_cache().stats())
+
+@app.route('/tools', methods=['GET'])
+def get_tool_stats():
+    """Registered character tools and how long their calls take"""
+    registry = get_tool_registry()
+    return jsonify({
+        "tools": {name: {"description": tool.description, "min_args": tool.min_args} for name, tool in registry.tools.items()},
+        "timings": registry.stats()
+    })
+
 @app.route('/narrator/active', methods=['PUT'])
 def set_active_narrator():
     """Set the active narrator"""
@@ -359,7 +603,7 @@ def set_narrator_scene():
     characters_present = data.get('characters_present', active_narrator.story_state["characters_present"])
     
     active_narrator.set_scene(scene_description, characters_present)
-    narrator_manager.save_narrators()
+    narrator_manager.save_narrator(narrator_manager.active_narrator_id)
     
     return jsonify({
         "success": True,
@@ -378,20 +622,65 @@ def narrator_chat():
     if not active_narrator:
         return jsonify({"error": "No active narrator set"}), 404
     
-    # Set persona if provided
-    persona_name = data.get('persona')
-    if persona_name and persona_name in personas:
-        persona = personas[persona_name]
-        active_narrator.set_user_persona(persona.name, persona.description)
-    
-    # Process the message
+    narrator_id = narrator_manager.active_narrator_id
+    persona = personas.get(data.get('persona'))
     message = data['message']
-    result = active_narrator.process_user_message(message)
     
-    # Save any changes to the narrator state
-    narrator_manager.save_narrators()
+    def turn():
+        with metrics.context(narrator=narrator_id):
+            # Set persona if provided
+            if persona:
+                active_narrator.set_user_persona(persona.name, persona.description)
+            
+            # Process the message; an ensemble has several characters answer it at once
+            if data.get('ensemble'):
+                result = active_narrator.process_ensemble(message, data.get('characters'))
+            else:
+                result = active_narrator.process_user_message(message)
+            
+            # Save any changes to the narrator state
+            narrator_manager.save_narrator(narrator_id)
+            return result
     
-    return jsonify(result)
+    return jsonify(narrator_scheduler.run(narrator_id, turn, timeout=NARRATOR_TIMEOUT))
+
+@app.route('/narrator/chat/stream', methods=['POST'])
+def narrator_chat_stream():
+    """Process a chat message in narrator mode and stream the response as Server-Sent Events"""
+    data = request.json
+    if not data or 'message' not in data:
+        return jsonify({"error": "Missing message parameter"}), 400
+    
+    active_narrator = narrator_manager.get_active_narrator()
+    if not active_narrator:
+        return jsonify({"error": "No active narrator set"}), 404
+    
+    narrator_id = narrator_manager.active_narrator_id
+    persona = personas.get(data.get('persona'))
+    message = data['message']
+
+    def turn():
+        # Set persona if provided
+        if persona:
+            active_narrator.set_user_persona(persona.name, persona.description)
+        try:
+            if data.get('ensemble'):
+                yield from active_narrator.process_ensemble_stream(message, data.get('characters'))
+            else:
+                yield from active_narrator.process_user_message_stream(message)
+        finally:
+            # Save any changes to the narrator state
+            narrator_manager.save_narrator(narrator_id)
+
+    def generate():
+        try:
+            for event in narrator_scheduler.stream(narrator_id, turn, timeout=NARRATOR_TIMEOUT):
+                event = dict(event)
+                yield sse_event(event.pop("event"), event)
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+
+    return sse_response(generate())
 
 @app.route('/narrator/direct', methods=['POST'])
 def direct_scene():
@@ -402,8 +691,13 @@ def direct_scene():
     
     data = request.json
     prompt = data.get('prompt') if data else None
+    fresh = bool(data and data.get('fresh'))  # Skip the cached narration for an unchanged scene
     
-    result = active_narrator.direct_scene(prompt)
+    if data and data.get('async'):
+        return job_accepted(job_manager.submit("direct_scene", active_narrator.direct_scene, prompt, fresh=fresh,
+                                               key=narrator_manager.active_narrator_id))
+    result = narrator_scheduler.run(narrator_manager.active_narrator_id, active_narrator.direct_scene, prompt,
+                                    fresh=fresh, timeout=NARRATOR_TIMEOUT)
     return jsonify(result)
 
 @app.route('/narrator/suggest-character', methods=['POST'])
@@ -416,8 +710,13 @@ def suggest_character():
     data = request.json
     prompt = data.get('prompt') if data else None
     
-    result = active_narrator.suggest_new_character(prompt)
+    if data and data.get('async'):
+        return job_accepted(job_manager.submit("suggest_character", active_narrator.suggest_new_character, prompt,
+                                               key=narrator_manager.active_narrator_id))
+    result = narrator_scheduler.run(narrator_manager.active_narrator_id, active_narrator.suggest_new_character, prompt,
+                                    timeout=NARRATOR_TIMEOUT)
     return jsonify(result)
 
 if __name__ == '__main__':
+    # Development server; use serve.py to run with several workers in production
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,248 @@
+"""
+ASGI entry point: the model-bound endpoints run natively on asyncio, everything else is the Flask app.
+
+    python serve.py --server uvicorn    (or: uvicorn asgi:app)
+
+/chat, /chat/stream, /narrator/chat, /narrator/chat/stream, /narrator/direct and
+/narrator/suggest-character await the model rather than holding a thread for the
+whole generation, so a single process can keep hundreds of them in flight. The
+blocking parts of a turn go to small bounded pools (executors.py): long-term
+memory queries to "memory", saving sessions and narrators to "storage".
+Narrator turns keep their place in line with the narrator scheduler, so they
+never interleave with background jobs for the same story.
+
+Every other route is served by the Flask app in app.py on a few threads.
+"""
+import contextlib
+import os
+import time
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import (app as flask_app, character_pool, session_store, narrator_manager, narrator_scheduler,
+                 job_manager, metrics, personas, apply_chat_settings, refresh_shared_state, job_links,
+                 sse_event, SESSION_COOKIE, SSE_HEADERS, NARRATOR_TIMEOUT)
+from executors import locked, run_blocking
+from scheduler import SchedulerFull, SchedulerTimeout
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def get_session_id(request, data):
+    """Identify which conversation a request belongs to, starting a new one if needed"""
+    return ((data or {}).get('session_id')
+            or request.headers.get('X-Session-Id')
+            or request.cookies.get(SESSION_COOKIE)
+            or session_store.new_session_id())
+
+
+def with_session_cookie(response, session):
+    response.set_cookie(SESSION_COOKIE, session.session_id, httponly=True, samesite='lax')
+    return response
+
+
+def error(message, status):
+    return JSONResponse({"error": message}, status)
+
+
+def sse_response(events):
+    return StreamingResponse(events, media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+async def open_session(request, data):
+    """Resolve the character and conversation a chat request is for; returns an error response if there are none"""
+    if not data or 'message' not in data or 'character' not in data:
+        return error("Missing message or character parameter", 400)
+    # Loading a character opens its memory store, and a session may be read from the shared store
+    character = await run_blocking("memory", character_pool.get_character, data['character'])
+    if not character:
+        return error(f"Character {data['character']} not found", 404)
+    session = await run_blocking("storage", session_store.get_or_create, get_session_id(request, data), character)
+    return character, session
+
+
+def turn_result(session, response):
+    return {
+        "response": response,
+        "day": session.current_day,
+        "time_of_day": session.time_of_day,
+        "session_id": session.session_id,
+        "context_usage": session.context_usage
+    }
+
+
+async def chat(request):
+    """Process a chat message and get a response"""
+    data = await read_json(request)
+    opened = await open_session(request, data)
+    if not isinstance(opened, tuple):
+        return opened
+    character, session = opened
+    try:
+        # Turns within one conversation run in order; other conversations aren't blocked
+        async with locked(session.lock):
+            apply_chat_settings(session, data)
+            response = await character.atalk(data['message'], session=session)
+            session.advance_time()
+            await run_blocking("storage", session_store.save, session)
+            return with_session_cookie(JSONResponse(turn_result(session, response)), session)
+    except Exception as e:
+        return error(str(e), 500)
+
+
+async def chat_stream(request):
+    """Process a chat message and stream the response as Server-Sent Events"""
+    data = await read_json(request)
+    opened = await open_session(request, data)
+    if not isinstance(opened, tuple):
+        return opened
+    character, session = opened
+
+    async def generate():
+        try:
+            async with locked(session.lock):
+                apply_chat_settings(session, data)
+                parts = []
+                async with contextlib.aclosing(character.atalk_stream(data['message'], session=session)) as tokens:
+                    async for text in tokens:
+                        parts.append(text)
+                        yield sse_event("token", {"text": text})
+                session.advance_time()
+                await run_blocking("storage", session_store.save, session)
+                yield sse_event("done", turn_result(session, "".join(parts).strip()))
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+
+    return with_session_cookie(sse_response(generate()), session)
+
+
+async def narrator_chat(request):
+    """Process a chat message in narrator mode"""
+    data = await read_json(request)
+    if not data or 'message' not in data:
+        return error("Missing message parameter", 400)
+    active_narrator = narrator_manager.get_active_narrator()
+    if not active_narrator:
+        return error("No active narrator set", 404)
+
+    narrator_id = narrator_manager.active_narrator_id
+    persona = personas.get(data.get('persona'))
+    message = data['message']
+
+    async with narrator_scheduler.reserve(narrator_id, timeout=NARRATOR_TIMEOUT):
+        with metrics.context(narrator=narrator_id):
+            # Set persona if provided
+            if persona:
+                active_narrator.set_user_persona(persona.name, persona.description)
+
+            # Process the message; an ensemble has several characters answer it at once
+            if data.get('ensemble'):
+                result = await active_narrator.aprocess_ensemble(message, data.get('characters'))
+            else:
+                result = await active_narrator.aprocess_user_message(message)
+
+            # Save any changes to the narrator state
+            await run_blocking("storage", narrator_manager.save_narrator, narrator_id)
+    return JSONResponse(result)
+
+
+async def narrator_chat_stream(request):
+    """Process a chat message in narrator mode and stream the response as Server-Sent Events"""
+    data = await read_json(request)
+    if not data or 'message' not in data:
+        return error("Missing message parameter", 400)
+    active_narrator = narrator_manager.get_active_narrator()
+    if not active_narrator:
+        return error("No active narrator set", 404)
+
+    narrator_id = narrator_manager.active_narrator_id
+    persona = personas.get(data.get('persona'))
+    message = data['message']
+
+    async def generate():
+        try:
+            async with narrator_scheduler.reserve(narrator_id, timeout=NARRATOR_TIMEOUT):
+                # Set persona if provided
+                if persona:
+                    active_narrator.set_user_persona(persona.name, persona.description)
+                if data.get('ensemble'):
+                    turn = active_narrator.aprocess_ensemble_stream(message, data.get('characters'))
+                else:
+                    turn = active_narrator.aprocess_user_message_stream(message)
+                try:
+                    async with contextlib.aclosing(turn):
+                        async for event in turn:
+                            event = dict(event)
+                            yield sse_event(event.pop("event"), event)
+                finally:
+                    # Save any changes to the narrator state
+                    await run_blocking("storage", narrator_manager.save_narrator, narrator_id)
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+
+    return sse_response(generate())
+
+
+def narrator_generation(job_name, method, cached=False):
+    """
+    Endpoint for one of the active narrator's one-off generations (direct_scene,
+    suggest_new_character), awaiting its async version; "async": true in the body
+    runs the sync version as a background job instead. A cached generation takes
+    "fresh": true to skip the cached reply.
+    """
+    async def endpoint(request):
+        active_narrator = narrator_manager.get_active_narrator()
+        if not active_narrator:
+            return error("No active narrator set", 404)
+        data = await read_json(request)
+        prompt = data.get('prompt') if data else None
+        narrator_id = narrator_manager.active_narrator_id
+        options = {"fresh": bool(data and data.get('fresh'))} if cached else {}
+
+        if data and data.get('async'):
+            job = job_manager.submit(job_name, getattr(active_narrator, method), prompt, key=narrator_id, **options)
+            return JSONResponse(job_links(job), 202)
+        async with narrator_scheduler.reserve(narrator_id, timeout=NARRATOR_TIMEOUT):
+            result = await getattr(active_narrator, "a" + method)(prompt, **options)
+        return JSONResponse(result)
+
+    return endpoint
+
+
+def route(path, handler):
+    """POST route with the Flask app's shared-state refresh, scheduler errors and request metrics"""
+    async def endpoint(request):
+        started = time.perf_counter()
+        try:
+            # Pick up changes other worker processes made; a no-op with a single process
+            await run_blocking("storage", refresh_shared_state)
+            response = await handler(request)
+        except SchedulerFull as e:
+            response = error(str(e), 429)
+        except SchedulerTimeout as e:
+            response = error(str(e), 503)
+        # Streamed responses are timed to their first byte
+        metrics.observe_request(path, response.status_code, time.perf_counter() - started)
+        return response
+
+    return Route(path, endpoint, methods=["POST"])
+
+
+app = Starlette(routes=[
+    route('/chat', chat),
+    route('/chat/stream', chat_stream),
+    route('/narrator/chat', narrator_chat),
+    route('/narrator/chat/stream', narrator_chat_stream),
+    route('/narrator/direct', narrator_generation("direct_scene", "direct_scene", cached=True)),
+    route('/narrator/suggest-character', narrator_generation("suggest_character", "suggest_new_character")),
+    # Everything else, including static files, /jobs and /metrics
+    Mount('/', app=WSGIMiddleware(flask_app, workers=int(os.environ.get("TALKBOT_THREADS", 8))))
+])
@@ -0,0 +1,93 @@
+"""
+Compare long-term memory embedders on a saved conversation corpus.
+
+Every memory in the corpus is imported into a throwaway Chroma store, then each
+follow-up message is queried and we check whether the memory it refers to comes
+back in the top k. Reports recall@1, recall@k, document import time and query
+latency for each backend.
+
+    python benchmarks/embedding_benchmark.py [--backends default hashing] [--k 2]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embeddings import BatchedEmbedder, ChromaDefaultEmbedder, HashingEmbedder  # noqa: E402
+from memory import ChromaStore, LongTermMemory  # noqa: E402
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "conversation_corpus.json")
+
+BACKENDS = {
+    "default": lambda: ChromaDefaultEmbedder(),
+    "default-batched": lambda: BatchedEmbedder(ChromaDefaultEmbedder()),
+    "hashing": lambda: HashingEmbedder(),
+    "hashing-batched": lambda: BatchedEmbedder(HashingEmbedder())
+}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def run_backend(name, corpus, k):
+    embedder = BACKENDS[name]()
+    with tempfile.TemporaryDirectory() as directory:
+        store = ChromaStore(db_path=directory, embedding_function=embedder, embedding_cache_size=0)
+        memory = LongTermMemory("benchmark_memories", store=store, result_cache_size=0)
+        by_text = {m["summary"]: m["id"] for m in corpus["memories"]}
+
+        started = time.perf_counter()
+        memory.bulk_import(corpus["memories"])
+        import_seconds = time.perf_counter() - started
+
+        top1 = topk = 0
+        latencies = []
+        for query in corpus["queries"]:
+            started = time.perf_counter()
+            documents = memory.query(query["text"], n_results=k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            ids = [by_text.get(document) for document in documents]
+            top1 += bool(ids) and ids[0] == query["expected"]
+            topk += query["expected"] in ids
+
+    count = len(corpus["queries"])
+    return {
+        "backend": name,
+        "recall@1": round(top1 / count, 3),
+        f"recall@{k}": round(topk / count, 3),
+        "import_ms": round(import_seconds * 1000, 1),
+        "query_p50_ms": round(statistics.median(latencies), 2),
+        "query_p95_ms": round(percentile(latencies, 95), 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument("--k", type=int, default=2, help="How many memories build_context retrieves")
+    parser.add_argument("--corpus", default=CORPUS_FILE)
+    args = parser.parse_args()
+
+    with open(args.corpus, "r", encoding="utf-8") as f:
+        corpus = json.load(f)
+    print(f"{len(corpus['memories'])} memories, {len(corpus['queries'])} queries")
+
+    for name in args.backends:
+        try:
+            result = run_backend(name, corpus, args.k)
+        except Exception as e:
+            # The default model has to be downloaded once; skip it when offline
+            print(f"{name}: skipped ({e})")
+            continue
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Load-test the web app with scripted multi-user conversations against a fake model server.
+
+Simulated users play the scripts in load_scripts.json concurrently through the
+Flask app: character chats (/chat), the active story (/narrator/chat) and memory
+summarization jobs (/memory/summarize). The model is a local FakeOllamaServer with
+configurable latency and token rate, so results measure TalkBot itself.
+
+Reports p50/p95/p99 latency per endpoint, throughput, long-term memory (Chroma)
+query and write time and peak RSS. --save writes the results as a baseline,
+noting the commit they were measured at; --compare checks a run against one and
+exits non-zero on a regression.
+
+    python benchmarks/load_benchmark.py [--users 8] [--rounds 2] [--latency 0.05] [--tokens-per-second 200]
+    python benchmarks/load_benchmark.py --save benchmarks/load_baseline.json
+    python benchmarks/load_benchmark.py --compare benchmarks/load_baseline.json [--tolerance 0.25]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import llm  # noqa: E402
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from memory import LongTermMemory  # noqa: E402
+from summarizer import get_summarizer  # noqa: E402
+
+SCRIPTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "load_scripts.json")
+STATE_FILES = ("characters.json", "narrators.json", "personas.json")
+REPLY = "*smiles warmly* That is a fine question, and the stars have a story about it. Shall I tell you?"
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize_latencies(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50_ms": round(statistics.median(values), 2),
+        "p95_ms": round(percentile(values, 95), 2),
+        "p99_ms": round(percentile(values, 99), 2),
+        "max_ms": round(max(values), 2)
+    }
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+
+def git_commit():
+    """The commit of the tree being measured, or None outside a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Timings:
+    """Latency samples by name, safe to record from many threads"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed_ms, ok=True):
+        with self.lock:
+            self.samples.setdefault(name, []).append(elapsed_ms)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def timed(self, name, func):
+        """Wrap func so each call is recorded under name"""
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, (time.perf_counter() - started) * 1000)
+        return wrapper
+
+
+def run_step(client, step, session_id, timings):
+    started = time.perf_counter()
+    if step["endpoint"] == "chat":
+        response = client.post("/chat", json={"character": step["character"], "message": step["message"],
+                                              "session_id": session_id})
+        ok = response.status_code == 200
+    elif step["endpoint"] == "narrator":
+        response = client.post("/narrator/chat", json={"message": step["message"], "ensemble": step.get("ensemble", False)})
+        ok = response.status_code == 200
+    elif step["endpoint"] == "summarize":
+        response = client.post("/memory/summarize", json={"character": step["character"], "session_id": session_id})
+        ok = response.status_code == 202
+        if ok:
+            job = client.get(f"/jobs/{response.json['job_id']}?wait=30").json
+            ok = job.get("status") == "succeeded"
+    else:
+        raise ValueError(f"Unknown endpoint in script: {step['endpoint']}")
+    timings.record(step["endpoint"], (time.perf_counter() - started) * 1000, ok)
+
+
+def run_user(app, user, scripts, rounds, timings):
+    client = app.test_client()
+    script = scripts[user % len(scripts)]
+    session_id = f"bench-user-{user}"
+    for _ in range(rounds):
+        for step in script["steps"]:
+            run_step(client, step, session_id, timings)
+
+
+def run(args):
+    with open(args.scripts, "r", encoding="utf-8") as f:
+        scripts = json.load(f)["scripts"]
+
+    fake = FakeOllamaServer(reply=REPLY, first_token_latency=args.latency,
+                            tokens_per_second=args.tokens_per_second).start()
+    workdir = tempfile.mkdtemp(prefix="talkbot-bench-")
+    for name in STATE_FILES:
+        shutil.copy(os.path.join(ROOT, name), workdir)
+    os.chdir(workdir)
+    os.environ.setdefault("TALKBOT_EMBEDDER", args.embedder)
+    llm.set_gateway(llm.LLMGateway(host=fake.url, max_concurrency=args.model_concurrency))
+
+    timings = Timings()
+    # Long-term memory time is what Chroma costs us per turn, including embedding
+    LongTermMemory.query = timings.timed("chroma_query", LongTermMemory.query)
+    LongTermMemory._upsert = timings.timed("chroma_write", LongTermMemory._upsert)
+
+    import app as app_module
+
+    try:
+        started = time.perf_counter()
+        threads = [threading.Thread(target=run_user, args=(app_module.app, user, scripts, args.rounds, timings))
+                   for user in range(args.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+    finally:
+        # Let queued summaries finish while their files and the model are still there
+        get_summarizer().shutdown(flush=True, timeout=30)
+        fake.stop()
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    endpoints = ("chat", "narrator", "summarize")
+    requests = sum(len(timings.samples.get(name, [])) for name in endpoints)
+    return {
+        "commit": git_commit(),
+        "config": {"users": args.users, "rounds": args.rounds, "latency": args.latency,
+                   "tokens_per_second": args.tokens_per_second, "embedder": os.environ["TALKBOT_EMBEDDER"],
+                   "model_concurrency": args.model_concurrency},
+        "endpoints": {name: dict(summarize_latencies(timings.samples.get(name, [])),
+                                 errors=timings.errors.get(name, 0)) for name in endpoints},
+        "chroma": {name: summarize_latencies(timings.samples.get(name, [])) for name in ("chroma_query", "chroma_write")},
+        "requests": requests,
+        "wall_seconds": round(wall, 2),
+        "throughput_rps": round(requests / wall, 2) if wall else 0.0,
+        "model_requests": len(fake.requests),
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of results against a saved baseline"""
+    regressions = []
+    for name, current in results["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name, {})
+        for key in ("p50_ms", "p95_ms"):
+            if key in before and key in current and current[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {before[key]} -> {current[key]}")
+        if current.get("errors", 0) > before.get("errors", 0):
+            regressions.append(f"{name} errors: {before.get('errors', 0)} -> {current['errors']}")
+    if results["throughput_rps"] < baseline.get("throughput_rps", 0) * (1 - tolerance):
+        regressions.append(f"throughput_rps: {baseline['throughput_rps']} -> {results['throughput_rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=8, help="Concurrent simulated users")
+    parser.add_argument("--rounds", type=int, default=2, help="Times each user plays their script")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake model time to first token, in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Fake model token rate; 0 is instant")
+    parser.add_argument("--model-concurrency", type=int, default=2, help="Requests the gateway sends the model at once")
+    parser.add_argument("--embedder", default="hashing", help="TALKBOT_EMBEDDER for the run; 'hashing' works offline")
+    parser.add_argument("--scripts", default=SCRIPTS_FILE)
+    parser.add_argument("--save", metavar="PATH", help="Save the results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Fail if results regress against this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before --compare fails")
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("Warning: baseline was recorded with a different configuration")
+        if baseline.get("commit") != results["commit"]:
+            print(f"Comparing against a baseline recorded at commit {baseline.get('commit') or 'unknown'}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Measure time to first token with the current prompt layout against the old one.
+
+The old layout put the recalled long-term memories straight after the system
+prompt and the user's persona inside it, so the prompt changed near the start
+on every turn and the model server could not reuse its cached prefill. The
+current layout keeps the character's system prompt byte-identical and puts the
+memories last.
+
+By default this runs against a fake Ollama server that simulates prefix caching;
+pass --host to measure a real server instead.
+
+    python benchmarks/ttft_benchmark.py [--turns 12] [--host http://localhost:11434 --model dolphin3]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm  # noqa: E402
+from character import Character  # noqa: E402
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from session import ConversationSession  # noqa: E402
+
+BACKGROUND = (
+    "Once a guardian of ancient celestial archives, now wandering worlds in search of lost stories. "
+    "She catalogued the light of dying stars, speaks softly, and answers questions with questions. "
+) * 6
+
+USER_MESSAGES = [
+    "Hello Lyra, what are you reading today?",
+    "Tell me more about the archives.",
+    "Do you miss the stars?",
+    "What was the strangest book you ever guarded?",
+    "Could you teach me to read starlight?",
+    "What happened after you left?",
+    "Do you ever get lonely?",
+    "Where will you travel next?",
+    "Can I come with you?",
+    "What should I pack?",
+    "Tell me a story before we go.",
+    "Goodnight, Lyra."
+]
+
+MEMORIES = [
+    "The user told Lyra they have a younger sister named Mira who studies medicine.",
+    "Lyra showed the user the constellations above the archive tower.",
+    "The user works night shifts as a nurse and is often tired.",
+    "Lyra promised to tell the story of her lost wings under a full moon.",
+    "The user and Lyra baked honey bread and burned the first loaf.",
+    "The user is learning Japanese and practised greetings with Lyra."
+]
+
+
+def legacy_context(character, prompt, session):
+    """build_context as it was before the prompt was reordered for prefix caching"""
+    system_prompt = {
+        "role": "system",
+        "content": (
+            f"You are {character.name}, an AI character in a roleplay system. "
+            f"Stay in character as {character.name} at all times. "
+            f"Your background: {character.background} "
+            f"Respond in {character.name}'s style and voice. "
+            f"The user is {session.user_name}: {session.user_persona}. "
+            f"Do not break character or refer to yourself as an AI.\n\n"
+            f"You can call tools by using specific syntax in your responses:\n"
+            f"1. To advance time: [change_time:next_time] or [change_time:next_day]\n"
+            f"2. To get current time: [tool:get_current_time]\n"
+            f"3. To generate random number: [tool:random_number:min:max]\n"
+            f"4. To access weather: [tool:get_weather:location]\n"
+            f"Use these tools only when appropriate in conversation."
+        )
+    }
+    long_mem = [{"role": "system", "content": mem} for mem in character.query_long_term_memory(prompt)]
+    return [system_prompt] + long_mem + session.short_term_memory.get_recent() + [
+        {"role": "user", "content": f"{session.user_name}: {prompt}"}
+    ]
+
+
+def run_conversation(character, layout, model, turns):
+    """Play the scripted conversation and return the time to first token of each turn in ms"""
+    session = ConversationSession(f"bench-{layout}", character.name, user_name="Ada",
+                                  user_persona="A traveller who collects maps and stories.")
+    ttfts = []
+    for turn in range(turns):
+        message = USER_MESSAGES[turn % len(USER_MESSAGES)]
+        # Every turn recalls different memories, as it does in real conversations
+        character.query_long_term_memory = lambda prompt, t=turn: [MEMORIES[t % len(MEMORIES)],
+                                                                     MEMORIES[(t + 3) % len(MEMORIES)]]
+        character.remember_message({"role": "user", "content": f"{session.user_name}: {message}"}, "1m", session)
+        context = character.build_context(message, session) if layout == "current" else legacy_context(character, message, session)
+
+        started = time.perf_counter()
+        parts = []
+        for chunk in llm.chat(model=model, messages=context, options=Character.CHAT_OPTIONS, stream=True):
+            if not parts:
+                ttfts.append((time.perf_counter() - started) * 1000)
+            parts.append(chunk.get("message", {}).get("content", ""))
+        character.remember_message({"role": "assistant", "content": "".join(parts)}, "0s", session)
+    return ttfts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--host", help="Ollama server to measure; defaults to a simulated one")
+    parser.add_argument("--model", default="dolphin3")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=400.0,
+                        help="Prompt processing speed of the simulated server")
+    args = parser.parse_args()
+
+    fake = None
+    if args.host:
+        host = args.host
+    else:
+        fake = FakeOllamaServer(reply="*Lyra smiles* Of course.", first_token_latency=0.02,
+                                prefill_tokens_per_second=args.prefill_tokens_per_second).start()
+        host = fake.url
+    llm.set_gateway(llm.LLMGateway(host=host, keep_alive="30m"))
+
+    os.chdir(tempfile.mkdtemp())
+    character = Character("Lyra", "", BACKGROUND, "lyra", "bench_memories", "Ada", "A traveller")
+    try:
+        for layout in ("legacy", "current"):
+            ttfts = run_conversation(character, layout, args.model, args.turns)
+            # The first turn always pays for the full prompt; steady state is what matters
+            steady = ttfts[1:] or ttfts
+            print(f"{layout:8s} first turn {ttfts[0]:7.1f} ms   later turns p50 {statistics.median(steady):7.1f} ms"
+                  f"   max {max(steady):7.1f} ms")
+            if fake:
+                fake.cached_prompts.clear()
+    finally:
+        if fake:
+            fake.stop()
+
+
+if __name__ == "__main__":
+    main()
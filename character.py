@@ -1,58 +1,121 @@
-import random
 import json
 import os
-import ollama
+import llm
 import chromadb
 import re
 import datetime
 from memory import ShortTermMemory, LongTermMemory
+from summarizer import get_summarizer
+from session import ConversationSession, VALID_TIMES
+from context_builder import get_context_builder
+from executors import run_blocking
+from metrics import get_metrics, span
+from tools import StreamingToolParser, get_tool_registry, simulated_weather
+
+
+def session_attribute(name):
+    """Property that forwards a Character attribute to its default conversation session"""
+    return property(
+        lambda self: getattr(self.session, name),
+        lambda self, value: setattr(self.session, name, value)
+    )
 
 
 class Character:
-    VALID_TIMES = ["early_morning", "morning", "afternoon", "evening", "night"]
+    VALID_TIMES = VALID_TIMES
+    CHAT_OPTIONS = {
+        "num_predict": 250,  # Limit token generation to 250 tokens for character responses
+        "temperature": 0.8,  # Slightly higher temperature for more creative character responses
+        "top_p": 0.9,        # Nucleus sampling for more natural responses
+        "top_k": 40          # Limit vocabulary diversity while keeping responses interesting
+    }
+    # Everything here depends only on the character, so the prompt prefix is byte-identical
+    # across turns and sessions and the model server can reuse its cached prefill
+    SYSTEM_PROMPT_TEMPLATE = (
+        "You are {name}, an AI character in a roleplay system. "
+        "Stay in character as {name} at all times. "
+        "Your background: {background} "
+        "Respond in {name}'s style and voice. "
+        "Do not break character or refer to yourself as an AI.\n\n"
+        "You can call tools by using specific syntax in your responses:\n"
+        "1. To advance time: [change_time:next_time] or [change_time:next_day]\n"
+        "2. To get current time: [tool:get_current_time]\n"
+        "3. To generate random number: [tool:random_number:min:max]\n"
+        "4. To access weather: [tool:get_weather:location]\n"
+        "Use these tools only when appropriate in conversation."
+    )
 
-    def __init__(self, name, intro, background, profile, db_name, user_name, user_persona, msgs_per_time_change=1):
+    def __init__(self, name, intro, background, profile, db_name, user_name, user_persona, msgs_per_time_change=1, summarizer=None):
         self.name = name
         self.intro = intro
         self.background = background
         # Fix path with forward slashes instead of backslashes for web compatibility
         self.profile = f"page/image/{profile}.png"
-        self.short_term_memory = ShortTermMemory()
-        self.long_term_memory = LongTermMemory(db_path=f"{db_name}_chroma")
+        self.db_name = db_name or f"{name.lower()}_memories"
+        self.long_term_memory = LongTermMemory(self.db_name)
         self.model = "dolphin3"
-        self.current_day = 1
-        self.time_of_day = "morning"
-        self.user_name = user_name
-        self.user_persona = user_persona
-        self.msgs_per_time_change = msgs_per_time_change
-        self.message_count = 0
-
-    def set_time(self, day, time_of_day):
-        if time_of_day not in self.VALID_TIMES:
-            raise ValueError(f"Invalid time_of_day. Must be one of: {', '.join(self.VALID_TIMES)}")
-        self.current_day = day
-        self.time_of_day = time_of_day
-
-    def advance_time(self):
-        current_index = self.VALID_TIMES.index(self.time_of_day)
-        if current_index < len(self.VALID_TIMES) - 1:
-            self.time_of_day = self.VALID_TIMES[current_index + 1]
-        else:
-            self.time_of_day = self.VALID_TIMES[0]
-            self.current_day += 1
-
-    def remember_message(self, message, time_since_last):
-        self.short_term_memory.add(message, time_since_last, self.current_day, self.time_of_day)
-
-    def summarize_and_store_memory(self):
-        if not self.short_term_memory.entries:
+        # Conversation state used when no explicit session is passed (CLI, defaults for new sessions)
+        self.session = ConversationSession(
+            "default",
+            name,
+            user_name=user_name,
+            user_persona=user_persona,
+            msgs_per_time_change=msgs_per_time_change
+        )
+        self.summarizer = summarizer  # Falls back to the shared background worker
+        self.tools = get_tool_registry()  # Tools this character can call from its replies
+        self._system_prompt = None  # ((name, background), message) built from SYSTEM_PROMPT_TEMPLATE
+
+    # Per-conversation state lives on the session; these keep the single-user API working
+    short_term_memory = property(lambda self: self.session.short_term_memory)
+    current_day = session_attribute("current_day")
+    time_of_day = session_attribute("time_of_day")
+    user_name = session_attribute("user_name")
+    user_persona = session_attribute("user_persona")
+    msgs_per_time_change = session_attribute("msgs_per_time_change")
+    message_count = session_attribute("message_count")
+
+    def set_time(self, day, time_of_day, session=None):
+        (session or self.session).set_time(day, time_of_day)
+
+    def advance_time(self, session=None):
+        (session or self.session).advance_time()
+
+    def remember_message(self, message, time_since_last, session=None):
+        session = session or self.session
+        session.short_term_memory.add(message, time_since_last, session.current_day, session.time_of_day)
+
+    def summarize_and_store_memory(self, session=None):
+        """Summarize short-term memory into long-term memory synchronously; returns the summary"""
+        session = session or self.session
+        if not len(session.short_term_memory):
+            return None
+
+        summary = self.summarize_entries(list(session.short_term_memory), session.current_day, session.time_of_day)
+        if summary:
+            self.long_term_memory.flush()
+            session.short_term_memory.clear()
+        return summary
+
+    def queue_memory_summary(self, session=None):
+        """Hand a snapshot of short-term memory to the background summarization worker"""
+        session = session or self.session
+        if not len(session.short_term_memory):
             return
 
-        messages = [item["message"] for item in self.short_term_memory.entries]
+        summarizer = self.summarizer or get_summarizer()
+        entries = list(session.short_term_memory)
+        # If the worker is saturated, keep the entries and try again on a later turn
+        if summarizer.submit(self, entries, session.current_day, session.time_of_day):
+            session.short_term_memory.clear()
+
+    def summarize_entries(self, entries, day, time_of_day):
+        """Summarize a list of short-term memory entries and store the result in long-term memory"""
+        messages = [entry.message for entry in entries]
         context = [{"role": "system", "content": "Summarize the following conversation into a long-term memory."}] + messages
 
         # Add token limit to Ollama call (max 150 tokens for summaries)
-        response = ollama.chat(
+        response = llm.chat(
             model=self.model, 
             messages=context,
             options={
@@ -63,202 +126,277 @@ class Character:
         summary = response.get("message", {}).get("content", None)
 
         if summary:
-            memory_id = f"day_{self.current_day}_time_{self.time_of_day}"
-            self.long_term_memory.add(memory_id, summary, self.current_day, self.time_of_day)
-            self.short_term_memory.clear()
+            self.long_term_memory.add(summary, day, time_of_day)
+        return summary
 
     def query_long_term_memory(self, prompt):
-        return self.long_term_memory.query(prompt)
-
-    def build_context(self, prompt):
-        system_prompt = {
-            "role": "system",
-            "content": (
-                f"You are {self.name}, an AI character in a roleplay system. "
-                f"Stay in character as {self.name} at all times. "
-                f"Your background: {self.background} "
-                f"Respond in {self.name}'s style and voice. "
-                f"The user is {self.user_name}: {self.user_persona}. "
-                f"Do not break character or refer to yourself as an AI.\n\n"
-                f"You can call tools by using specific syntax in your responses:\n"
-                f"1. To advance time: [change_time:next_time] or [change_time:next_day]\n"
-                f"2. To get current time: [tool:get_current_time]\n"
-                f"3. To generate random number: [tool:random_number:min:max]\n"
-                f"4. To access weather: [tool:get_weather:location]\n"
-                f"Use these tools only when appropriate in conversation."
-            )
-        }
-        short_mem = self.short_term_memory.get_recent()
-        long_mem = self.query_long_term_memory(prompt)
+        with span("memory_query", character=self.name):
+            return self.long_term_memory.query(prompt)
+
+    def system_prompt(self):
+        """The static system message, built once and rebuilt only if the character is edited"""
+        key = (self.name, self.background)
+        if self._system_prompt is None or self._system_prompt[0] != key:
+            content = self.SYSTEM_PROMPT_TEMPLATE.format(name=self.name, background=self.background)
+            self._system_prompt = (key, {"role": "system", "content": content})
+        return self._system_prompt[1]
+
+    def invalidate_prompt_cache(self):
+        self._system_prompt = None
+
+    def build_context(self, prompt, session=None, recalled=None):
+        """
+        Assemble the messages for a turn, most stable first: the character's static
+        prompt, then the user's persona, the conversation so far (in a window that
+        advances in steps), and last the memories recalled for this message, which
+        change every turn
+        Everything is fitted into the model's token budget; the tokens each section
+        used are kept in session.context_usage
+        recalled is the long-term memory for prompt when it was already retrieved
+        """
+        session = session or self.session
+        persona = {"role": "system", "content": f"The user is {session.user_name}: {session.user_persona}."}
+        user_message = {"role": "user", "content": f"{session.user_name}: {prompt}"}
+        short_mem = session.short_term_memory.get_window()
+        if short_mem and short_mem[-1] == user_message:
+            short_mem = short_mem[:-1]  # start_turn already remembered it; send it only once
+        long_mem = self.query_long_term_memory(prompt) if recalled is None else recalled
         long_mem_messages = [{"role": "system", "content": mem} for mem in long_mem]
-        context = [system_prompt] + long_mem_messages + short_mem + [
-            {"role": "user", "content": f"{self.user_name}: {prompt}"}
-        ]
+        builder = get_context_builder(self.model, self.CHAT_OPTIONS["num_predict"])
+        context, session.context_usage = builder.build(
+            [self.system_prompt(), persona],
+            short_mem,
+            long_mem_messages,
+            user_message
+        )
         return context
 
-    def talk(self, user_message, time_since_last="unknown", auto_advance=True):
-        self.remember_message({"role": "user", "content": f"{self.user_name}: {user_message}"}, time_since_last)
-        
+    def talk(self, user_message, time_since_last="unknown", auto_advance=True, session=None, recalled=None):
+        with get_metrics().context(character=self.name):
+            return self._talk(user_message, time_since_last, auto_advance, session, recalled)
+
+    def _talk(self, user_message, time_since_last, auto_advance, session, recalled=None):
+        session = session or self.session
         # Check for time control commands
-        time_command = self.check_for_time_commands(user_message)
+        time_command = self.start_turn(user_message, time_since_last, session)
         if time_command:
             return time_command
             
-        context = self.build_context(user_message)
+        context = self.build_context(user_message, session, recalled)
         
         # Add token limit and response parameters
-        response = ollama.chat(
+        response = llm.chat(
             model=self.model, 
             messages=context,
-            options={
-                "num_predict": 250,  # Limit token generation to 250 tokens for character responses
-                "temperature": 0.8,  # Slightly higher temperature for more creative character responses
-                "top_p": 0.9,        # Nucleus sampling for more natural responses
-                "top_k": 40          # Limit vocabulary diversity while keeping responses interesting
-            }
+            options=self.CHAT_OPTIONS
         )
         
+        return self.complete_turn(response, auto_advance, session)
+
+    async def atalk(self, user_message, time_since_last="unknown", auto_advance=True, session=None, recalled=None):
+        """Async version of talk; memory retrieval runs on the memory pool and the model call is awaited"""
+        with get_metrics().context(character=self.name):
+            session = session or self.session
+            time_command = self.start_turn(user_message, time_since_last, session)
+            if time_command:
+                return time_command
+
+            context = await run_blocking("memory", self.build_context, user_message, session, recalled)
+            response = await llm.achat(model=self.model, messages=context, options=self.CHAT_OPTIONS)
+            return self.complete_turn(response, auto_advance, session)
+
+    def start_turn(self, user_message, time_since_last, session):
+        """Remember the user's message; returns the reply to a time command, which needs no model call"""
+        self.remember_message({"role": "user", "content": f"{session.user_name}: {user_message}"}, time_since_last, session)
+        return self.check_for_time_commands(user_message, session)
+
+    def complete_turn(self, response, auto_advance, session):
+        """Resolve tool calls in a model response and finish the turn; returns the processed reply"""
         reply = response.get("message", {}).get("content", "No response")
         
         # Check for all tool calls in the response
-        processed_reply = self.process_tool_calls(reply)
+        processed_reply = self.process_tool_calls(reply, session)
         
-        self.remember_message({"role": "assistant", "content": processed_reply}, "0s")
+        self.finish_turn(processed_reply, auto_advance, session)
+            
+        return processed_reply
+
+    def talk_stream(self, user_message, time_since_last="unknown", auto_advance=True, session=None, recalled=None):
+        """Streaming version of talk that yields reply text as the model generates it.
+
+        Tool and time-change tags are resolved as soon as they are complete, so the
+        caller only ever sees processed text. The reply is remembered once the stream
+        is exhausted, or with whatever was generated if the caller stops early.
+        """
+        stream = self._talk_stream(user_message, time_since_last, auto_advance, session, recalled)
+        try:
+            while True:
+                # The labels are set only while the turn runs, not in the caller between chunks
+                with get_metrics().context(character=self.name):
+                    try:
+                        text = next(stream)
+                    except StopIteration:
+                        return
+                yield text
+        finally:
+            with get_metrics().context(character=self.name):
+                stream.close()
+
+    def _talk_stream(self, user_message, time_since_last, auto_advance, session, recalled=None):
+        session = session or self.session
+        time_command = self.start_turn(user_message, time_since_last, session)
+        if time_command:
+            yield time_command
+            return
+            
+        context = self.build_context(user_message, session, recalled)
+        
+        stream = llm.chat(
+            model=self.model, 
+            messages=context,
+            options=self.CHAT_OPTIONS,
+            stream=True
+        )
+        
+        parser = self.tools.stream_parser(self, session)
+        parts = []
+        try:
+            for chunk in stream:
+                text = parser.feed(chunk.get("message", {}).get("content", ""))
+                if text:
+                    parts.append(text)
+                    yield text
+            text = parser.flush()
+            if text:
+                parts.append(text)
+                yield text
+        finally:
+            # Also when the client disconnects mid-reply: the turn is finished with what was said
+            close = getattr(stream, "close", None)
+            if close:
+                close()  # Frees the model slot right away
+            processed_reply = "".join(parts).strip() or "No response"
+            self.finish_turn(processed_reply, auto_advance, session)
+
+    async def atalk_stream(self, user_message, time_since_last="unknown", auto_advance=True, session=None,
+                           recalled=None):
+        """Async version of talk_stream"""
+        stream = self._atalk_stream(user_message, time_since_last, auto_advance, session, recalled)
+        try:
+            while True:
+                with get_metrics().context(character=self.name):
+                    try:
+                        text = await stream.__anext__()
+                    except StopAsyncIteration:
+                        return
+                yield text
+        finally:
+            with get_metrics().context(character=self.name):
+                await stream.aclose()
+
+    async def _atalk_stream(self, user_message, time_since_last, auto_advance, session, recalled=None):
+        session = session or self.session
+        time_command = self.start_turn(user_message, time_since_last, session)
+        if time_command:
+            yield time_command
+            return
+
+        context = await run_blocking("memory", self.build_context, user_message, session, recalled)
+        stream = await llm.achat(model=self.model, messages=context, options=self.CHAT_OPTIONS, stream=True)
+
+        parser = self.tools.stream_parser(self, session)
+        parts = []
+        try:
+            async for chunk in stream:
+                text = parser.feed(chunk.get("message", {}).get("content", ""))
+                if text:
+                    parts.append(text)
+                    yield text
+            text = parser.flush()
+            if text:
+                parts.append(text)
+                yield text
+        finally:
+            close = getattr(stream, "aclose", None)
+            if close:
+                await close()
+            processed_reply = "".join(parts).strip() or "No response"
+            self.finish_turn(processed_reply, auto_advance, session)
+
+    def finish_turn(self, processed_reply, auto_advance=True, session=None):
+        """Record the character's reply and run the end-of-turn bookkeeping"""
+        session = session or self.session
+        self.remember_message({"role": "assistant", "content": processed_reply}, "0s", session)
         
         # Check if it's time to update long-term memory
         # We'll update memory when we have at least 8 messages
-        if len(self.short_term_memory.entries) >= 8:
-            self.summarize_and_store_memory()
+        if len(session.short_term_memory) >= 8:
+            self.queue_memory_summary(session)
         
         # Auto-advance time based on message count if enabled
         if auto_advance:
-            self.message_count += 1
-            if self.message_count >= self.msgs_per_time_change:
-                self.advance_time()
-                self.message_count = 0
-            
-        return processed_reply
+            session.message_count += 1
+            if session.message_count >= session.msgs_per_time_change:
+                session.advance_time()
+                session.message_count = 0
         
-    def process_tool_calls(self, reply):
+    def process_tool_calls(self, reply, session=None):
         """Process all tool calls in the AI's reply"""
-        # First check for time commands (for backward compatibility)
-        time_command = self.check_for_ai_time_commands(reply)
-        if time_command:
-            self.execute_time_command(time_command)
-            # Remove the time command from the reply
-            reply = re.sub(r'\[change_time:.*?\]', '', reply).strip()
-        
-        # Now check for general tool calls
-        tool_pattern = r'\[tool:(.*?)\]'
-        tool_matches = re.finditer(tool_pattern, reply)
-        
-        for match in tool_matches:
-            tool_call = match.group(1)
-            tool_result = self.execute_tool_call(tool_call)
-            
-            # Replace the tool call with its result
-            if tool_result is not None:
-                reply = reply.replace(match.group(0), tool_result)
-            else:
-                # If tool execution failed, just remove the tool call
-                reply = reply.replace(match.group(0), "")
-                
-        return reply
-    
-    def execute_tool_call(self, tool_call):
+        with span("tools", character=self.name):
+            return self.tools.process(self, reply, session)
+
+    def execute_tool_call(self, tool_call, session=None):
         """Execute a general tool call from the AI"""
-        parts = tool_call.split(':')
-        tool_name = parts[0].strip()
-        
-        try:
-            if tool_name == "get_current_time":
-                return self.tool_get_current_time()
-                
-            elif tool_name == "random_number" and len(parts) >= 3:
-                try:
-                    min_val = int(parts[1].strip())
-                    max_val = int(parts[2].strip())
-                    return self.tool_random_number(min_val, max_val)
-                except ValueError:
-                    return f"*Error: random_number tool requires integer values*"
-                
-            elif tool_name == "get_weather" and len(parts) >= 2:
-                location = ':'.join(parts[1:])  # Join all remaining parts in case location contains ':'
-                location = location.strip()
-                return self.tool_get_weather(location)
-                
-            else:
-                return f"*Tool '{tool_name}' not found or missing parameters*"
-                
-        except Exception as e:
-            return f"*Error executing tool '{tool_name}': {str(e)}*"
-    
+        return self.tools.execute(self, tool_call, session)
+
     def tool_get_current_time(self):
         """Tool: Get the current real-world time"""
         now = datetime.datetime.now()
         return now.strftime("%I:%M %p on %A, %B %d, %Y")
     
-    def tool_random_number(self, min_val, max_val):
+    def tool_random_number(self, min_val, max_val, session=None):
         """Tool: Generate a random number between min and max"""
+        session = session or self.session
         if min_val > max_val:
             min_val, max_val = max_val, min_val
-        result = random.randint(min_val, max_val)
+        result = session.rng.randint(min_val, max_val)
         return str(result)
     
-    def tool_get_weather(self, location):
+    def tool_get_weather(self, location, session=None):
         """Tool: Simulate getting weather for a location"""
+        session = session or self.session
         # This is a simulated weather tool (no real API call)
-        weather_options = ["sunny", "cloudy", "rainy", "stormy", "windy", "snowy", "foggy"]
-        temperatures = {"sunny": (75, 95), "cloudy": (60, 80), "rainy": (50, 70),
-                       "stormy": (55, 75), "windy": (50, 70), "snowy": (20, 35), "foggy": (45, 65)}
-        
-        # Use location as seed for deterministic but varied results
-        seed = sum(ord(c) for c in location) + self.current_day
-        random.seed(seed)
-        
-        weather = random.choice(weather_options)
-        temp_range = temperatures[weather]
-        temp = random.randint(temp_range[0], temp_range[1])
-        
-        # Reset random seed
-        random.seed()
-        
+        weather, temp = simulated_weather(location, session.current_day)
         return f"In {location}, it's currently {weather} with a temperature of {temp}°F"
 
-    def check_for_time_commands(self, message):
+    def check_for_time_commands(self, message, session=None):
         """Check if the user message contains time control commands"""
+        session = session or self.session
         lower_msg = message.lower()
         
         if "/time next" in lower_msg:
-            self.advance_time()
-            return f"*Time advances to {self.time_of_day}, Day {self.current_day}*"
+            session.advance_time()
+            return f"*Time advances to {session.time_of_day}, Day {session.current_day}*"
             
         elif "/time previous" in lower_msg:
-            current_index = self.VALID_TIMES.index(self.time_of_day)
-            if current_index > 0:
-                self.time_of_day = self.VALID_TIMES[current_index - 1]
-            else:
-                self.time_of_day = self.VALID_TIMES[-1]
-                if self.current_day > 1:
-                    self.current_day -= 1
-            return f"*Time rolls back to {self.time_of_day}, Day {self.current_day}*"
+            session.rewind_time()
+            return f"*Time rolls back to {session.time_of_day}, Day {session.current_day}*"
             
         elif "/day next" in lower_msg:
-            self.current_day += 1
-            self.time_of_day = self.VALID_TIMES[0]
-            return f"*A new day begins. It is now {self.time_of_day}, Day {self.current_day}*"
+            session.next_day()
+            return f"*A new day begins. It is now {session.time_of_day}, Day {session.current_day}*"
             
         elif "/day previous" in lower_msg:
-            if self.current_day > 1:
-                self.current_day -= 1
-                return f"*Going back to Day {self.current_day}, {self.time_of_day}*"
+            if session.current_day > 1:
+                session.current_day -= 1
+                return f"*Going back to Day {session.current_day}, {session.time_of_day}*"
             return "*You can't go back before Day 1*"
             
         elif "/set messages" in lower_msg:
             try:
                 # Extract number from command like "/set messages 3"
                 num = int(re.search(r'/set messages (\d+)', lower_msg).group(1))
-                self.msgs_per_time_change = num
+                session.msgs_per_time_change = num
                 return f"*Time will now advance every {num} messages*"
             except:
                 return "*Invalid format. Use '/set messages X' where X is a number*"
@@ -272,15 +410,15 @@ class Character:
             return match.group(1).strip()
         return None
         
-    def execute_time_command(self, command):
+    def execute_time_command(self, command, session=None):
         """Execute a time command from the AI"""
+        session = session or self.session
         command = command.lower()
         
         if command == "next_time":
-            self.advance_time()
+            session.advance_time()
         elif command == "next_day":
-            self.current_day += 1
-            self.time_of_day = self.VALID_TIMES[0]
+            session.next_day()
         # Additional commands could be added here
 
     def to_dict(self):
@@ -289,7 +427,7 @@ class Character:
             "intro": self.intro,
             "background": self.background,
             "profile": self.profile,
-            "db_name": getattr(self.long_term_memory, "db_path", "").replace("_chroma", ""),
+            "db_name": self.db_name,
             "user_name": self.user_name,
             "user_persona": self.user_persona,
             "current_day": self.current_day,
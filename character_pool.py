@@ -1,67 +1,154 @@
 from character import Character
+from collections import OrderedDict
+from state_store import open_store
 import json
 import os
+import threading
 
 class CharacterPool:
-    CHARACTERS_FILE = "characters.json"
-    
-    def __init__(self):
-        self.characters = {}
+    """
+    Registry of all characters.
+    Every character is kept as a lightweight metadata record; the full Character
+    (with its memory backends) is only built the first time it is used, and the
+    least recently used characters are unloaded once more than max_resident are live.
+    Records are persisted one character at a time in a journaled state store.
+    """
+    CHARACTERS_FILE = "characters.json"  # Legacy file, imported once into the state store
+    STATE_DIR = os.path.join("state", "characters")
+    DEFAULT_MAX_RESIDENT = 64
+
+    def __init__(self, max_resident=None, store=None):
+        self.records = {}  # Character name -> saved character data
+        self.resident = OrderedDict()  # Character name -> Character, least recently used first
+        self.max_resident = max_resident or int(os.environ.get("TALKBOT_MAX_RESIDENT_CHARACTERS", self.DEFAULT_MAX_RESIDENT))
+        self.lock = threading.RLock()
+        self.store = store or open_store("characters", self.STATE_DIR)
         self.load_characters()
 
     def add_character(self, character: Character):
-        self.characters[character.name] = character
-        self.save_characters()
+        with self.lock:
+            self.resident[character.name] = character
+            self.resident.move_to_end(character.name)
+            self._write_record(character.name, character.to_dict())
+            self._evict()
 
     def get_character(self, name):
-        return self.characters.get(name)
+        """Return the Character with this name, building it from its record if needed"""
+        with self.lock:
+            character = self.resident.get(name)
+            if character:
+                self.resident.move_to_end(name)
+                return character
+            record = self.records.get(name)
+            if not record:
+                return None
+            character = self._hydrate(record)
+            self.resident[name] = character
+            self._evict()
+            return character
+
+    def get_resident(self, name):
+        """Return the Character only if it is already loaded, without touching LRU order"""
+        with self.lock:
+            return self.resident.get(name)
+
+    def has_character(self, name):
+        return name in self.records
+
+    def get_record(self, name):
+        """Return the metadata record for a character without loading it"""
+        with self.lock:
+            character = self.resident.get(name)
+            return character.to_dict() if character else self.records.get(name)
 
     def remove_character(self, name):
-        if name in self.characters:
-            del self.characters[name]
-            self.save_characters()
+        with self.lock:
+            if name not in self.records:
+                return
+            del self.records[name]
+            self.resident.pop(name, None)
+            self.store.delete("characters", name)
+
+    def list_records(self):
+        """Return metadata for every character without loading any of them"""
+        with self.lock:
+            return [self.get_record(name) for name in self.records]
 
     def list_characters(self):
-        return list(self.characters.values())
-        
+        """Return every character, loading any that aren't resident"""
+        return [self.get_character(name) for name in list(self.records)]
+
+    def save_character(self, name):
+        """Persist the current state of one loaded character"""
+        with self.lock:
+            character = self.resident.get(name)
+            if character:
+                self._write_record(name, character.to_dict())
+
     def save_characters(self):
-        """Save all characters to a JSON file"""
-        characters_data = []
-        for char in self.characters.values():
-            characters_data.append(char.to_dict())
-        
-        with open(self.CHARACTERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(characters_data, f, indent=2)
-            
+        """Persist every loaded character whose state changed"""
+        with self.lock:
+            for name in list(self.resident):
+                self.save_character(name)
+
     def load_characters(self):
-        """Load characters from the JSON file if it exists"""
-        if not os.path.exists(self.CHARACTERS_FILE):
+        """Load character records from the state store, importing the legacy JSON file on first run"""
+        if self.store.is_empty() and os.path.exists(self.CHARACTERS_FILE):
+            try:
+                with open(self.CHARACTERS_FILE, "r", encoding="utf-8") as f:
+                    characters_data = json.load(f)
+
+                for char_data in characters_data:
+                    self.store.put("characters", char_data["name"], char_data)
+                self.store.compact()
+            except Exception as e:
+                print(f"Error loading characters: {e}")
+
+        self.records = dict(self.store.collection("characters"))
+
+    def refresh(self):
+        """Pick up characters another worker process added, changed or removed"""
+        if not self.store.changed():
             return
-            
-        try:
-            with open(self.CHARACTERS_FILE, "r", encoding="utf-8") as f:
-                characters_data = json.load(f)
-                
-            for char_data in characters_data:
-                char = Character(
-                    name=char_data["name"],
-                    intro=char_data["intro"],
-                    background=char_data["background"],
-                    profile=char_data["profile"].replace("page/image/", "").replace(".png", ""),
-                    db_name=char_data.get("db_name", f"{char_data['name'].lower()}_memories"),
-                    user_name=char_data.get("user_name", "Guest"),
-                    user_persona=char_data.get("user_persona", "A curious visitor to the website."),
-                    msgs_per_time_change=char_data.get("msgs_per_time_change", 1)
-                )
-                
-                # Set time and other state properties if they exist
-                if "current_day" in char_data:
-                    char.current_day = char_data["current_day"]
-                if "time_of_day" in char_data:
-                    char.time_of_day = char_data["time_of_day"]
-                if "message_count" in char_data:
-                    char.message_count = char_data["message_count"]
-                
-                self.characters[char.name] = char
-        except Exception as e:
-            print(f"Error loading characters: {e}")
+        with self.lock:
+            records = dict(self.store.collection("characters"))
+            for name in list(self.resident):
+                if records.get(name) != self.records.get(name):
+                    # Rebuilt from the new record the next time it is used
+                    del self.resident[name]
+            self.records = records
+
+    def _hydrate(self, char_data):
+        """Build a Character from its saved record"""
+        char = Character(
+            name=char_data["name"],
+            intro=char_data["intro"],
+            background=char_data["background"],
+            profile=char_data["profile"].replace("page/image/", "").replace(".png", ""),
+            db_name=char_data.get("db_name") or f"{char_data['name'].lower()}_memories",
+            user_name=char_data.get("user_name", "Guest"),
+            user_persona=char_data.get("user_persona", "A curious visitor to the website."),
+            msgs_per_time_change=char_data.get("msgs_per_time_change", 1)
+        )
+
+        # Set time and other state properties if they exist
+        if "current_day" in char_data:
+            char.current_day = char_data["current_day"]
+        if "time_of_day" in char_data:
+            char.time_of_day = char_data["time_of_day"]
+        if "message_count" in char_data:
+            char.message_count = char_data["message_count"]
+        return char
+
+    def _evict(self):
+        """Unload least recently used characters, keeping their state in the records"""
+        while len(self.resident) > self.max_resident:
+            name, character = self.resident.popitem(last=False)
+            if name in self.records:
+                self._write_record(name, character.to_dict())
+
+    def _write_record(self, name, record):
+        """Update a character's record, journaling it only if it changed"""
+        if self.records.get(name) != record:
+            self.records[name] = record
+            self.store.put("characters", name, record)
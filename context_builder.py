@@ -0,0 +1,170 @@
+import logging
+import os
+import re
+import threading
+from llm import parse_model_settings
+
+logger = logging.getLogger("talkbot.context")
+
+# Context window sizes of the models we run, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "dolphin3": 4096
+}
+DEFAULT_CONTEXT_TOKENS = 2048  # Ollama's default num_ctx
+
+
+class TokenEstimator:
+    """
+    Fast local token counter.
+    Without a tokenizer, words and punctuation are counted with one regex pass, with
+    long words costing extra; that is close enough to BPE counts for budgeting.
+    A tokenizer with an encode(text) method can be passed for exact counts.
+    """
+    PATTERN = re.compile(r"\w+|[^\w\s]")
+    MESSAGE_OVERHEAD = 4  # Role markers and separators added around each message
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+
+    def count(self, text) -> int:
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text))
+        return sum(1 + len(piece) // 7 for piece in self.PATTERN.findall(text))
+
+    def count_message(self, message) -> int:
+        return self.count(message.get("content", "")) + self.MESSAGE_OVERHEAD
+
+    def truncate(self, text, max_tokens, marker=" [...] "):
+        """Shorten text to about max_tokens, keeping its beginning and end"""
+        tokens = self.count(text)
+        if tokens <= max_tokens:
+            return text
+        if max_tokens <= 0:
+            return ""
+        marker_tokens = self.count(marker)
+        if max_tokens <= marker_tokens:
+            return text[:max(1, len(text) * max_tokens // tokens)]
+        keep = len(text) * (max_tokens - marker_tokens) // tokens
+        while True:
+            head = keep * 2 // 3
+            shortened = text[:head] + marker + text[len(text) - (keep - head):]
+            # Cut points can split words into extra pieces; shrink until it fits
+            if keep <= 1 or self.count(shortened) <= max_tokens:
+                return shortened
+            keep = keep * 9 // 10
+
+
+class ContextBuilder:
+    """
+    Fits a turn's messages into a model's token budget.
+    Sections are filled by priority: the system messages and the new user message
+    first (a long paste is cut down to max_user_share of the budget), then as many
+    recent turns as fit, newest first, then retrieved memories in rank order. Older
+    turns that don't fit are left out of the prompt; they are still in short-term
+    memory and end up in long-term memory through the summarizer.
+    """
+
+    def __init__(self, budget, estimator=None, max_user_share=0.35, max_system_share=0.5):
+        self.budget = budget
+        self.estimator = estimator or TokenEstimator()
+        self.max_user_share = max_user_share
+        self.max_system_share = max_system_share
+
+    def build(self, system, history, memories, user_message):
+        """
+        Return (messages, usage) with messages in prompt order: system, history,
+        memories, user message; usage reports the tokens each section used
+        """
+        estimate = self.estimator
+        overhead = estimate.MESSAGE_OVERHEAD
+        truncated = 0
+
+        system = list(system)
+        system_tokens = sum(estimate.count_message(m) for m in system)
+        system_limit = int(self.budget * self.max_system_share)
+        if system_tokens > system_limit and system:
+            # Only the most variable system message, the last one, is cut
+            last = system[-1]
+            others = system_tokens - estimate.count_message(last)
+            system[-1] = dict(last, content=estimate.truncate(last["content"], system_limit - others - overhead))
+            system_tokens = sum(estimate.count_message(m) for m in system)
+            truncated += 1
+
+        user_limit = int(self.budget * self.max_user_share)
+        if estimate.count_message(user_message) > user_limit:
+            user_message = dict(user_message, content=estimate.truncate(user_message["content"], user_limit - overhead))
+            truncated += 1
+        user_tokens = estimate.count_message(user_message)
+
+        remaining = self.budget - system_tokens - user_tokens
+        kept_history = []
+        history_tokens = 0
+        for message in reversed(history):
+            cost = estimate.count_message(message)
+            if cost > remaining:
+                if not kept_history and remaining > overhead * 4:
+                    # Always keep some of the latest turn, even if it's a long paste
+                    message = dict(message, content=estimate.truncate(message["content"], remaining - overhead))
+                    cost = estimate.count_message(message)
+                    truncated += 1
+                else:
+                    break
+            kept_history.append(message)
+            history_tokens += cost
+            remaining -= cost
+        kept_history.reverse()
+
+        kept_memories = []
+        memory_tokens = 0
+        for message in memories:
+            cost = estimate.count_message(message)
+            if cost <= remaining:
+                kept_memories.append(message)
+                memory_tokens += cost
+                remaining -= cost
+
+        usage = {
+            "budget": self.budget,
+            "system": system_tokens,
+            "history": history_tokens,
+            "memories": memory_tokens,
+            "user": user_tokens,
+            "total": self.budget - remaining,
+            "dropped_history": len(history) - len(kept_history),
+            "dropped_memories": len(memories) - len(kept_memories),
+            "truncated": truncated
+        }
+        logger.debug("Context usage: %s", usage)
+        return system + kept_history + kept_memories + [user_message], usage
+
+
+_builders = {}
+_builders_lock = threading.Lock()
+
+
+def context_tokens(model) -> int:
+    """
+    A model's context window, overridable with TALKBOT_CONTEXT_TOKENS or per model
+    with TALKBOT_MODEL_CONTEXT_TOKENS ("dolphin3=8192"); the LLM gateway sends it
+    as num_ctx, so the server's window is the one prompts are budgeted for
+    """
+    per_model = parse_model_settings(os.environ.get("TALKBOT_MODEL_CONTEXT_TOKENS"))
+    window = per_model.get(model) or os.environ.get("TALKBOT_CONTEXT_TOKENS") \
+        or MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    return int(window)
+
+
+def context_budget(model, reply_tokens=0):
+    """Prompt token budget for a model: its context window minus the tokens reserved for the reply"""
+    return context_tokens(model) - reply_tokens
+
+
+def get_context_builder(model, reply_tokens=0) -> ContextBuilder:
+    """Return the shared context builder for a model"""
+    with _builders_lock:
+        key = (model, reply_tokens)
+        if key not in _builders:
+            _builders[key] = ContextBuilder(context_budget(model, reply_tokens))
+        return _builders[key]
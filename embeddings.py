@@ -0,0 +1,190 @@
+import math
+import os
+import re
+import threading
+import time
+import zlib
+
+
+class Embedder:
+    """
+    Interface for the embedding functions used by long-term memory.
+    Implementations take a list of texts and return one vector per text, in the
+    call signature Chroma expects, so they can be handed to a collection directly.
+    The name identifies the vector space: memories embedded by one embedder can
+    only be searched with the same one.
+    """
+    name = "embedder"
+
+    def __call__(self, input):
+        raise NotImplementedError
+
+    def embed(self, texts):
+        return self(list(texts))
+
+    def embed_one(self, text):
+        return self([text])[0]
+
+
+class ChromaDefaultEmbedder(Embedder):
+    """Chroma's built-in MiniLM ONNX model, loaded on first use"""
+    name = "default"
+
+    def __init__(self):
+        self._model = None
+        self._lock = threading.Lock()
+
+    def __call__(self, input):
+        with self._lock:
+            if self._model is None:
+                from chromadb.utils import embedding_functions
+                self._model = embedding_functions.DefaultEmbeddingFunction()
+        return [list(vector) for vector in self._model(input)]
+
+
+class HashingEmbedder(Embedder):
+    """
+    CPU-only embedder with no model to load: words, word pairs and character
+    trigrams are hashed into a fixed number of signed buckets, weighted by
+    log term frequency and L2-normalised. Roughly a thousand times faster than
+    a neural model and good at matching shared names and topics, but blind to
+    paraphrases.
+    """
+    TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+    STOP_WORDS = frozenset((
+        "a an and are as at be but by did do for from had has have he her him his i if in is it its "
+        "me my of on or our she so that the their them they this to was we were what when which who "
+        "will with you your"
+    ).split())
+
+    def __init__(self, dimension=512, char_ngrams=3):
+        self.dimension = dimension
+        self.char_ngrams = char_ngrams
+        self.name = f"hashing{dimension}"
+
+    def __call__(self, input):
+        return [self._embed(text) for text in input]
+
+    def features(self, text):
+        words = [w for w in self.TOKEN_PATTERN.findall(text.lower()) if w not in self.STOP_WORDS]
+        features = list(words)
+        features.extend(f"{a} {b}" for a, b in zip(words, words[1:]))
+        n = self.char_ngrams
+        for word in words:
+            padded = f"<{word}>"
+            features.extend("#" + padded[i:i + n] for i in range(len(padded) - n + 1))
+        return features
+
+    def _embed(self, text):
+        counts = {}
+        for feature in self.features(text):
+            h = zlib.crc32(feature.encode("utf-8"))
+            # One hash bit picks the sign so collisions tend to cancel out
+            bucket = (h >> 1) % self.dimension
+            counts[bucket] = counts.get(bucket, 0.0) + (1.0 if h & 1 else -1.0)
+
+        vector = [0.0] * self.dimension
+        for bucket, count in counts.items():
+            vector[bucket] = math.copysign(1.0 + math.log(abs(count)), count) if count else 0.0
+        norm = math.sqrt(sum(v * v for v in vector))
+        if norm:
+            vector = [v / norm for v in vector]
+        else:
+            vector[0] = 1.0  # Chroma rejects all-zero vectors for some spaces
+        return vector
+
+
+class BatchedEmbedder(Embedder):
+    """
+    Wraps another embedder so it is called with many texts at once.
+    Large inputs are split into batches of max_batch_size. Single-text calls made
+    concurrently from different threads, e.g. the query embeddings of several
+    chats, are coalesced: callers that arrive while a batch is being embedded
+    queue up, and the first of them waits up to max_wait seconds for more to join
+    before embedding the whole group in one call. A caller with nobody else
+    waiting is embedded right away.
+    """
+
+    def __init__(self, inner, max_batch_size=64, max_wait=0.005):
+        self.inner = inner
+        self.name = inner.name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.pending = []  # Slots waiting to be embedded by the current leader
+        self.leader_active = False
+        self.calls = 0
+        self.texts = 0
+
+    def __call__(self, input):
+        texts = list(input)
+        if len(texts) == 1:
+            return [self._coalesce(texts[0])]
+        vectors = []
+        for start in range(0, len(texts), self.max_batch_size):
+            vectors.extend(self._embed_batch(texts[start:start + self.max_batch_size]))
+        return vectors
+
+    def _embed_batch(self, texts):
+        with self.condition:
+            self.calls += 1
+            self.texts += len(texts)
+        return self.inner(texts)
+
+    def _coalesce(self, text):
+        slot = {"text": text, "done": False, "vector": None, "error": None}
+        with self.condition:
+            self.pending.append(slot)
+            self.condition.notify_all()
+        while True:
+            with self.condition:
+                while not slot["done"] and self.leader_active:
+                    self.condition.wait()
+                if slot["done"]:
+                    break
+                # Nobody is embedding right now: lead the next batch, waiting for
+                # others to join only when there is contention
+                self.leader_active = True
+                deadline = time.monotonic() + self.max_wait
+                while 1 < len(self.pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.max_batch_size]
+                del self.pending[:self.max_batch_size]
+            self._run_batch(batch)
+
+        if slot["error"] is not None:
+            raise slot["error"]
+        return slot["vector"]
+
+    def _run_batch(self, batch):
+        try:
+            vectors = self._embed_batch([s["text"] for s in batch])
+            error = None
+        except Exception as e:
+            vectors, error = [None] * len(batch), e
+        with self.condition:
+            for s, vector in zip(batch, vectors):
+                s["vector"], s["error"], s["done"] = vector, error, True
+            self.leader_active = False
+            self.condition.notify_all()
+
+
+EMBEDDERS = {
+    "default": ChromaDefaultEmbedder,
+    "hashing": HashingEmbedder
+}
+
+
+def create_embedder(name=None, batched=True):
+    """
+    Build an embedder by name ("default" or "hashing"); the name defaults to the
+    TALKBOT_EMBEDDER environment variable
+    """
+    name = name or os.environ.get("TALKBOT_EMBEDDER", "default")
+    if name not in EMBEDDERS:
+        raise ValueError(f"Unknown embedder '{name}'. Must be one of: {', '.join(EMBEDDERS)}")
+    embedder = EMBEDDERS[name]()
+    return BatchedEmbedder(embedder) if batched else embedder
@@ -0,0 +1,90 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from llm import ModelLimiter
+
+# Blocking work that async request handlers hand off, by kind. Each kind has its
+# own small pool, so slow disk writes can't hold up memory retrieval and a burst
+# of requests queues here instead of starting a thread per connection
+POOL_SIZES = {
+    "memory": ("TALKBOT_MEMORY_WORKERS", 8),    # Long-term memory (Chroma) queries and context building
+    "storage": ("TALKBOT_STORAGE_WORKERS", 4)   # Saving sessions, narrators and other state
+}
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(kind):
+    """Return the process-wide pool for one kind of blocking work, creating it on first use"""
+    with _executors_lock:
+        executor = _executors.get(kind)
+        if executor is None:
+            variable, default = POOL_SIZES[kind]
+            executor = ThreadPoolExecutor(max_workers=int(os.environ.get(variable, default)),
+                                          thread_name_prefix=f"talkbot-{kind}")
+            _executors[kind] = executor
+        return executor
+
+
+def submit(kind, fn, *args, **kwargs):
+    """Start fn(*args, **kwargs) on the pool for its kind without waiting; metric labels carry over"""
+    return get_executor(kind).submit(contextvars.copy_context().run, _call, fn, args, kwargs)
+
+
+async def run_blocking(kind, fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) on the pool for its kind and await the result; metric labels carry over"""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, _call, fn, args, kwargs)
+    return await loop.run_in_executor(get_executor(kind), call)
+
+
+def _call(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except StopIteration as e:
+        # asyncio can't set StopIteration on a future, and the awaiting request would hang forever
+        raise RuntimeError(f"{getattr(fn, '__qualname__', fn)} raised StopIteration") from e
+
+
+class TurnLock(ModelLimiter):
+    """
+    Lock shared by worker threads and event-loop tasks: a ModelLimiter of one, so it
+    passes straight to the next waiter in arrival order whichever side it came from.
+    Threads hold it with `with lock`, tasks with `async with locked(lock)`.
+    """
+
+    def __init__(self):
+        super().__init__(1)
+
+    def locked(self):
+        with self.lock:
+            return self.active > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class locked:
+    """Async context manager holding a TurnLock without blocking the event loop"""
+    __slots__ = ("lock",)
+
+    def __init__(self, lock):
+        self.lock = lock
+
+    async def __aenter__(self):
+        await self.lock.acquire_async()
+        return self.lock
+
+    async def __aexit__(self, *exc):
+        self.lock.release()
+        return False
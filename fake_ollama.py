@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class BackloggedHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 256  # Load tests open many connections at once; the default of 5 resets them
+
+
+class FakeOllamaServer:
+    """
+    Minimal stand-in for the Ollama HTTP API, used by tests and benchmarks.
+    Serves /api/chat with a configurable time to first token and token rate, can
+    fail the first few requests, and records what it was asked for.
+    With prefill_tokens_per_second set, prompt processing is simulated too: like a
+    real server, only the part of the prompt after the prefix shared with the
+    previous request to the same model has to be processed.
+    """
+
+    def __init__(self, reply="Hello there, traveler.", first_token_latency=0.0, tokens_per_second=0.0,
+                 fail_first=0, fail_status=503, host="127.0.0.1", port=0, prefill_tokens_per_second=0.0):
+        self.reply = reply
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.cached_prompts = {}  # Model -> prompt text of its last request
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.server = BackloggedHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FakeOllamaServer':
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-ollama", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reply_for(self, request):
+        """Text to answer a chat request with; a callable reply gets the request body"""
+        return self.reply(request) if callable(self.reply) else self.reply
+
+    def prefill_delay(self, request):
+        """Seconds spent processing the prompt tokens not covered by the cached prefix"""
+        if not self.prefill_tokens_per_second:
+            return 0.0
+        prompt = "".join(f"<{m.get('role')}>{m.get('content', '')}" for m in request.get("messages", []))
+        with self.lock:
+            cached = self.cached_prompts.get(request.get("model"), "")
+            self.cached_prompts[request.get("model")] = prompt
+        shared = len(os.path.commonprefix([prompt, cached]))
+        return (len(prompt) - shared) / 4 / self.prefill_tokens_per_second
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if self.path != "/api/chat":
+                    self.send_error(404)
+                    return
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with fake.lock:
+                    fake.requests.append(body)
+                    fake.connections.add(self.client_address)
+                    failing = fake.fail_first > 0
+                    if failing:
+                        fake.fail_first -= 1
+                    fake.active += 1
+                    fake.max_active = max(fake.max_active, fake.active)
+                try:
+                    if failing:
+                        self._send_json(fake.fail_status, {"error": "model is busy"})
+                    elif body.get("stream", True):
+                        self._stream(body)
+                    else:
+                        self._respond(body)
+                finally:
+                    with fake.lock:
+                        fake.active -= 1
+
+            def _send_json(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _tokens(self, body):
+                text = fake.reply_for(body)
+                words = text.split(" ")
+                return [word + (" " if i < len(words) - 1 else "") for i, word in enumerate(words)]
+
+            def _pace(self):
+                if fake.tokens_per_second:
+                    time.sleep(1.0 / fake.tokens_per_second)
+
+            def _final(self, body, tokens, started):
+                elapsed = time.perf_counter() - started
+                return {
+                    "model": body.get("model"),
+                    "done": True,
+                    "prompt_eval_count": sum(len(m.get("content", "")) // 4 for m in body.get("messages", [])),
+                    "eval_count": len(tokens),
+                    "eval_duration": int(elapsed * 1e9),
+                    "total_duration": int(elapsed * 1e9)
+                }
+
+            def _respond(self, body):
+                started = time.perf_counter()
+                time.sleep(fake.first_token_latency + fake.prefill_delay(body))
+                tokens = self._tokens(body)
+                for _ in tokens:
+                    self._pace()
+                payload = self._final(body, tokens, started)
+                payload["message"] = {"role": "assistant", "content": "".join(tokens)}
+                self._send_json(200, payload)
+
+            def _stream(self, body):
+                started = time.perf_counter()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(fake.first_token_latency + fake.prefill_delay(body))
+                tokens = self._tokens(body)
+                for i, token in enumerate(tokens):
+                    if i:
+                        self._pace()
+                    self._write_chunk({"model": body.get("model"), "done": False,
+                                       "message": {"role": "assistant", "content": token}})
+                final = self._final(body, tokens, started)
+                final["message"] = {"role": "assistant", "content": ""}
+                self._write_chunk(final)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write_chunk(self, payload):
+                data = json.dumps(payload).encode("utf-8") + b"\n"
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a fake Ollama server")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=30.0)
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=0.0,
+                        help="Simulated prompt processing speed; 0 disables it")
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(first_token_latency=args.latency, tokens_per_second=args.tokens_per_second, port=args.port,
+                              prefill_tokens_per_second=args.prefill_tokens_per_second)
+    print(f"Fake Ollama listening on {server.url}")
+    server.server.serve_forever()
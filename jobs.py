@@ -0,0 +1,232 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import get_scheduler
+from state_store import open_shared_store
+
+
+class Job:
+    """One asynchronous piece of work and, once it finishes, its result"""
+    QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+    FINAL = (SUCCEEDED, FAILED, CANCELLED)
+
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = self.QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = threading.Event()
+        self.handle = None  # Scheduler ticket or executor future, used for cancellation
+        self.revision = 0  # Of the published record; bumped when the job starts
+
+    @property
+    def done(self) -> bool:
+        return self.finished.is_set()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+    @staticmethod
+    def from_dict(data) -> 'Job':
+        """A read-only copy of a job that runs in another worker process"""
+        job = Job(data["kind"])
+        for name in ("id", "status", "result", "error", "created_at", "started_at", "finished_at"):
+            setattr(job, name, data.get(name))
+        job.revision = data.get("revision", 0)
+        if job.status in Job.FINAL:
+            job.finished.set()
+        return job
+
+
+class JobManager:
+    """
+    Runs slow generations in the background so request threads can return at once.
+    Jobs tied to a narrator go through the narrator scheduler and keep their place
+    among that story's turns; other jobs run on a small thread pool. Finished jobs
+    are kept for ttl seconds so clients can collect the result, and at most
+    max_jobs are held, dropping the oldest finished ones first.
+    With a shared store every job's status is published there too, so any worker
+    process can answer for a job another one runs.
+    """
+    POLL_INTERVAL = 0.25  # Seconds between store reads while waiting on another worker's job
+
+    def __init__(self, workers=None, ttl=None, max_jobs=1000, scheduler=None, store=None):
+        self.workers = workers or int(os.environ.get("TALKBOT_JOB_WORKERS", 4))
+        self.ttl = ttl if ttl is not None else float(os.environ.get("TALKBOT_JOB_TTL", 600))
+        self.max_jobs = max_jobs
+        self.scheduler = scheduler or get_scheduler()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()  # Job id -> Job, oldest first
+        self.store = store
+
+    def submit(self, kind, fn, *args, key=None, **kwargs) -> Job:
+        """
+        Run fn(*args, **kwargs) as a job and return it immediately
+        With a key (a narrator id) the job is queued behind that narrator's other requests
+        """
+        job = Job(kind)
+        with self.lock:
+            self._sweep()
+            self.jobs[job.id] = job
+        self._publish(job)
+
+        def run():
+            with self.lock:
+                if job.status == Job.CANCELLED:
+                    return
+            if not self._start(job):
+                self._finish(job, Job.CANCELLED)
+                return
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                print(f"Error in {kind} job {job.id}: {e}")
+                self._finish(job, Job.FAILED, error=str(e))
+            else:
+                self._finish(job, Job.SUCCEEDED, result=result)
+
+        try:
+            job.handle = self.scheduler.submit(key, run) if key is not None else self.executor.submit(run)
+        except Exception:
+            with self.lock:
+                self.jobs.pop(job.id, None)
+            self._unpublish(job.id)
+            raise
+        return job
+
+    def get(self, job_id) -> Job:
+        with self.lock:
+            self._sweep()
+            job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            record = self.store.get("jobs", job_id)
+            if record is not None:
+                return Job.from_dict(record)
+        return job
+
+    def wait(self, job_id, timeout=None) -> Job:
+        """Long-poll: return the job once it has finished or the timeout expires"""
+        job = self.get(job_id)
+        if job is None or job.id in self.jobs:
+            if job is not None:
+                job.finished.wait(timeout)
+            return job
+        # Another worker runs it; watch its published status
+        deadline = time.monotonic() + (timeout or 0)
+        while not job.done and time.monotonic() < deadline:
+            time.sleep(min(self.POLL_INTERVAL, max(0, deadline - time.monotonic())))
+            job = self.get(job_id) or job
+        return job
+
+    def cancel(self, job_id) -> bool:
+        """Cancel a job that hasn't started yet, in this worker or another one"""
+        job = self.get(job_id)
+        if job is None:
+            return False
+        if job.id not in self.jobs:
+            # Another worker runs it: cancel its published record, which that worker
+            # checks before starting the job
+            if job.status != Job.QUEUED:
+                return False
+            record = dict(job.to_dict(), status=Job.CANCELLED, finished_at=time.time())
+            return self.store.put_versioned("jobs", job.id, record, job.revision) is not None
+        if job.handle is None or not job.handle.cancel():
+            return False
+        self._finish(job, Job.CANCELLED)
+        return True
+
+    def stats(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {"jobs": len(self.jobs), "by_status": counts, "ttl_seconds": self.ttl}
+
+    def _finish(self, job, status, result=None, error=None) -> None:
+        with self.lock:
+            if job.done:
+                return
+            job.status = status
+            job.result = result
+            job.error = error
+            job.finished_at = time.time()
+            job.finished.set()
+        self._publish(job)
+
+    def _start(self, job) -> bool:
+        """
+        Mark a queued job running; False if another worker cancelled it first
+        Starting and cancelling both compare-and-set the published record, so
+        exactly one of them wins
+        """
+        started_at = time.time()
+        if self.store is not None:
+            record = dict(job.to_dict(), status=Job.RUNNING, started_at=started_at)
+            try:
+                revision = self.store.put_versioned("jobs", job.id, record, job.revision)
+            except Exception as e:
+                print(f"Error publishing job {job.id}: {e}")
+            else:
+                if revision is None:
+                    return False
+                job.revision = revision
+        with self.lock:
+            job.status = Job.RUNNING
+            job.started_at = started_at
+        return True
+
+    def _publish(self, job) -> None:
+        if self.store is None:
+            return
+        try:
+            self.store.put("jobs", job.id, dict(job.to_dict(), revision=job.revision))
+        except Exception as e:
+            print(f"Error publishing job {job.id}: {e}")
+
+    def _unpublish(self, job_id) -> None:
+        if self.store is not None:
+            try:
+                self.store.delete("jobs", job_id)
+            except Exception as e:
+                print(f"Error removing job {job_id}: {e}")
+
+    def _sweep(self) -> None:
+        """Forget expired results; called with the lock held"""
+        now = time.time()
+        expired = [i for i, j in self.jobs.items() if j.done and now - j.finished_at > self.ttl]
+        if len(self.jobs) - len(expired) > self.max_jobs:
+            finished = [i for i, j in self.jobs.items() if j.done and i not in expired]
+            expired += finished[:len(self.jobs) - len(expired) - self.max_jobs]
+        for job_id in expired:
+            del self.jobs[job_id]
+            self._unpublish(job_id)
+
+
+_default_jobs = None
+_default_jobs_lock = threading.Lock()
+
+
+def get_jobs() -> JobManager:
+    """Return the process-wide job manager, creating it on first use"""
+    global _default_jobs
+    with _default_jobs_lock:
+        if _default_jobs is None:
+            _default_jobs = JobManager(store=open_shared_store("jobs"))
+        return _default_jobs
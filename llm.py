@@ -0,0 +1,335 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+
+import httpx
+import ollama
+
+from metrics import get_metrics, span
+
+
+class ModelLimiter:
+    """
+    Counting semaphore shared by threads and event loops.
+    Waiters are served in FIFO order whichever API they came from, so sync and
+    async callers draw from the same per-model concurrency budget.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.lock = threading.Lock()
+        self.waiters = deque()  # threading.Event or (loop, asyncio.Future)
+
+    def acquire(self, timeout=None) -> bool:
+        with self.lock:
+            if self.active < self.limit and not self.waiters:
+                self.active += 1
+                return True
+            event = threading.Event()
+            self.waiters.append(event)
+        if event.wait(timeout):
+            return True
+        with self.lock:
+            if event in self.waiters:
+                self.waiters.remove(event)
+                return False
+        # The slot was handed over just as we timed out
+        return True
+
+    async def acquire_async(self, timeout=None) -> bool:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.active < self.limit and not self.waiters:
+                self.active += 1
+                return True
+            future = loop.create_future()
+            waiter = (loop, future)
+            self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                    granted = False
+                else:
+                    granted = True
+            if granted:
+                # The slot was handed over just as we gave up; pass it on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while True:
+            with self.lock:
+                if not self.waiters:
+                    self.active -= 1
+                    return
+                waiter = self.waiters.popleft()
+            # The slot passes straight to the next waiter, so active stays unchanged
+            if isinstance(waiter, threading.Event):
+                waiter.set()
+                return
+            loop, future = waiter
+            try:
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+                return
+            except RuntimeError:
+                continue  # Its event loop has closed, so nobody is waiting there
+
+
+class LLMGateway:
+    """
+    Single entry point for every model call.
+    Keeps pooled keep-alive HTTP connections to the Ollama server, bounds the number of
+    in-flight generations per model, applies request timeouts and retries transient
+    failures with exponential backoff. Offers the same call as chat() and achat().
+    keep_alive (per model via model_keep_alive) controls how long the server keeps a
+    model and its prompt cache loaded after a request. context_window, a function of
+    the model, sets num_ctx on every request, so the server runs each model with the
+    window its prompts are budgeted for, and all callers agree on it (a different
+    num_ctx makes the server reload the model).
+    """
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, host=None, timeout=120.0, connect_timeout=5.0, max_concurrency=2,
+                 model_concurrency=None, max_connections=32, retries=2, backoff=0.5, queue_timeout=None,
+                 keep_alive=None, model_keep_alive=None, context_window=None):
+        self.host = host or os.environ.get("OLLAMA_HOST")
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                   keepalive_expiry=60.0)
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = dict(model_concurrency or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.queue_timeout = queue_timeout
+        self.keep_alive = keep_alive  # None leaves the server's default
+        self.model_keep_alive = dict(model_keep_alive or {})
+        self.context_window = context_window  # None leaves the server's default num_ctx
+        self.lock = threading.Lock()
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncClient
+        self._limiters = {}
+
+    @property
+    def client(self) -> ollama.Client:
+        with self.lock:
+            if self._client is None:
+                self._client = ollama.Client(host=self.host, timeout=self.timeout, limits=self.limits)
+            return self._client
+
+    def async_client(self) -> ollama.AsyncClient:
+        """Return the AsyncClient for the running event loop; httpx async pools can't be shared across loops"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = ollama.AsyncClient(host=self.host, timeout=self.timeout, limits=self.limits)
+                self._async_clients[loop] = client
+            return client
+
+    def limiter(self, model) -> ModelLimiter:
+        with self.lock:
+            limiter = self._limiters.get(model)
+            if limiter is None:
+                limiter = ModelLimiter(self.model_concurrency.get(model, self.max_concurrency))
+                self._limiters[model] = limiter
+            return limiter
+
+    def keep_alive_for(self, model):
+        return self.model_keep_alive.get(model, self.keep_alive)
+
+    def options_for(self, model, options):
+        options = dict(options or {})
+        if self.context_window is not None and "num_ctx" not in options:
+            options["num_ctx"] = self.context_window(model)
+        return options
+
+    def chat(self, model, messages, options=None, stream=False, keep_alive=None):
+        """Blocking chat call; returns the response dict, or an iterator of chunks when stream=True"""
+        keep_alive = keep_alive if keep_alive is not None else self.keep_alive_for(model)
+        request = dict(model=model, messages=messages, options=self.options_for(model, options), keep_alive=keep_alive)
+        if stream:
+            return self._stream(request)
+
+        limiter = self._acquire(model)
+        try:
+            with span("generate", model=model):
+                response = self._with_retries(lambda: self.client.chat(**request))
+            get_metrics().observe_generation(model, response)
+            return response
+        finally:
+            limiter.release()
+
+    async def achat(self, model, messages, options=None, stream=False, keep_alive=None):
+        """Async chat call; returns the response dict, or an async iterator of chunks when stream=True"""
+        keep_alive = keep_alive if keep_alive is not None else self.keep_alive_for(model)
+        request = dict(model=model, messages=messages, options=self.options_for(model, options), keep_alive=keep_alive)
+        if stream:
+            return self._astream(request)
+
+        limiter = await self._acquire_async(model)
+        try:
+            with span("generate", model=model):
+                response = await self._with_retries_async(lambda: self.async_client().chat(**request))
+            get_metrics().observe_generation(model, response)
+            return response
+        finally:
+            limiter.release()
+
+    def close(self) -> None:
+        with self.lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client._client.close()
+
+    def _stream(self, request):
+        limiter = self._acquire(request["model"])
+        final = None
+        try:
+            with span("generate", model=request["model"]):
+                # Only the request itself is retried; once tokens flow a failure is passed on
+                chunks = self._with_retries(lambda: self._first_chunk(self.client.chat(stream=True, **request)))
+                for chunk in chunks:
+                    if chunk.get("done"):
+                        final = chunk
+                    yield chunk
+            get_metrics().observe_generation(request["model"], final)
+        finally:
+            limiter.release()
+
+    async def _astream(self, request):
+        limiter = await self._acquire_async(request["model"])
+        final = None
+        started = time.perf_counter()
+        try:
+            async def open_stream():
+                stream = await self.async_client().chat(stream=True, **request)
+                try:
+                    return await stream.__anext__(), stream
+                except StopAsyncIteration:
+                    return None, None
+
+            first, stream = await self._with_retries_async(open_stream)
+            if stream is None:
+                return
+            yield first
+            async for chunk in stream:
+                if chunk.get("done"):
+                    final = chunk
+                yield chunk
+            metrics = get_metrics()
+            if metrics.enabled:
+                # A span can't be held open across awaits that other tasks interleave with
+                metrics.stage_seconds.observe(time.perf_counter() - started, "generate", "", "", request["model"])
+                metrics.observe_generation(request["model"], final)
+        finally:
+            limiter.release()
+
+    @staticmethod
+    def _first_chunk(stream):
+        """Pull the first chunk eagerly so connection errors surface inside the retry loop"""
+        try:
+            first = next(stream)
+        except StopIteration:
+            return iter(())
+
+        def chain():
+            yield first
+            yield from stream
+        return chain()
+
+    def _acquire(self, model) -> ModelLimiter:
+        limiter = self.limiter(model)
+        if not limiter.acquire(self.queue_timeout):
+            raise TimeoutError(f"Timed out waiting for a free slot on model '{model}'")
+        return limiter
+
+    async def _acquire_async(self, model) -> ModelLimiter:
+        limiter = self.limiter(model)
+        try:
+            await limiter.acquire_async(self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out waiting for a free slot on model '{model}'") from None
+        return limiter
+
+    def _should_retry(self, error) -> bool:
+        if isinstance(error, httpx.TransportError):
+            return True
+        return isinstance(error, ollama.ResponseError) and error.status_code in self.RETRY_STATUS_CODES
+
+    def _retry_delay(self, attempt) -> float:
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def _with_retries(self, call):
+        for attempt in range(self.retries + 1):
+            try:
+                return call()
+            except Exception as e:
+                if attempt >= self.retries or not self._should_retry(e):
+                    raise
+                time.sleep(self._retry_delay(attempt))
+
+    async def _with_retries_async(self, call):
+        for attempt in range(self.retries + 1):
+            try:
+                return await call()
+            except Exception as e:
+                if attempt >= self.retries or not self._should_retry(e):
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt))
+
+
+_default_gateway = None
+_default_gateway_lock = threading.Lock()
+
+
+def parse_model_settings(value):
+    """Parse "model=value,other=value" from the environment into a dict"""
+    settings = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            model, setting = item.split("=", 1)
+            settings[model.strip()] = setting.strip()
+    return settings
+
+
+def get_gateway() -> LLMGateway:
+    """Return the process-wide gateway, configured from the environment on first use"""
+    global _default_gateway
+    with _default_gateway_lock:
+        if _default_gateway is None:
+            from context_builder import context_tokens  # context_builder imports this module
+            _default_gateway = LLMGateway(
+                timeout=float(os.environ.get("TALKBOT_LLM_TIMEOUT", 120)),
+                max_concurrency=int(os.environ.get("TALKBOT_LLM_CONCURRENCY", 2)),
+                retries=int(os.environ.get("TALKBOT_LLM_RETRIES", 2)),
+                keep_alive=os.environ.get("TALKBOT_KEEP_ALIVE"),
+                model_keep_alive=parse_model_settings(os.environ.get("TALKBOT_MODEL_KEEP_ALIVE")),
+                context_window=context_tokens
+            )
+        return _default_gateway
+
+
+def set_gateway(gateway: LLMGateway) -> None:
+    """Replace the process-wide gateway (e.g. to point at a different server)"""
+    global _default_gateway
+    with _default_gateway_lock:
+        _default_gateway = gateway
+
+
+def chat(model, messages, options=None, stream=False, keep_alive=None):
+    """Drop-in replacement for ollama.chat that goes through the shared gateway"""
+    return get_gateway().chat(model, messages, options=options, stream=stream, keep_alive=keep_alive)
+
+
+async def achat(model, messages, options=None, stream=False, keep_alive=None):
+    """Async counterpart of chat()"""
+    return await get_gateway().achat(model, messages, options=options, stream=stream, keep_alive=keep_alive)
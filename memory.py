@@ -1,38 +1,503 @@
+import atexit
 import chromadb
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from embeddings import create_embedder
+from state_store import open_shared_store
+
+class MemoryEntry:
+    """One message in short-term memory"""
+    __slots__ = ("message", "time_delta", "day", "time_of_day")
+
+    def __init__(self, message, time_delta, day, time_of_day):
+        self.message = message
+        self.time_delta = time_delta
+        self.day = day
+        self.time_of_day = time_of_day
+
+    def __getitem__(self, key):
+        # Entries used to be dicts; keep item access working for existing callers
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {"message": self.message, "time_delta": self.time_delta, "day": self.day, "time_of_day": self.time_of_day}
 
 class ShortTermMemory:
-    def __init__(self, max_length=20):
+    """
+    The latest messages of a conversation in a fixed-size ring buffer.
+    Adding past max_length overwrites the oldest entry in place, and reads walk the
+    buffer without copying it. With a spill_path every change is also appended to
+    a small JSON-lines log, so the window survives a restart; the log is rewritten
+    to just the current window whenever it grows past a few windows' worth.
+    """
+
+    def __init__(self, max_length=20, spill_path=None):
         self.max_length = max_length
-        self.entries = []
+        self._buffer = [None] * max_length
+        self._start = 0  # Index of the oldest entry
+        self._size = 0
+        self.total_added = 0  # Entries ever added, so window positions survive trimming
+        self.spill_path = spill_path
+        self._spilled_lines = 0
+        if spill_path:
+            self._load()
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """Entries from oldest to newest"""
+        return self.iter_recent(self._size)
+
+    def iter_recent(self, n):
+        """The last n entries, oldest first, without building a list"""
+        buffer, capacity = self._buffer, self.max_length
+        for i in range(self._size - min(n, self._size), self._size):
+            yield buffer[(self._start + i) % capacity]
+
+    @property
+    def entries(self):
+        return list(self)
 
     def add(self, message, time_delta, day, time_of_day):
-        self.entries.append({
-            "message": message,
-            "time_delta": time_delta,
-            "day": day,
-            "time_of_day": time_of_day
-        })
-        if len(self.entries) > self.max_length:
-            self.entries.pop(0)
+        entry = MemoryEntry(message, time_delta, day, time_of_day)
+        self._append(entry)
+        if self.spill_path:
+            self._spill(json.dumps(entry.to_dict(), ensure_ascii=False))
 
     def get_recent(self, n=8):
-        return [item["message"] for item in self.entries[-n:]]
+        return [entry.message for entry in self.iter_recent(n)]
+
+    def get_window(self, n=8, step=8):
+        """
+        At least the last n messages, with the window's start moving forward step
+        messages at a time rather than on every message, so the oldest lines in a
+        prompt stay the same for several turns and its prefix can be reused
+        """
+        first = self.total_added - self._size
+        start = max(first, (max(0, self.total_added - n) // step) * step)
+        return self.get_recent(self.total_added - start)
+
+    def to_dict(self):
+        return {"total_added": self.total_added, "entries": [entry.to_dict() for entry in self]}
+
+    def restore(self, data):
+        """Replace the window with one saved by to_dict"""
+        self._buffer = [None] * self.max_length
+        self._start = self._size = 0
+        for entry in data.get("entries", []):
+            self._append(MemoryEntry(entry["message"], entry["time_delta"], entry["day"], entry["time_of_day"]))
+        self.total_added = data.get("total_added", self._size)
+        if self.spill_path:
+            self._rewrite_spill()
+
+    def clear(self):
+        self._buffer = [None] * self.max_length
+        self._start = 0
+        self._size = 0
+        if self.spill_path:
+            self._spill(json.dumps({"clear": True}))
+
+    def _append(self, entry):
+        if self._size < self.max_length:
+            self._buffer[(self._start + self._size) % self.max_length] = entry
+            self._size += 1
+        else:
+            self._buffer[self._start] = entry
+            self._start = (self._start + 1) % self.max_length
+        self.total_added += 1
+
+    def _spill(self, line):
+        """Append one record to the spill log, compacting it once it has grown"""
+        try:
+            if self._spilled_lines >= self.max_length * 4:
+                self._rewrite_spill()
+                return
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self._spilled_lines += 1
+        except OSError as e:
+            print(f"Error writing short-term memory to {self.spill_path}: {e}")
+
+    def _rewrite_spill(self):
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        tmp_path = self.spill_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            # Position of the first entry below, so window alignment carries over
+            f.write(json.dumps({"total_added": self.total_added - self._size}) + "\n")
+            for entry in self:
+                f.write(json.dumps(entry.to_dict(), ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.spill_path)
+        self._spilled_lines = self._size + 1
+
+    def _load(self):
+        """Rebuild the window from the spill log"""
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        if not os.path.exists(self.spill_path):
+            return
+        torn = False
+        with open(self.spill_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    torn = True  # Torn write from a crash
+                    break
+                self._spilled_lines += 1
+                if "total_added" in record:
+                    self.total_added = record["total_added"]
+                    self._start = self._size = 0
+                elif record.get("clear"):
+                    self._start = self._size = 0
+                else:
+                    self._append(MemoryEntry(record["message"], record["time_delta"], record["day"], record["time_of_day"]))
+        if torn:
+            self._rewrite_spill()
+
+def normalize_text(text):
+    """Canonical form of a prompt for cache keys: lowercase with collapsed whitespace"""
+    return " ".join(text.lower().split())
+
+class EmbeddingCache:
+    """
+    Bounded LRU of text embeddings keyed by normalized text.
+    Shared by every character, so short repeated messages like "hi" or "continue"
+    are only embedded once.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # normalized text -> embedding
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text, embed):
+        """Return the embedding of text, calling embed([text]) only on a miss"""
+        key = normalize_text(text)
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+            self.misses += 1
+        embedding = list(embed([key])[0])
+        with self.lock:
+            self.entries[key] = embedding
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return embedding
 
     def clear(self):
-        self.entries.clear()
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+class ChromaStore:
+    """
+    A single Chroma client shared by every character's long-term memory.
+    Each character gets its own collection inside one database; collection handles
+    are opened lazily on first use and closed again once they sit idle.
+    Query embeddings are cached across characters, and every write bumps the
+    collection's version so cached query results can be invalidated. With a
+    version_store (a shared state store) the versions live there instead, so a
+    write by any worker process invalidates every worker's cached results.
+    """
+    NAME_PATTERN = re.compile(r"[^a-zA-Z0-9_-]")
+
+    def __init__(self, db_path="memories_chroma", max_open_collections=64, idle_timeout=600, embedding_function=None,
+                 embedding_cache_size=1024, version_store=None):
+        self.db_path = db_path
+        self.embedding_function = embedding_function  # None uses Chroma's default model
+        self.embedding_cache = EmbeddingCache(embedding_cache_size)
+        self.max_open_collections = max_open_collections
+        self.idle_timeout = idle_timeout
+        self.lock = threading.RLock()
+        self._client = None
+        self._collections = OrderedDict()  # collection name -> (collection, last used)
+        self._last_sweep = time.monotonic()
+        self._versions = {}  # collection name -> number of writes seen
+        self.version_store = version_store
+
+    @property
+    def client(self):
+        with self.lock:
+            if self._client is None:
+                self._client = chromadb.PersistentClient(path=self.db_path)
+            return self._client
+
+    @property
+    def embedder(self):
+        """The embedding function for documents and queries"""
+        with self.lock:
+            if self.embedding_function is None:
+                self.embedding_function = create_embedder("default")
+            return self.embedding_function
+
+    def embed_query(self, text):
+        return self.embedding_cache.get(text, self.embedder)
+
+    def version(self, key):
+        if self.version_store is not None:
+            return self.version_store.get("versions", self.collection_name(key))
+        with self.lock:
+            return self._versions.get(self.collection_name(key), 0)
+
+    def mark_written(self, key):
+        """Record a write to a character's collection, invalidating its cached query results"""
+        name = self.collection_name(key)
+        if self.version_store is not None:
+            self.version_store.put("versions", name, uuid.uuid4().hex)  # A fresh token no worker has cached
+            return
+        with self.lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    @classmethod
+    def collection_name(cls, key):
+        """Map a character key onto a valid Chroma collection name"""
+        name = cls.NAME_PATTERN.sub("_", key).strip("_-") or "memories"
+        if name != key or not 3 <= len(name) <= 63:
+            # Keep names unique when sanitizing or truncating changed them
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:8]
+            name = f"{name[:50]}_{digest}"
+        return name
+
+    def get_collection(self, key):
+        """Return the collection for a character key, opening it if needed"""
+        name = self.collection_name(key)
+        now = time.monotonic()
+        with self.lock:
+            entry = self._collections.pop(name, None)
+            collection = entry[0] if entry else self._open_collection(name)
+            self._collections[name] = (collection, now)
+            if now - self._last_sweep > self.idle_timeout:
+                self.evict_idle()
+            while len(self._collections) > self.max_open_collections:
+                self._collections.popitem(last=False)
+            return collection
+
+    def _open_collection(self, name):
+        return self.client.get_or_create_collection(name=name, embedding_function=self.embedder)
+
+    def evict_idle(self, idle_timeout=None):
+        """Drop collection handles that haven't been used recently; returns how many were dropped"""
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.monotonic()
+        with self.lock:
+            self._last_sweep = now
+            idle = [name for name, (_, last_used) in self._collections.items() if now - last_used >= idle_timeout]
+            for name in idle:
+                del self._collections[name]
+            return len(idle)
+
+    def open_collections(self):
+        with self.lock:
+            return list(self._collections.keys())
+
+
+_stores = {}  # Embedder name -> ChromaStore
+_stores_lock = threading.Lock()
+
+def get_store(embedding_function=None):
+    """
+    Return the process-wide Chroma store for an embedder, creating it on first use
+    Without an embedder the one named by TALKBOT_EMBEDDER is used. Vectors from
+    different embedders can't be mixed, so each one gets its own database.
+    """
+    with _stores_lock:
+        name = embedding_function.name if embedding_function else os.environ.get("TALKBOT_EMBEDDER", "default")
+        if name not in _stores:
+            db_path = "memories_chroma" if name == "default" else f"memories_chroma_{name}"
+            _stores[name] = ChromaStore(db_path=db_path, embedding_function=embedding_function or create_embedder(name),
+                                        version_store=open_shared_store(f"memories_{name}"))
+        return _stores[name]
+
 
 class LongTermMemory:
-    def __init__(self, db_path, collection_name="memories"):
-        self.chroma_client = chromadb.PersistentClient(path=db_path)
-        self.collection = self.chroma_client.get_or_create_collection(name=collection_name)
+    """
+    A character's long-term memories in the shared Chroma store.
+    New memories get unique, time-ordered IDs and are buffered so several can be
+    written with one upsert; queries flush the buffer first so reads see every write.
+    Query results are cached until the collection is written to again.
+    Memories in a character's database from before the shared store (<key>_chroma)
+    are imported into its collection the first time the collection is used.
+    """
+    LEGACY_COLLECTION = "memories"  # Collection name in the old per-character databases
+    _id_lock = threading.Lock()
+    _last_id_time = 0
 
-    def add(self, memory_id, summary, day, time_of_day):
-        self.collection.add(
-            ids=[memory_id],
-            metadatas=[{"day": day, "time_of_day": time_of_day}],
-            documents=[summary]
-        )
+    def __init__(self, key, store=None, batch_size=16, result_cache_size=128, embedding_function=None):
+        self.key = key
+        self.store = store or get_store(embedding_function)
+        self.batch_size = batch_size
+        self.result_cache_size = result_cache_size
+        self.lock = threading.Lock()
+        self.pending = []  # (id, document, metadata) waiting to be written
+        self.results = OrderedDict()  # (normalized prompt, n_results) -> (collection version, documents)
+        self.hits = 0
+        self.misses = 0
+        self._legacy_checked = False
+        _buffered_memories.add(self)
+
+    @property
+    def collection(self):
+        if not self._legacy_checked:
+            self._legacy_checked = True
+            self.import_legacy()
+        return self.store.get_collection(self.key)
+
+    def import_legacy(self, legacy_path=None):
+        """
+        Import the memories of this character's database from before the shared store,
+        if there is one and the character's collection is still empty
+        Returns the number of memories imported
+        """
+        # Absolute, since Chroma reuses clients by path and relative ones depend on the directory
+        legacy_path = os.path.abspath(legacy_path or f"{self.key}_chroma")
+        if not os.path.isdir(legacy_path) or legacy_path == os.path.abspath(self.store.db_path):
+            return 0
+        try:
+            if self.store.get_collection(self.key).count() > 0:
+                return 0
+            legacy = chromadb.PersistentClient(path=legacy_path).get_collection(self.LEGACY_COLLECTION)
+            records = legacy.get(include=["documents", "metadatas"])
+            memories = [
+                dict(metadata or {}, id=memory_id, document=document)
+                for memory_id, document, metadata in zip(records["ids"], records["documents"], records["metadatas"])
+            ]
+            count = self.bulk_import(memories)
+            print(f"Imported {count} memories for {self.key} from {legacy_path}")
+            return count
+        except Exception as e:
+            print(f"Warning: the memories in {legacy_path} could not be imported for {self.key} "
+                  f"and won't be recalled: {e}")
+            return 0
+
+    @classmethod
+    def new_memory_id(cls):
+        """Return an ID that sorts after every ID handed out before it"""
+        with cls._id_lock:
+            # Strictly increasing even if the clock stalls or steps back
+            cls._last_id_time = max(time.time_ns(), cls._last_id_time + 1)
+            timestamp = cls._last_id_time
+        # The random suffix keeps IDs unique across processes
+        return f"mem_{timestamp:020d}_{uuid.uuid4().hex[:8]}"
+
+    def add(self, summary, day, time_of_day, memory_id=None):
+        """Buffer a memory for writing; returns its ID"""
+        memory_id = memory_id or self.new_memory_id()
+        with self.lock:
+            self.pending.append((memory_id, summary, {"day": day, "time_of_day": time_of_day}))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+        return memory_id
+
+    def flush(self):
+        """
+        Write all buffered memories in a single upsert
+        A failed batch goes back to the front of the buffer and is written again on
+        the next flush, so no memory is lost to a transient store error
+        """
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            try:
+                self._upsert(batch)
+            except Exception as e:
+                print(f"Error writing {len(batch)} memories for {self.key}, will retry: {e}")
+                with self.lock:
+                    self.pending[:0] = batch
+                raise
+        return len(batch)
+
+    def bulk_import(self, memories, batch_size=256):
+        """
+        Import historical memories, e.g. when migrating a character
+        Each memory is a dict with "summary" (or "document"), "day", "time_of_day" and
+        optionally "id"; they are embedded and written batch_size at a time
+        Returns the number of memories imported
+        """
+        self.flush()
+        batch = []
+        count = 0
+        for memory in memories:
+            batch.append((
+                memory.get("id") or self.new_memory_id(),
+                memory.get("summary") or memory["document"],
+                {"day": memory.get("day", 1), "time_of_day": memory.get("time_of_day", "morning")}
+            ))
+            if len(batch) >= batch_size:
+                self._upsert(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self._upsert(batch)
+            count += len(batch)
+        return count
 
     def query(self, prompt, n_results=2):
-        results = self.collection.query(query_texts=[prompt], n_results=n_results)
-        return results.get("documents", [])
+        try:
+            self.flush()
+        except Exception as e:
+            # The batch stays buffered for the next flush; a recall never fails on a write
+            print(f"Warning: recalling for {self.key} without its unwritten memories: {e}")
+        key = (normalize_text(prompt), n_results)
+        version = self.store.version(self.key)
+        with self.lock:
+            cached = self.results.get(key)
+            if cached and cached[0] == version:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return list(cached[1])
+            self.misses += 1
+
+        embedding = self.store.embed_query(prompt)
+        results = self.collection.query(query_embeddings=[embedding], n_results=n_results)
+        documents = (results.get("documents") or [[]])[0]
+        if None in documents:
+            # A read racing a write can find a record before its document; skip it, uncached
+            return [document for document in documents if document is not None]
+
+        with self.lock:
+            self.results[key] = (version, documents)
+            self.results.move_to_end(key)
+            while len(self.results) > self.result_cache_size:
+                self.results.popitem(last=False)
+        return list(documents)
+
+    def cache_stats(self):
+        with self.lock:
+            return {"size": len(self.results), "hits": self.hits, "misses": self.misses}
+
+    def _upsert(self, batch):
+        ids, documents, metadatas = zip(*batch)
+        # Upsert keeps a batch retried by flush idempotent, even if part of it was written
+        try:
+            self.collection.upsert(ids=list(ids), documents=list(documents), metadatas=list(metadatas))
+        finally:
+            self.store.mark_written(self.key)
+
+
+_buffered_memories = weakref.WeakSet()
+
+@atexit.register
+def flush_all_memories():
+    """Write out memories still buffered when the process exits"""
+    for memory in list(_buffered_memories):
+        try:
+            memory.flush()
+        except Exception as e:
+            print(f"Error flushing memories for {memory.key}: {e}")
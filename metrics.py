@@ -0,0 +1,178 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200)
+TOKEN_COUNT_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+SPAN_LABELS = ("stage", "character", "narrator", "model")
+
+
+class Histogram:
+    """A Prometheus histogram with a fixed set of label names"""
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}  # Label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = ",".join(f'{name}="{escape(value)}"' for name, value in zip(self.label_names, label_values))
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {values[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {values[-1]}")
+        return "\n".join(lines)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Span:
+    """Times one stage of a request and records it when the block exits"""
+    __slots__ = ("registry", "labels", "started")
+
+    def __init__(self, registry, labels):
+        self.registry = registry
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.stage_seconds.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+class NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class MetricsRegistry:
+    """
+    Latency histograms for each stage of a chat turn (routing, memory retrieval,
+    generation, tools, saving) labelled by character, narrator and model, plus
+    request latency and model token rates. Rendered in the Prometheus text format.
+    While disabled, span() hands out a shared no-op and observations return at once.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.context_labels = contextvars.ContextVar("talkbot_span_labels", default=None)  # Per thread and per asyncio task
+        self.stage_seconds = Histogram("talkbot_stage_seconds", "Time spent in each stage of a chat turn",
+                                       SPAN_LABELS)
+        self.request_seconds = Histogram("talkbot_request_seconds", "HTTP request latency",
+                                         ("endpoint", "status"))
+        self.tokens_per_second = Histogram("talkbot_llm_tokens_per_second", "Model generation speed",
+                                           ("model",), TOKEN_RATE_BUCKETS)
+        self.prompt_tokens = Histogram("talkbot_llm_prompt_tokens", "Prompt tokens evaluated per model call",
+                                       ("model",), TOKEN_COUNT_BUCKETS)
+        self.completion_tokens = Histogram("talkbot_llm_completion_tokens", "Tokens generated per model call",
+                                           ("model",), TOKEN_COUNT_BUCKETS)
+        self.histograms = [self.stage_seconds, self.request_seconds, self.tokens_per_second,
+                           self.prompt_tokens, self.completion_tokens]
+
+    def span(self, stage, **labels):
+        """Context manager timing one stage; labels not given come from the enclosing context()"""
+        if not self.enabled:
+            return NOOP_SPAN
+        defaults = self.context_labels.get() or {}
+        return Span(self, (stage,) + tuple(labels.get(name, defaults.get(name, "")) for name in SPAN_LABELS[1:]))
+
+    def context(self, **labels):
+        """Set default span labels (e.g. narrator=...) for the current thread or task within a block"""
+        return LabelContext(self, labels) if self.enabled else NOOP_SPAN
+
+    def observe_request(self, endpoint, status, seconds):
+        if self.enabled:
+            self.request_seconds.observe(seconds, endpoint or "unknown", str(status))
+
+    def observe_generation(self, model, response):
+        """Record prompt size and generation speed from a model call's final response"""
+        if not self.enabled or not response:
+            return
+        prompt_tokens = response.get("prompt_eval_count")
+        eval_count = response.get("eval_count")
+        eval_duration = response.get("eval_duration")
+        if prompt_tokens:
+            self.prompt_tokens.observe(prompt_tokens, model)
+        if eval_count:
+            self.completion_tokens.observe(eval_count, model)
+            if eval_duration:
+                self.tokens_per_second.observe(eval_count / (eval_duration / 1e9), model)
+
+    def render(self):
+        return "\n".join(histogram.render() for histogram in self.histograms) + "\n"
+
+    def reset(self):
+        for histogram in self.histograms:
+            with histogram.lock:
+                histogram.series.clear()
+
+
+class LabelContext:
+    __slots__ = ("registry", "labels", "previous")
+
+    def __init__(self, registry, labels):
+        self.registry = registry
+        self.labels = labels
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = self.registry.context_labels.get()
+        self.registry.context_labels.set(dict(self.previous or {}, **self.labels))
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.context_labels.set(self.previous)
+        return False
+
+
+_default_registry = MetricsRegistry(enabled=os.environ.get("TALKBOT_METRICS", "").lower() in ("1", "true", "yes"))
+
+
+def get_metrics() -> MetricsRegistry:
+    """Return the process-wide metrics registry; TALKBOT_METRICS=1 turns it on"""
+    return _default_registry
+
+
+def span(stage, **labels):
+    """Time a stage with the process-wide registry; see MetricsRegistry.span"""
+    return _default_registry.span(stage, **labels)
@@ -1,13 +1,128 @@
-import random
-import ollama
-import threading
+import asyncio
+import llm
+import os
 import time
+import uuid
 from character import Character
-from typing import List, Dict, Any, Tuple, Optional, Callable
+from executors import locked, run_blocking, submit
+from session import ConversationSession
+from router import RoutingDecision, get_router
+from metrics import span
+from response_cache import get_response_cache
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Tuple, Optional, Callable, Iterator, AsyncIterator
+
+class CharacterRoster(MutableMapping):
+    """
+    Mapping of character names to Character instances for a narrator.
+    When backed by a CharacterPool only the names are held, and characters are
+    resolved through the pool on access so they can be loaded lazily and unloaded
+    again while the story is idle.
+    """
+    def __init__(self, character_pool=None):
+        self.character_pool = character_pool
+        self._characters = {}  # Character name -> Character (None when resolved through the pool)
+
+    def __getitem__(self, name: str) -> Character:
+        character = self._characters[name]
+        if self.character_pool is not None:
+            character = self.character_pool.get_character(name)
+            if character is None:
+                raise KeyError(name)
+        return character
+
+    def __setitem__(self, name: str, character: Character) -> None:
+        self._characters[name] = None if self.character_pool is not None else character
+
+    def __delitem__(self, name: str) -> None:
+        del self._characters[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self._characters
+
+    def __iter__(self):
+        return iter(self._characters)
+
+    def __len__(self) -> int:
+        return len(self._characters)
+
+    def get_record(self, name: str) -> Dict[str, Any]:
+        """Return a character's metadata, without loading it when backed by a pool"""
+        if name not in self._characters:
+            return None
+        if self.character_pool is not None:
+            return self.character_pool.get_record(name)
+        return self._characters[name].to_dict()
+
+
+class ContextPrefetch:
+    """
+    Speculative memory retrieval for the characters likely to answer a message.
+    Started while the LLM is still deciding who responds, so the chosen character's
+    turn begins with its long-term memories already recalled; the lookups for the
+    characters that were not picked are cancelled, or dropped if already running.
+    """
+
+    def __init__(self, narrator: 'Narrator', prompt: str):
+        self.narrator = narrator
+        self.prompt = prompt
+        self.pending = {}  # Character name -> future of its recalled memories
+
+    def start(self, names: List[str]) -> None:
+        for name in names:
+            if name not in self.pending and name in self.narrator.characters:
+                self.pending[name] = submit("memory", self._recall, name)
+
+    def _recall(self, name: str) -> List[str]:
+        character = self.narrator.characters[name]  # Loads it if the pool had unloaded it
+        character.system_prompt()
+        return character.query_long_term_memory(self.prompt)
+
+    def take(self, name: str) -> Optional[List[str]]:
+        """Memories prefetched for the chosen character, or None if it has to query them itself"""
+        future = self._claim(name)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"Error prefetching memories for {name}: {e}")
+            return None
+
+    async def atake(self, name: str) -> Optional[List[str]]:
+        future = self._claim(name)
+        if future is None:
+            return None
+        try:
+            return await asyncio.wrap_future(future)
+        except Exception as e:
+            print(f"Error prefetching memories for {name}: {e}")
+            return None
+
+    def _claim(self, name: str):
+        future = self.pending.pop(name, None)
+        self.discard()
+        return future
+
+    def discard(self) -> None:
+        """Cancel the lookups that haven't started; running ones finish and are ignored"""
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
 
 class Narrator:
-    def __init__(self, model_name="dolphin3"):
-        self.characters = {}  # Dictionary mapping character names to Character instances
+    ROUTING_RECENT_LINES = 4  # How many of a character's recent lines the router compares against
+    ENSEMBLE_CONCURRENCY = int(os.environ.get("TALKBOT_ENSEMBLE_CONCURRENCY", 3))  # Replies generated at once
+    # Likeliest responders whose memories are recalled while the LLM picks one; 0 turns it off
+    PREFETCH_RESPONDERS = int(os.environ.get("TALKBOT_PREFETCH_RESPONDERS", 2))
+    ROUTING_OPTIONS = {"temperature": 0.3, "num_predict": 30}  # Low temperature for more deterministic output
+    DIRECTION_OPTIONS = {"temperature": 0.7, "num_predict": 300}
+    SUGGESTION_OPTIONS = {"temperature": 0.8, "num_predict": 500}
+
+    def __init__(self, model_name="dolphin3", character_pool=None, router=None, response_cache=None):
+        self.characters = CharacterRoster(character_pool)  # Character names -> Character instances
         self.story_state = {
             "plot_points": [],  # Key plot points that have occurred
             "scene": "start",   # Current scene identifier
@@ -20,28 +135,45 @@ class Narrator:
         self.model = model_name  # LLM to use
         self.user_name = "Guest"
         self.user_persona = "A curious visitor to the story."
-        self.is_processing = False  # Flag to prevent multiple simultaneous LLM calls
+        self.sessions = {}  # Character name -> this story's ConversationSession with that character
+        # When set (by NarratorManager, with state shared between workers) the sessions are
+        # kept in this SessionStore under session_id, like /chat conversations
+        self.session_store = None
+        self.session_id = "narrator"
+        self.router = router or get_router()  # Picks responders locally before falling back to the LLM
+        # Replies to routing and direction prompts, which depend only on the story state
+        self.response_cache = response_cache or get_response_cache()
+        self.cache_owner = uuid.uuid4().hex  # Files this story's entries so a state change can drop them
     
     def add_character(self, character: Character) -> None:
         """Add a character to the pool of available characters"""
         self.characters[character.name] = character
         
-        # Sync character time with narrator time
-        character.current_day = self.story_state["day"]
-        character.time_of_day = self.story_state["time_of_day"]
-        
         # If not already present, add to the scene
         if character.name not in self.story_state["characters_present"]:
             self.story_state["characters_present"].append(character.name)
+            self.story_changed()
+    
+    def add_character_name(self, character_name: str) -> None:
+        """Add a character by name without loading it"""
+        self.characters[character_name] = None
+        
+        if character_name not in self.story_state["characters_present"]:
+            self.story_state["characters_present"].append(character_name)
+            self.story_changed()
     
     def remove_character(self, character_name: str) -> None:
         """Remove a character from the narrator's pool"""
         if character_name in self.characters:
             del self.characters[character_name]
+        self.sessions.pop(character_name, None)
+        if self.session_store is not None:
+            self.session_store.remove(self.session_id, character_name)
             
         # Also remove from current scene if present
         if character_name in self.story_state["characters_present"]:
             self.story_state["characters_present"].remove(character_name)
+            self.story_changed()
     
     def set_scene(self, scene_name: str, characters_present: List[str]) -> None:
         """Set the current scene and characters present"""
@@ -49,10 +181,16 @@ class Narrator:
         self.story_state["characters_present"] = [
             char for char in characters_present if char in self.characters
         ]
+        self.story_changed()
     
     def add_plot_point(self, plot_point: str) -> None:
         """Add a significant plot point to the story state"""
         self.story_state["plot_points"].append(plot_point)
+        self.story_changed()
+    
+    def story_changed(self) -> None:
+        """Drop cached replies made for the previous story state"""
+        self.response_cache.invalidate(self.cache_owner)
     
     def advance_time(self) -> None:
         """Advance time for the narrator and all characters"""
@@ -65,53 +203,126 @@ class Narrator:
         else:
             self.story_state["time_of_day"] = valid_times[0]
             self.story_state["day"] += 1
+        self.story_changed()
         
-        # Sync all characters to the new time
-        for character in self.characters.values():
-            character.current_day = self.story_state["day"]
-            character.time_of_day = self.story_state["time_of_day"]
+        # Sync this story's conversations to the new time
+        for session in self.sessions.values():
+            session.current_day = self.story_state["day"]
+            session.time_of_day = self.story_state["time_of_day"]
     
     def set_user_persona(self, name: str, persona: str) -> None:
         """Set the user's persona for all character interactions"""
         self.user_name = name
         self.user_persona = persona
         
-        # Update all characters with this information
-        for character in self.characters.values():
-            character.user_name = name
-            character.user_persona = persona
+        # Update this story's conversations with this information
+        for session in self.sessions.values():
+            session.user_name = name
+            session.user_persona = persona
     
-    def select_responding_character(self, user_message: str) -> Tuple[str, float]:
+    def select_responding_character(self, user_message: str,
+                                    prefetch: ContextPrefetch = None) -> Tuple[str, float]:
         """
         Select which character should respond to the user message
         Returns character name and confidence score
+        A prefetch, if given, starts recalling memories for the likeliest responders
+        while the LLM decides
         """
+        started = time.perf_counter()
+        with span("route"):
+            char_name, confidence, method, scores = self._route(user_message, prefetch)
+        if char_name:
+            self.router.record(RoutingDecision(char_name, confidence, method, scores,
+                                               (time.perf_counter() - started) * 1000))
+        return char_name, confidence
+    
+    async def aselect_responding_character(self, user_message: str,
+                                           prefetch: ContextPrefetch = None) -> Tuple[str, float]:
+        """Async version of select_responding_character; only an unsure router waits on the model"""
+        started = time.perf_counter()
+        with span("route"):
+            char_name, confidence, method, scores = self._route_locally(user_message)
+            if method == "unsure":
+                self._prefetch(prefetch, scores)
+                char_name, confidence, method = await self._aselect_with_llm(user_message, char_name)
+        if char_name:
+            self.router.record(RoutingDecision(char_name, confidence, method, scores,
+                                               (time.perf_counter() - started) * 1000))
+        return char_name, confidence
+    
+    def _route(self, user_message: str, prefetch: ContextPrefetch = None) -> Tuple[str, float, str, Dict[str, float]]:
+        """Pick a responder, returning (name, confidence, method, router scores)"""
+        char_name, confidence, method, scores = self._route_locally(user_message)
+        if method == "unsure":
+            self._prefetch(prefetch, scores)
+            char_name, confidence, method = self._select_with_llm(user_message, char_name)
+        return char_name, confidence, method, scores
+    
+    def _prefetch(self, prefetch: Optional[ContextPrefetch], scores: Dict[str, float]) -> None:
+        """Start recalling memories for the best-scored characters before asking the LLM"""
+        if prefetch is not None and self.PREFETCH_RESPONDERS > 0:
+            prefetch.start(sorted(scores, key=scores.get, reverse=True)[:self.PREFETCH_RESPONDERS])
+    
+    def _route_locally(self, user_message: str) -> Tuple[str, float, str, Dict[str, float]]:
+        """Pick a responder without the LLM; method "unsure" means the router's best guess should be checked with it"""
         # If no characters present, can't select any
         if not self.story_state["characters_present"]:
-            return None, 0.0
+            return None, 0.0, "none", {}
             
         # If only one character, that character responds
         if len(self.story_state["characters_present"]) == 1:
-            return self.story_state["characters_present"][0], 1.0
+            return self.story_state["characters_present"][0], 1.0, "single", {}
             
         # If user addresses a specific character by name
         for char_name in self.story_state["characters_present"]:
             if char_name.lower() in user_message.lower():
-                return char_name, 0.9
+                return char_name, 0.9, "named", {}
         
-        # Without LLM, use a simplified approach if we're waiting for LLM
-        if self.is_processing:
-            # Choose randomly, but avoid the last speaking character if possible
-            available_chars = [c for c in self.story_state["characters_present"] 
-                             if c != self.last_speaking_character or len(self.story_state["characters_present"]) == 1]
-            return random.choice(available_chars), 0.5
-            
-        # Use the LLM to decide which character should respond
+        # Score characters locally and only ask the LLM when the router is unsure
+        scores, confidence = self.router.score(user_message, self._routing_candidates(), self.last_speaking_character)
+        if not scores:
+            return None, 0.0, "none", {}
+        best = max(scores, key=scores.get)
+        if confidence >= self.router.confidence_threshold:
+            return best, confidence, "router", scores
+        return best, confidence, "unsure", scores
+    
+    def _routing_candidates(self) -> Dict[str, Tuple[str, List[str]]]:
+        """Background text and recent lines of every character in the scene"""
+        candidates = {}
+        for char_name in self.story_state["characters_present"]:
+            record = self.characters.get_record(char_name)
+            if not record:
+                continue
+            background = f"{char_name}. {record.get('background', '')} {record.get('intro', '')}"
+            session = self.sessions.get(char_name)
+            entries = session.short_term_memory if session else []
+            recent = [e.message["content"] for e in entries if e.message.get("role") == "assistant"]
+            candidates[char_name] = (background, recent[-self.ROUTING_RECENT_LINES:])
+        return candidates
+    
+    def _select_with_llm(self, user_message: str, fallback: str) -> Tuple[str, float, str]:
+        """Ask the LLM who should respond; falls back to the router's pick"""
         try:
-            self.is_processing = True
+            response_text = self._cached_chat(self._routing_messages(user_message), self.ROUTING_OPTIONS)
+            return self._routing_choice(response_text, fallback)
             
-            context = [
-                {"role": "system", "content": f"""You are a narrative director deciding which character should respond next in this scene.
+        except Exception as e:
+            print(f"Error in character selection: {e}")
+            # Fallback to the router's pick if LLM fails
+            return fallback, 0.4, "fallback"
+    
+    async def _aselect_with_llm(self, user_message: str, fallback: str) -> Tuple[str, float, str]:
+        try:
+            response_text = await self._acached_chat(self._routing_messages(user_message), self.ROUTING_OPTIONS)
+            return self._routing_choice(response_text, fallback)
+        except Exception as e:
+            print(f"Error in character selection: {e}")
+            return fallback, 0.4, "fallback"
+    
+    def _routing_messages(self, user_message: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": f"""You are a narrative director deciding which character should respond next in this scene.
 Characters present: {', '.join(self.story_state["characters_present"])}
 Current scene: {self.story_state["scene"]}
 Last speaking character: {self.last_speaking_character if self.last_speaking_character else 'None'}
@@ -124,35 +335,249 @@ Consider the following when making your decision:
 4. Avoid having the same character respond too many times in a row unless it makes narrative sense
 
 Return ONLY the name of the character who should respond next, no other text."""},
-                {"role": "user", "content": f"Based on this user message, which character should respond next? Message: '{user_message}'"}
-            ]
-
-            response = ollama.chat(
-                model=self.model,
-                messages=context,
-                options={"temperature": 0.3, "num_predict": 30}  # Low temperature for more deterministic output
-            )
-            
-            response_text = response.get("message", {}).get("content", "").strip()
-            
-            # Find which character name appears in the response
-            for char_name in self.story_state["characters_present"]:
-                if char_name.lower() in response_text.lower():
-                    self.is_processing = False
-                    return char_name, 0.8
-                    
-            # Fallback to random selection from characters in scene with lower confidence
-            self.is_processing = False
-            return random.choice(self.story_state["characters_present"]), 0.6
-            
-        except Exception as e:
-            print(f"Error in character selection: {e}")
-            # Fallback to random if LLM fails
-            self.is_processing = False
-            return random.choice(self.story_state["characters_present"]), 0.4
+            {"role": "user", "content": f"Based on this user message, which character should respond next? Message: '{user_message}'"}
+        ]
+    
+    def _routing_choice(self, response_text: str, fallback: str) -> Tuple[str, float, str]:
+        response_text = response_text.strip()
+        
+        # Find which character name appears in the response
+        for char_name in self.story_state["characters_present"]:
+            if char_name.lower() in response_text.lower():
+                return char_name, 0.8, "llm"
+                
+        # Fallback to the router's pick with lower confidence
+        return fallback, 0.6, "fallback"
     
     def process_user_message(self, user_message: str) -> Dict[str, Any]:
         """Process a user message and get a character response"""
+        selection = self._prepare_response(user_message)
+        if isinstance(selection, dict):
+            return selection
+        character, session, confidence, recalled = selection
+        
+        # Get response from the selected character
+        response = character.talk(user_message, auto_advance=False, session=session, recalled=recalled)
+        
+        return self._finish_response(character, response, confidence)
+    
+    def process_user_message_stream(self, user_message: str) -> Iterator[Dict[str, Any]]:
+        """
+        Process a user message and stream the character response
+        Yields a "start" event naming the responder, "token" events with reply text
+        and a final "done" event carrying the same payload as process_user_message
+        """
+        selection = self._prepare_response(user_message)
+        if isinstance(selection, dict):
+            yield {"event": "done", **selection}
+            return
+        character, session, confidence, recalled = selection
+        
+        yield {"event": "start", "character": character.name, "confidence": confidence}
+        
+        parts = []
+        for text in character.talk_stream(user_message, auto_advance=False, session=session, recalled=recalled):
+            parts.append(text)
+            yield {"event": "token", "text": text}
+        
+        response = "".join(parts).strip()
+        yield {"event": "done", **self._finish_response(character, response, confidence)}
+    
+    async def aprocess_user_message(self, user_message: str) -> Dict[str, Any]:
+        """Async version of process_user_message"""
+        selection = await self._aprepare_response(user_message)
+        if isinstance(selection, dict):
+            return selection
+        character, session, confidence, recalled = selection
+        
+        response = await character.atalk(user_message, auto_advance=False, session=session, recalled=recalled)
+        
+        return self._finish_response(character, response, confidence)
+    
+    async def aprocess_user_message_stream(self, user_message: str) -> AsyncIterator[Dict[str, Any]]:
+        """Async version of process_user_message_stream"""
+        selection = await self._aprepare_response(user_message)
+        if isinstance(selection, dict):
+            yield {"event": "done", **selection}
+            return
+        character, session, confidence, recalled = selection
+        
+        yield {"event": "start", "character": character.name, "confidence": confidence}
+        
+        parts = []
+        async for text in character.atalk_stream(user_message, auto_advance=False, session=session,
+                                                 recalled=recalled):
+            parts.append(text)
+            yield {"event": "token", "text": text}
+        
+        response = "".join(parts).strip()
+        yield {"event": "done", **self._finish_response(character, response, confidence)}
+    
+    def process_ensemble(self, user_message: str, character_names: List[str] = None,
+                         max_concurrency: int = None) -> Dict[str, Any]:
+        """Have several characters in the scene answer the same message; see process_ensemble_stream"""
+        for event in self.process_ensemble_stream(user_message, character_names, max_concurrency):
+            if event["event"] == "done":
+                event = dict(event)
+                del event["event"]
+                return event
+    
+    def process_ensemble_stream(self, user_message: str, character_names: List[str] = None,
+                                max_concurrency: int = None) -> Iterator[Dict[str, Any]]:
+        """
+        Have several characters in the scene answer the same message at once
+        Replies are generated concurrently, at most max_concurrency at a time, and each
+        is yielded as a "reply" event as soon as it is ready. The final "done" event
+        lists every reply in scene order, regardless of which finished first.
+        """
+        setup = self._ensemble_speakers(user_message, character_names)
+        if isinstance(setup, dict):
+            yield {"event": "done", **setup}
+            return
+        names, speakers = setup
+        yield {"event": "start", "characters": names}
+        
+        replies = [None] * len(speakers)
+        pool = ThreadPoolExecutor(max_workers=min(max_concurrency or self.ENSEMBLE_CONCURRENCY, len(speakers)),
+                                  thread_name_prefix="ensemble")
+        try:
+            futures = {
+                pool.submit(self._ensemble_reply, character, session, user_message): index
+                for index, (character, session) in enumerate(speakers)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                replies[index] = future.result()
+                yield {"event": "reply", "index": index, **replies[index]}
+        finally:
+            # A client that goes away cancels replies that haven't started
+            pool.shutdown(wait=True, cancel_futures=True)
+        
+        yield self._finish_ensemble(names, replies)
+    
+    async def aprocess_ensemble(self, user_message: str, character_names: List[str] = None,
+                                max_concurrency: int = None) -> Dict[str, Any]:
+        """Async version of process_ensemble"""
+        async for event in self.aprocess_ensemble_stream(user_message, character_names, max_concurrency):
+            if event["event"] == "done":
+                event = dict(event)
+                del event["event"]
+                return event
+    
+    async def aprocess_ensemble_stream(self, user_message: str, character_names: List[str] = None,
+                                       max_concurrency: int = None) -> AsyncIterator[Dict[str, Any]]:
+        """Async version of process_ensemble_stream; replies are tasks on the event loop rather than threads"""
+        # Characters and sessions may have to be loaded from storage
+        setup = await run_blocking("storage", self._ensemble_speakers, user_message, character_names)
+        if isinstance(setup, dict):
+            yield {"event": "done", **setup}
+            return
+        names, speakers = setup
+        yield {"event": "start", "characters": names}
+        
+        replies = [None] * len(speakers)
+        slots = asyncio.Semaphore(max_concurrency or self.ENSEMBLE_CONCURRENCY)
+        
+        async def reply(index, character, session):
+            async with slots:
+                return index, await self._aensemble_reply(character, session, user_message)
+        
+        tasks = [asyncio.ensure_future(reply(index, character, session))
+                 for index, (character, session) in enumerate(speakers)]
+        try:
+            for next_reply in asyncio.as_completed(tasks):
+                index, replies[index] = await next_reply
+                yield {"event": "reply", "index": index, **replies[index]}
+        finally:
+            # A client that goes away cancels replies still generating
+            for task in tasks:
+                task.cancel()
+        
+        yield self._finish_ensemble(names, replies)
+    
+    def _ensemble_speakers(self, user_message: str, character_names: List[str] = None):
+        """
+        Characters and sessions that answer an ensemble message, in scene order
+        Returns (names, [(character, session), ...]), or a finished narrator result
+        for commands and empty scenes
+        """
+        if user_message.startswith("/"):
+            return self._handle_command(user_message)
+        names = [name for name in self.story_state["characters_present"]
+                 if name in self.characters and (character_names is None or name in character_names)]
+        if not names:
+            return {"response": "There are no characters in the current scene. Please add characters first.",
+                    "character": None, "confidence": 0, "is_narrator": True}
+        
+        # Resolve characters and sessions up front; the workers only generate
+        return names, [(self.characters[name], self.get_session(name)) for name in names]
+    
+    def _finish_ensemble(self, names: List[str], replies: List[Dict[str, Any]]) -> Dict[str, Any]:
+        self.last_speaking_character = names[-1]
+        return {
+            "event": "done",
+            "replies": replies,
+            "is_narrator": False,
+            "day": self.story_state["day"],
+            "time_of_day": self.story_state["time_of_day"]
+        }
+    
+    def _ensemble_reply(self, character: Character, session: ConversationSession, user_message: str) -> Dict[str, Any]:
+        try:
+            with session.lock:
+                response = character.talk(user_message, auto_advance=False, session=session)
+            return {"character": character.name, "response": response}
+        except Exception as e:
+            print(f"Error in ensemble reply from {character.name}: {e}")
+            return {"character": character.name, "response": None, "error": str(e)}
+    
+    async def _aensemble_reply(self, character: Character, session: ConversationSession, user_message: str) -> Dict[str, Any]:
+        try:
+            async with locked(session.lock):
+                response = await character.atalk(user_message, auto_advance=False, session=session)
+            return {"character": character.name, "response": response}
+        except Exception as e:
+            print(f"Error in ensemble reply from {character.name}: {e}")
+            return {"character": character.name, "response": None, "error": str(e)}
+    
+    def _prepare_response(self, user_message: str):
+        """
+        Pick the character that answers a user message
+        Returns (character, session, confidence, recalled memories or None), or a finished
+        narrator result when no character should respond (commands, empty scene, failed selection)
+        """
+        result = self._check_message(user_message)
+        if result:
+            return result
+            
+        # Select which character should respond, recalling memories for likely ones meanwhile
+        prefetch = ContextPrefetch(self, user_message)
+        try:
+            char_name, confidence = self.select_responding_character(user_message, prefetch)
+            selection = self._selected(char_name, confidence)
+            if isinstance(selection, dict):
+                return selection
+            return (*selection, prefetch.take(char_name))
+        finally:
+            prefetch.discard()
+    
+    async def _aprepare_response(self, user_message: str):
+        # Commands and the selected character and session may have to load from storage
+        result = await run_blocking("storage", self._check_message, user_message)
+        if result:
+            return result
+        prefetch = ContextPrefetch(self, user_message)
+        try:
+            char_name, confidence = await self.aselect_responding_character(user_message, prefetch)
+            selection = await run_blocking("storage", self._selected, char_name, confidence)
+            if isinstance(selection, dict):
+                return selection
+            return (*selection, await prefetch.atake(char_name))
+        finally:
+            prefetch.discard()
+    
+    def _check_message(self, user_message: str) -> Optional[Dict[str, Any]]:
+        """The narrator's own answer to a message no character should respond to, or None"""
         if not self.characters or not self.story_state["characters_present"]:
             return {
                 "response": "There are no characters in the current scene. Please add characters first.",
@@ -164,10 +589,9 @@ Return ONLY the name of the character who should respond next, no other text."""
         # Process special commands
         if user_message.startswith("/"):
             return self._handle_command(user_message)
-            
-        # Select which character should respond
-        char_name, confidence = self.select_responding_character(user_message)
-        
+        return None
+    
+    def _selected(self, char_name: str, confidence: float):
         if not char_name or char_name not in self.characters:
             return {
                 "response": f"No character selected to respond. Available characters: {', '.join(self.story_state['characters_present'])}",
@@ -178,19 +602,33 @@ Return ONLY the name of the character who should respond next, no other text."""
             
         character = self.characters[char_name]
         
-        # Set user info on character before responding
-        character.user_name = self.user_name
-        character.user_persona = self.user_persona
-        
-        # Get response from the selected character
-        response = character.talk(user_message, auto_advance=False)
-        
+        return character, self.get_session(char_name), confidence
+    
+    def get_session(self, character_name: str) -> ConversationSession:
+        """Return this story's conversation with a character, synced to the story's user and time"""
+        if self.session_store is not None:
+            # Reloaded by the store when another worker took a turn since
+            session = self.session_store.get_or_create(self.session_id, self.characters[character_name])
+            self.sessions[character_name] = session
+        else:
+            session = self.sessions.get(character_name)
+            if session is None:
+                session = ConversationSession(self.session_id, character_name)
+                self.sessions[character_name] = session
+        session.user_name = self.user_name
+        session.user_persona = self.user_persona
+        session.current_day = self.story_state["day"]
+        session.time_of_day = self.story_state["time_of_day"]
+        return session
+    
+    def _finish_response(self, character: Character, response: str, confidence: float) -> Dict[str, Any]:
+        """Record the speaker and build the result payload for a character reply"""
         # Remember who spoke last
-        self.last_speaking_character = char_name
+        self.last_speaking_character = character.name
         
         return {
             "response": response,
-            "character": char_name,
+            "character": character.name,
             "confidence": confidence,
             "is_narrator": False,
             "day": self.story_state["day"],
@@ -205,6 +643,7 @@ Return ONLY the name of the character who should respond next, no other text."""
             # Set a new scene
             scene_desc = command[7:].strip()
             self.story_state["scene"] = scene_desc
+            self.story_changed()
             return {
                 "response": f"*The scene changes to: {scene_desc}*",
                 "is_narrator": True
@@ -216,6 +655,7 @@ Return ONLY the name of the character who should respond next, no other text."""
             if char_name in self.characters:
                 if char_name not in self.story_state["characters_present"]:
                     self.story_state["characters_present"].append(char_name)
+                    self.story_changed()
                     return {
                         "response": f"*{char_name} enters the scene*",
                         "is_narrator": True
@@ -236,6 +676,7 @@ Return ONLY the name of the character who should respond next, no other text."""
             char_name = command[8:].strip()
             if char_name in self.story_state["characters_present"]:
                 self.story_state["characters_present"].remove(char_name)
+                self.story_changed()
                 return {
                     "response": f"*{char_name} leaves the scene*",
                     "is_narrator": True
@@ -284,18 +725,49 @@ Return ONLY the name of the character who should respond next, no other text."""
                 "is_narrator": True
             }
     
-    def direct_scene(self, prompt: str = None) -> Dict[str, Any]:
-        """Generate a narrative direction or scene description"""
-        # If already processing a request, return a placeholder
-        if self.is_processing:
-            return {
-                "response": "*The narrator is still contemplating the scene...*",
-                "is_narrator": True,
-                "day": self.story_state["day"],
-                "time_of_day": self.story_state["time_of_day"]
-            }
+    def direct_scene(self, prompt: str = None, fresh: bool = False) -> Dict[str, Any]:
+        """
+        Generate a narrative direction or scene description
+        The same prompt for an unchanged story reuses the earlier narration unless fresh is set
+        """
+        try:
+            narration = self._cached_chat(self._direction_messages(prompt), self.DIRECTION_OPTIONS, fresh)
+            return self._direction_result(narration)
             
-        context = [
+        except Exception as e:
+            print(f"Error generating narration: {e}")
+            return self._direction_result("*The narrator pauses, contemplating the scene...*")
+    
+    async def adirect_scene(self, prompt: str = None, fresh: bool = False) -> Dict[str, Any]:
+        """Async version of direct_scene"""
+        try:
+            narration = await self._acached_chat(self._direction_messages(prompt), self.DIRECTION_OPTIONS, fresh)
+            return self._direction_result(narration)
+        except Exception as e:
+            print(f"Error generating narration: {e}")
+            return self._direction_result("*The narrator pauses, contemplating the scene...*")
+    
+    def _cached_chat(self, messages: List[Dict[str, str]], options: Dict[str, Any], fresh: bool = False) -> str:
+        """The model's reply to a prompt built from the story state, reused for identical requests unless fresh"""
+        key = self.response_cache.key(self.model, messages, options)
+        reply = None if fresh else self.response_cache.get(key, self.cache_owner)
+        if reply is None:
+            response = llm.chat(model=self.model, messages=messages, options=options)
+            reply = response.get("message", {}).get("content", "")
+            self.response_cache.put(key, reply, self.cache_owner)
+        return reply
+    
+    async def _acached_chat(self, messages: List[Dict[str, str]], options: Dict[str, Any], fresh: bool = False) -> str:
+        key = self.response_cache.key(self.model, messages, options)
+        reply = None if fresh else self.response_cache.get(key, self.cache_owner)
+        if reply is None:
+            response = await llm.achat(model=self.model, messages=messages, options=options)
+            reply = response.get("message", {}).get("content", "")
+            self.response_cache.put(key, reply, self.cache_owner)
+        return reply
+    
+    def _direction_messages(self, prompt: str = None) -> List[Dict[str, str]]:
+        return [
             {"role": "system", "content": f"""You are a skilled narrative director providing storytelling direction.
 Current scene: {self.story_state["scene"]}
 Characters present: {', '.join(self.story_state["characters_present"])}
@@ -311,46 +783,50 @@ Write a brief but evocative narrative description that:
 Your narration should encourage further interaction while providing structure to the roleplay."""},
             {"role": "user", "content": prompt if prompt else "Provide a narrative direction for the current scene."}
         ]
-
+    
+    def _direction_result(self, narration: str) -> Dict[str, Any]:
+        return {
+            "response": narration,
+            "is_narrator": True,
+            "day": self.story_state["day"],
+            "time_of_day": self.story_state["time_of_day"]
+        }
+    
+    def suggest_new_character(self, context_prompt: str) -> Dict[str, Any]:
+        """Suggest a new character based on the story context"""
         try:
-            self.is_processing = True
-            response = ollama.chat(
+            response = llm.chat(
                 model=self.model,
-                messages=context,
-                options={"temperature": 0.7, "num_predict": 300}
+                messages=self._suggestion_messages(context_prompt),
+                options=self.SUGGESTION_OPTIONS
             )
             
-            narration = response.get("message", {}).get("content", "")
-            self.is_processing = False
-            
             return {
-                "response": narration,
-                "is_narrator": True,
-                "day": self.story_state["day"],
-                "time_of_day": self.story_state["time_of_day"]
+                "response": response.get("message", {}).get("content", ""),
+                "is_narrator": True
             }
             
         except Exception as e:
-            print(f"Error generating narration: {e}")
-            self.is_processing = False
-            return {
-                "response": "*The narrator pauses, contemplating the scene...*",
-                "is_narrator": True,
-                "day": self.story_state["day"],
-                "time_of_day": self.story_state["time_of_day"]
-            }
-    
-    def suggest_new_character(self, context_prompt: str) -> Dict[str, Any]:
-        """Suggest a new character based on the story context"""
-        # If already processing a request, return a placeholder
-        if self.is_processing:
+            print(f"Error suggesting character: {e}")
             return {
-                "response": "*The narrator is still considering potential characters...*",
+                "response": "*Unable to generate character suggestion at this time.*",
                 "is_narrator": True
             }
-        
-        self.is_processing = True
-        
+    
+    async def asuggest_new_character(self, context_prompt: str) -> Dict[str, Any]:
+        """Async version of suggest_new_character"""
+        try:
+            response = await llm.achat(
+                model=self.model,
+                messages=self._suggestion_messages(context_prompt),
+                options=self.SUGGESTION_OPTIONS
+            )
+            return {"response": response.get("message", {}).get("content", ""), "is_narrator": True}
+        except Exception as e:
+            print(f"Error suggesting character: {e}")
+            return {"response": "*Unable to generate character suggestion at this time.*", "is_narrator": True}
+    
+    def _suggestion_messages(self, context_prompt: str) -> List[Dict[str, str]]:
         system_prompt = f"""Based on the current story context, suggest a new character who would fit well in this narrative world.
 Current scene: {self.story_state["scene"]}
 Characters present: {', '.join(self.story_state["characters_present"])}
@@ -363,47 +839,10 @@ Generate a complete character profile with:
 4. Appearance description
 
 Format your response as a structured character profile ONLY - no explanations or additional text."""
-
-        try:
-            context = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": context_prompt if context_prompt else "Suggest a new character who would complement the current story."}
-            ]
-            
-            # Start in a non-blocking thread
-            def get_suggestion_async(callback):
-                try:
-                    response = ollama.chat(
-                        model=self.model,
-                        messages=context,
-                        options={"temperature": 0.8, "num_predict": 500}
-                    )
-                    
-                    character_suggestion = response.get("message", {}).get("content", "")
-                    callback(character_suggestion)
-                except Exception as e:
-                    print(f"Error in async character suggestion: {e}")
-                    callback(None)
-                finally:
-                    self.is_processing = False
-            
-            # Start process in background
-            threading.Thread(target=get_suggestion_async, args=(lambda x: None,)).start()
-            
-            # Return immediately with a processing message
-            return {
-                "response": "*The narrator is considering what new character might fit in this story...*",
-                "is_narrator": True,
-                "processing": True
-            }
-            
-        except Exception as e:
-            print(f"Error suggesting character: {e}")
-            self.is_processing = False
-            return {
-                "response": "*Unable to generate character suggestion at this time.*",
-                "is_narrator": True
-            }
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": context_prompt if context_prompt else "Suggest a new character who would complement the current story."}
+        ]
     
     def to_dict(self) -> Dict[str, Any]:
         """Convert narrator state to dictionary for storage"""
@@ -416,11 +855,19 @@ Format your response as a structured character profile ONLY - no explanations or
         }
     
     @staticmethod
-    def from_dict(data: Dict[str, Any]) -> 'Narrator':
+    def from_dict(data: Dict[str, Any], character_pool=None) -> 'Narrator':
         """Create a narrator from a dictionary"""
-        narrator = Narrator(model_name=data.get("model", "dolphin3"))
-        narrator.story_state = data.get("story_state", narrator.story_state)
-        narrator.last_speaking_character = data.get("last_speaking_character")
-        narrator.user_name = data.get("user_name", "Guest")
-        narrator.user_persona = data.get("user_persona", "A curious visitor to the story.")
+        narrator = Narrator(model_name=data.get("model", "dolphin3"), character_pool=character_pool)
+        narrator.load_state(data)
         return narrator
+    
+    def load_state(self, data: Dict[str, Any]) -> None:
+        """Replace the story state with one saved by to_dict; characters and their sessions are kept"""
+        story_state = data.get("story_state", self.story_state)
+        if story_state != self.story_state:
+            self.story_changed()
+        self.story_state = story_state
+        self.last_speaking_character = data.get("last_speaking_character")
+        self.user_name = data.get("user_name", "Guest")
+        self.user_persona = data.get("user_persona", "A curious visitor to the story.")
+        self.model = data.get("model", self.model)
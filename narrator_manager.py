@@ -1,15 +1,25 @@
+import copy
 import json
 import os
 from narrator import Narrator
 from character_pool import CharacterPool
+from state_store import JournalStore, open_store
+from metrics import span
 
 class NarratorManager:
-    NARRATORS_FILE = "narrators.json"
+    NARRATORS_FILE = "narrators.json"  # Legacy file, imported once into the state store
+    STATE_DIR = os.path.join("state", "narrators")
     
-    def __init__(self, character_pool: CharacterPool):
+    def __init__(self, character_pool: CharacterPool, store: JournalStore = None, session_store=None):
         self.narrators = {}  # Dictionary mapping narrator IDs to Narrator instances
         self.character_pool = character_pool
+        # Keeps the stories' conversations when they are shared between worker processes
+        self.session_store = session_store
         self.active_narrator_id = None
+        self.store = store or open_store("narrators", self.STATE_DIR)
+        self._saved = {}  # Narrator ID -> last persisted state, used to journal only what changed
+        self._reloads = set()  # Narrator IDs with a reload waiting in the scheduler
+        self._refresh_again = False  # A reload couldn't be scheduled; retry it on the next refresh
         self.load_narrators()
     
     def create_narrator(self, narrator_id: str, model_name: str = "dolphin3") -> Narrator:
@@ -17,9 +27,10 @@ class NarratorManager:
         if narrator_id in self.narrators:
             raise ValueError(f"Narrator with ID '{narrator_id}' already exists")
         
-        narrator = Narrator(model_name=model_name)
+        narrator = Narrator(model_name=model_name, character_pool=self.character_pool)
+        self._attach(narrator_id, narrator)
         self.narrators[narrator_id] = narrator
-        self.save_narrators()
+        self.save_narrator(narrator_id)
         return narrator
     
     def get_narrator(self, narrator_id: str) -> Narrator:
@@ -31,7 +42,7 @@ class NarratorManager:
         if narrator_id not in self.narrators:
             raise ValueError(f"Narrator with ID '{narrator_id}' not found")
         self.active_narrator_id = narrator_id
-        self.save_narrators()
+        self.store.put("meta", "active_narrator_id", narrator_id)
     
     def get_active_narrator(self) -> Narrator:
         """Get the currently active narrator"""
@@ -43,10 +54,14 @@ class NarratorManager:
     def delete_narrator(self, narrator_id: str) -> None:
         """Delete a narrator by ID"""
         if narrator_id in self.narrators:
-            del self.narrators[narrator_id]
+            narrator = self.narrators.pop(narrator_id)
+            if narrator.session_store is not None:
+                narrator.session_store.remove(narrator.session_id)
+            self._saved.pop(narrator_id, None)
+            self.store.delete("narrators", narrator_id)
             if self.active_narrator_id == narrator_id:
                 self.active_narrator_id = None
-            self.save_narrators()
+                self.store.put("meta", "active_narrator_id", None)
     
     def add_character_to_narrator(self, narrator_id: str, character_name: str) -> bool:
         """Add a character from the character pool to a narrator"""
@@ -57,53 +72,164 @@ class NarratorManager:
             return False
         
         narrator.add_character(character)
-        self.save_narrators()
+        self.save_narrator(narrator_id)
         return True
     
+    def save_narrator(self, narrator_id: str) -> None:
+        """
+        Persist the changes to one narrator since it was last saved
+        Only changed fields and newly added plot points are journaled, so the cost
+        doesn't grow with the size of the story
+        """
+        narrator = self.narrators.get(narrator_id)
+        if not narrator:
+            return
+        
+        with span("save_narrator", narrator=narrator_id):
+            data = self._narrator_data(narrator)
+            saved = self._saved.get(narrator_id)
+            if saved is None:
+                self.store.put("narrators", narrator_id, data)
+            else:
+                self._journal_changes(narrator_id, saved, data)
+            self._saved[narrator_id] = data
+            self._save_sessions(narrator)
+    
     def save_narrators(self) -> None:
-        """Save all narrators to a JSON file"""
-        narrators_data = {
-            "active_narrator_id": self.active_narrator_id,
-            "narrators": {}
+        """Persist the changes to every narrator"""
+        for narrator_id in list(self.narrators):
+            self.save_narrator(narrator_id)
+    
+    def _attach(self, narrator_id: str, narrator: Narrator) -> None:
+        """Keep a narrator's conversations in the shared session store, if there is one"""
+        if self.session_store is not None:
+            narrator.session_store = self.session_store
+            narrator.session_id = f"narrator:{narrator_id}"
+    
+    def _save_sessions(self, narrator: Narrator) -> None:
+        """Save the narrator's conversations that had a turn since they were last saved"""
+        if narrator.session_store is None:
+            return
+        for session in list(narrator.sessions.values()):
+            if session.short_term_memory.total_added != session.saved_messages:
+                narrator.session_store.save(session)
+    
+    def _narrator_data(self, narrator: Narrator):
+        """Snapshot the persistent state of a narrator"""
+        # We only save the narrator state, not the character objects
+        # Characters will be referenced by name and loaded from character_pool when needed
+        narrator_dict = narrator.to_dict()
+        plot_points = narrator_dict["story_state"]["plot_points"]
+        narrator_dict["story_state"] = {
+            key: copy.deepcopy(value) for key, value in narrator_dict["story_state"].items() if key != "plot_points"
         }
-        
-        for narrator_id, narrator in self.narrators.items():
-            # We only save the narrator state, not the character objects
-            # Characters will be referenced by name and loaded from character_pool when needed
-            narrator_dict = narrator.to_dict()
-            narrator_dict["character_names"] = list(narrator.characters.keys())
-            narrators_data["narrators"][narrator_id] = narrator_dict
-        
-        with open(self.NARRATORS_FILE, "w", encoding="utf-8") as f:
-            json.dump(narrators_data, f, indent=2)
+        # Plot points only ever grow, so a shallow copy is enough to find the new ones
+        narrator_dict["story_state"]["plot_points"] = list(plot_points)
+        narrator_dict["character_names"] = list(narrator.characters.keys())
+        return narrator_dict
+    
+    def _journal_changes(self, narrator_id: str, saved, data) -> None:
+        for key, value in data.items():
+            if key != "story_state":
+                if saved.get(key) != value:
+                    self.store.set("narrators", narrator_id, [key], value)
+                continue
+            
+            saved_state = saved.get("story_state", {})
+            for state_key, state_value in value.items():
+                old_value = saved_state.get(state_key)
+                if state_key == "plot_points" and isinstance(old_value, list) and len(state_value) >= len(old_value) \
+                        and state_value[len(old_value) - 1:len(old_value)] == old_value[-1:]:
+                    for plot_point in state_value[len(old_value):]:
+                        self.store.append("narrators", narrator_id, ["story_state", "plot_points"], plot_point)
+                elif old_value != state_value:
+                    self.store.set("narrators", narrator_id, ["story_state", state_key], state_value)
     
     def load_narrators(self) -> None:
-        """Load narrators from the JSON file if it exists"""
-        if not os.path.exists(self.NARRATORS_FILE):
-            return
+        """Load narrators from the state store, importing the legacy JSON file on first run"""
+        if self.store.is_empty() and os.path.exists(self.NARRATORS_FILE):
+            try:
+                with open(self.NARRATORS_FILE, "r", encoding="utf-8") as f:
+                    narrators_data = json.load(f)
+                
+                for narrator_id, narrator_dict in narrators_data.get("narrators", {}).items():
+                    self.store.put("narrators", narrator_id, narrator_dict)
+                self.store.put("meta", "active_narrator_id", narrators_data.get("active_narrator_id"))
+                self.store.compact()
+            except Exception as e:
+                print(f"Error loading narrators: {e}")
         
         try:
-            with open(self.NARRATORS_FILE, "r", encoding="utf-8") as f:
-                narrators_data = json.load(f)
-            
-            self.active_narrator_id = narrators_data.get("active_narrator_id")
+            self.active_narrator_id = self.store.collection("meta").get("active_narrator_id")
             
-            for narrator_id, narrator_dict in narrators_data.get("narrators", {}).items():
-                # Create narrator from the saved data
-                narrator = Narrator.from_dict(narrator_dict)
-                
-                # Add characters from the character pool
-                character_names = narrator_dict.get("character_names", [])
-                for char_name in character_names:
-                    character = self.character_pool.get_character(char_name)
-                    if character:
-                        narrator.add_character(character)
-                
-                self.narrators[narrator_id] = narrator
+            for narrator_id, narrator_dict in self.store.collection("narrators").items():
+                self._restore(narrator_id, narrator_dict)
                 
         except Exception as e:
             print(f"Error loading narrators: {e}")
     
+    def refresh(self, scheduler=None) -> None:
+        """
+        Pick up narrators another worker process created, changed or deleted
+        Only narrators whose stored state differs from what we last saved are touched.
+        With a scheduler, a changed narrator is reloaded as a request in its own line,
+        so the reload never lands in the middle of one of its turns
+        """
+        if not self.store.changed() and not self._refresh_again:
+            return
+        self._refresh_again = False
+        try:
+            self.active_narrator_id = self.store.collection("meta").get("active_narrator_id")
+            stored = self.store.collection("narrators")
+            for narrator_id in [i for i in self.narrators if i not in stored]:
+                del self.narrators[narrator_id]
+                self._saved.pop(narrator_id, None)
+            for narrator_id, narrator_dict in stored.items():
+                if self._saved.get(narrator_id) == narrator_dict:
+                    continue
+                if scheduler is None or narrator_id not in self.narrators:
+                    self._restore(narrator_id, narrator_dict)
+                elif narrator_id not in self._reloads:
+                    self._reloads.add(narrator_id)
+                    try:
+                        scheduler.submit(narrator_id, self._reload, narrator_id)
+                    except Exception as e:
+                        self._reloads.discard(narrator_id)
+                        self._refresh_again = True
+                        print(f"Error scheduling reload of narrator {narrator_id}: {e}")
+        except Exception as e:
+            print(f"Error refreshing narrators: {e}")
+    
+    def _reload(self, narrator_id: str) -> None:
+        """Restore a narrator from its latest stored state, between its turns"""
+        self._reloads.discard(narrator_id)
+        narrator_dict = self.store.get("narrators", narrator_id)
+        if narrator_dict is not None and narrator_id in self.narrators and self._saved.get(narrator_id) != narrator_dict:
+            self._restore(narrator_id, narrator_dict)
+    
+    def _restore(self, narrator_id: str, narrator_dict) -> None:
+        """Build or update a narrator from its stored state"""
+        # Work on a copy so the store's view only changes through the journal
+        narrator_dict = copy.deepcopy(narrator_dict)
+        narrator = self.narrators.get(narrator_id)
+        if narrator is None:
+            narrator = Narrator.from_dict(narrator_dict, character_pool=self.character_pool)
+            self._attach(narrator_id, narrator)
+            self.narrators[narrator_id] = narrator
+        else:
+            # Updated in place so the characters' conversation sessions survive
+            narrator.load_state(narrator_dict)
+        
+        # Add characters from the character pool; they are loaded when first used
+        character_names = narrator_dict.get("character_names", [])
+        for char_name in [name for name in narrator.characters if name not in character_names]:
+            narrator.remove_character(char_name)
+        for char_name in character_names:
+            if self.character_pool.has_character(char_name) and char_name not in narrator.characters:
+                narrator.add_character_name(char_name)
+        
+        self._saved[narrator_id] = self._narrator_data(narrator)
+    
     def list_narrators(self):
         """Return a list of narrator IDs and basic info"""
         return [
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Bounded, expiring cache of model replies for prompts built only from story state.
+    Keys are content addresses: a hash of the model, the full messages and the
+    options, so a reply is only reused for exactly the same request, and any change
+    to the scene, characters, time or plot points produces a new key. Entries are
+    also filed under the narrators that used them, and dropped as soon as all of
+    those stories have changed instead of waiting to expire or be evicted.
+    max_entries of 0 turns the cache off.
+    """
+
+    def __init__(self, max_entries=256, ttl=600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl  # Seconds an entry stays usable; None keeps it until evicted
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (reply, owners, stored at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(model, messages, options=None) -> str:
+        """Content address of a model request"""
+        payload = json.dumps([model, messages, options or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key, owner=None):
+        """Return the cached reply for key, or None on a miss or an expired entry"""
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            if owner is not None:
+                entry[1].add(owner)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, reply, owner=None) -> None:
+        if not self.enabled or not reply:
+            return
+        with self.lock:
+            self.entries[key] = (reply, set() if owner is None else {owner}, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, owner) -> int:
+        """Forget an owner's entries, dropping those no other owner uses; returns how many were dropped"""
+        with self.lock:
+            stale = []
+            for key, (_, owners, _) in self.entries.items():
+                if owner in owners:
+                    owners.discard(owner)
+                    if not owners:
+                        stale.append(key)
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """
+    Return the process-wide response cache, creating it on first use
+    Sized by TALKBOT_RESPONSE_CACHE_SIZE (0 turns it off) and TALKBOT_RESPONSE_CACHE_TTL seconds
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache(
+                max_entries=int(os.environ.get("TALKBOT_RESPONSE_CACHE_SIZE", 256)),
+                ttl=float(os.environ.get("TALKBOT_RESPONSE_CACHE_TTL", 600))
+            )
+        return _default_cache
@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from embeddings import HashingEmbedder
+
+logger = logging.getLogger("talkbot.router")
+
+
+class RoutingDecision:
+    def __init__(self, character, confidence, method, scores, latency_ms):
+        self.character = character
+        self.confidence = confidence
+        self.method = method  # "single", "named", "router", "llm" or "fallback"
+        self.scores = scores
+        self.latency_ms = latency_ms
+
+    def to_dict(self):
+        return {
+            "character": self.character,
+            "confidence": round(self.confidence, 3),
+            "method": self.method,
+            "scores": {name: round(score, 4) for name, score in self.scores.items()},
+            "latency_ms": round(self.latency_ms, 2)
+        }
+
+
+class ResponderRouter:
+    """
+    Picks which character in a scene answers a user message without calling the LLM.
+    Each character is scored by how similar the message is to its background and
+    to the lines it spoke recently, and whoever spoke last is penalised so the
+    dialogue stays balanced. Confidence is the top score's share of the top two;
+    the narrator only asks the LLM when it falls below confidence_threshold.
+    """
+
+    def __init__(self, embedder=None, confidence_threshold=None, background_weight=0.6, recent_weight=0.4,
+                 repeat_penalty=0.05, max_cached_profiles=512):
+        if confidence_threshold is None:
+            confidence_threshold = float(os.environ.get("TALKBOT_ROUTER_THRESHOLD", 0.6))
+        self.embedder = embedder or HashingEmbedder()
+        self.confidence_threshold = confidence_threshold
+        self.background_weight = background_weight
+        self.recent_weight = recent_weight
+        self.repeat_penalty = repeat_penalty
+        self.max_cached_profiles = max_cached_profiles
+        self.lock = threading.Lock()
+        self._profiles = OrderedDict()  # Digest of profile text -> embedding
+        self.decisions = {}  # Method -> count
+        self.total_latency_ms = 0.0
+
+    def score(self, message, candidates, last_speaker=None):
+        """
+        Score candidates for a message
+        candidates maps character names to (background text, recent lines)
+        Returns (scores by name, confidence of the best one)
+        """
+        query = self.embedder.embed_one(message)
+        scores = {}
+        for name, (background, recent_lines) in candidates.items():
+            score = self.background_weight * self._similarity(query, background)
+            if recent_lines:
+                score += self.recent_weight * self._similarity(query, " ".join(recent_lines))
+            if name == last_speaker:
+                score -= self.repeat_penalty
+            scores[name] = score
+
+        ranked = sorted(scores.values(), reverse=True)
+        top = max(ranked[0], 0.0)
+        second = max(ranked[1], 0.0) if len(ranked) > 1 else 0.0
+        confidence = top / (top + second) if top + second > 0 else 1.0 / len(ranked)
+        return scores, confidence
+
+    def record(self, decision):
+        """Count and log a routing decision"""
+        with self.lock:
+            self.decisions[decision.method] = self.decisions.get(decision.method, 0) + 1
+            self.total_latency_ms += decision.latency_ms
+        logger.info("Routed to %s via %s (confidence %.2f) in %.1f ms",
+                    decision.character, decision.method, decision.confidence, decision.latency_ms)
+
+    def stats(self):
+        with self.lock:
+            total = sum(self.decisions.values())
+            llm_calls = self.decisions.get("llm", 0) + self.decisions.get("fallback", 0)
+            return {
+                "decisions": dict(self.decisions),
+                "total": total,
+                "llm_skipped_ratio": round(1 - llm_calls / total, 3) if total else 0.0,
+                "average_latency_ms": round(self.total_latency_ms / total, 2) if total else 0.0,
+                "confidence_threshold": self.confidence_threshold
+            }
+
+    def _similarity(self, query, text):
+        vector = self._profile_embedding(text)
+        dot = sum(a * b for a, b in zip(query, vector))
+        norms = math.sqrt(sum(a * a for a in query)) * math.sqrt(sum(b * b for b in vector))
+        return dot / norms if norms else 0.0
+
+    def _profile_embedding(self, text):
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        with self.lock:
+            vector = self._profiles.get(key)
+            if vector is not None:
+                self._profiles.move_to_end(key)
+                return vector
+        vector = self.embedder.embed_one(text)
+        with self.lock:
+            self._profiles[key] = vector
+            while len(self._profiles) > self.max_cached_profiles:
+                self._profiles.popitem(last=False)
+        return vector
+
+
+_default_router = None
+_default_router_lock = threading.Lock()
+
+
+def get_router():
+    """Return the process-wide responder router, creating it on first use"""
+    global _default_router
+    with _default_router_lock:
+        if _default_router is None:
+            _default_router = ResponderRouter()
+        return _default_router
@@ -0,0 +1,290 @@
+import asyncio
+import contextlib
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+
+class SchedulerFull(Exception):
+    """Raised when a narrator already has the maximum number of requests waiting"""
+
+
+class SchedulerTimeout(Exception):
+    """Raised when a request waited longer than its timeout"""
+
+
+class Cancelled(Exception):
+    """Raised when waiting on a request that was cancelled before it ran"""
+
+
+class Ticket:
+    """Handle to one scheduled request"""
+    QUEUED, RUNNING, DONE, CANCELLED = "queued", "running", "done", "cancelled"
+
+    def __init__(self, scheduler, key, fn, args, kwargs):
+        self.scheduler = scheduler
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.state = self.QUEUED
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def cancel(self) -> bool:
+        """Cancel the request if it hasn't started; returns True if it was cancelled"""
+        return self.scheduler._cancel(self)
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the request and return its result, re-raising its exception
+        A request still queued when the timeout expires is cancelled; one that is
+        already running finishes in the background
+        """
+        if not self._done.wait(timeout):
+            self.cancel()
+            raise SchedulerTimeout(f"Request for '{self.key}' did not finish within {timeout} seconds")
+        if self.state == self.CANCELLED:
+            raise Cancelled(f"Request for '{self.key}' was cancelled")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _finish(self, result=None, error=None, state=DONE):
+        self._result = result
+        self._error = error
+        self.state = state
+        self._done.set()
+
+
+class Reservation(Ticket):
+    """Holds a narrator's place in line for a turn that runs on an event loop instead of a worker"""
+
+    def __init__(self, scheduler, key, loop):
+        super().__init__(scheduler, key, None, (), {})
+        self.loop = loop
+        self.granted = loop.create_future()
+
+    def release(self) -> None:
+        """Hand the narrator back once the turn is over; safe to call more than once"""
+        if self.state == self.RUNNING:
+            self._finish()
+            self.scheduler._release(self.key)
+
+    def _grant(self) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._set_granted)
+        except RuntimeError:  # The loop has closed, so nobody is waiting
+            self.release()
+
+    def _set_granted(self) -> None:
+        if not self.granted.done():
+            self.granted.set_result(True)
+
+
+class NarratorScheduler:
+    """
+    Runs requests against narrators on a small pool of worker threads.
+    Requests for one narrator run one at a time in the order they arrived, so a
+    story's turns never interleave. Narrators with waiting work are served
+    round-robin, so a busy story can't starve the others. Each narrator may have
+    at most max_pending requests waiting; more are rejected with SchedulerFull.
+    """
+
+    def __init__(self, workers=None, max_pending=16):
+        self.workers = workers or int(os.environ.get("TALKBOT_SCHEDULER_WORKERS", 4))
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        self.queues = {}  # Narrator id -> deque of queued tickets
+        self.ready = deque()  # Narrator ids with queued work and nothing running, in service order
+        self.running = set()  # Narrator ids with a request in progress
+        self.threads = []
+        self.completed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    def submit(self, key, fn, *args, **kwargs) -> Ticket:
+        """Queue fn(*args, **kwargs) behind earlier requests for the same narrator"""
+        ticket = Ticket(self, key, fn, args, kwargs)
+        self._enqueue(ticket)
+        return ticket
+
+    def run(self, key, fn, *args, timeout=None, **kwargs):
+        """Schedule a request and wait for its result"""
+        return self.submit(key, fn, *args, **kwargs).result(timeout)
+
+    def stream(self, key, fn, *args, timeout=None, **kwargs):
+        """
+        Schedule a generator function and yield its items as they are produced
+        The narrator stays reserved until the generator finishes; closing this
+        generator early cancels a queued request or stops a running one at its
+        next item
+        """
+        items = queue.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def pump():
+            try:
+                for item in fn(*args, **kwargs):
+                    if stop.is_set():
+                        break
+                    items.put(item)
+            finally:
+                items.put(done)
+
+        ticket = self.submit(key, pump)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=0.1)
+                except queue.Empty:
+                    if deadline is not None and time.monotonic() >= deadline and ticket.cancel():
+                        raise SchedulerTimeout(f"Request for '{key}' did not start within {timeout} seconds")
+                    if ticket.state == Ticket.CANCELLED:
+                        raise Cancelled(f"Request for '{key}' was cancelled")
+                    continue
+                if item is done:
+                    break
+                yield item
+            ticket.result()  # Surface errors raised by the generator
+        finally:
+            stop.set()
+            ticket.cancel()
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, key, timeout=None):
+        """
+        Wait for a narrator's turn without tying up a worker thread, and hold it for the block
+        For async handlers: the turn keeps its place in line with the narrator's other
+        requests but runs on the caller's event loop. A wait that times out or is
+        cancelled gives up its place.
+        """
+        reservation = Reservation(self, key, asyncio.get_running_loop())
+        self._enqueue(reservation)
+        try:
+            await asyncio.wait_for(asyncio.shield(reservation.granted), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if not reservation.cancel():
+                reservation.release()  # Granted just as we gave up
+            if isinstance(e, asyncio.TimeoutError):
+                raise SchedulerTimeout(f"Request for '{key}' did not start within {timeout} seconds") from None
+            raise
+        try:
+            yield
+        finally:
+            reservation.release()
+
+    def pending(self, key) -> int:
+        with self.condition:
+            return len(self.queues.get(key, ()))
+
+    def stats(self):
+        with self.condition:
+            return {
+                "workers": self.workers,
+                "running": len(self.running),
+                "queued": sum(len(q) for q in self.queues.values()),
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "rejected": self.rejected
+            }
+
+    def _start_workers(self) -> None:
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"narrator-scheduler-{len(self.threads)}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _enqueue(self, ticket) -> None:
+        key = ticket.key
+        with self.condition:
+            self._start_workers()
+            if isinstance(ticket, Reservation) and key not in self.running and not self.queues.get(key):
+                # The narrator is idle; take it now rather than waiting for a worker to hand it over
+                self._start(ticket)
+                ticket._grant()
+                return
+            pending = self.queues.setdefault(key, deque())
+            if len(pending) >= self.max_pending:
+                self.rejected += 1
+                raise SchedulerFull(f"Too many requests waiting for '{key}'")
+            pending.append(ticket)
+            if key not in self.running and key not in self.ready:
+                self.ready.append(key)
+                self.condition.notify()
+
+    def _start(self, ticket) -> None:
+        ticket.state = Ticket.RUNNING
+        ticket.started_at = time.monotonic()
+        self.running.add(ticket.key)
+
+    def _release(self, key) -> None:
+        with self.condition:
+            self.running.discard(key)
+            self.completed += 1
+            if self.queues.get(key):
+                # Back of the line, behind narrators that have been waiting
+                self.ready.append(key)
+                self.condition.notify()
+
+    def _cancel(self, ticket) -> bool:
+        with self.condition:
+            if ticket.state != Ticket.QUEUED:
+                return False
+            pending = self.queues.get(ticket.key)
+            if pending is not None:
+                pending.remove(ticket)
+                if not pending:
+                    del self.queues[ticket.key]
+                    if ticket.key in self.ready:
+                        self.ready.remove(ticket.key)
+            self.cancelled += 1
+            ticket._finish(state=Ticket.CANCELLED)
+            return True
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                while not self.ready:
+                    self.condition.wait()
+                key = self.ready.popleft()
+                pending = self.queues[key]
+                ticket = pending.popleft()
+                if not pending:
+                    del self.queues[key]
+                self._start(ticket)
+
+            if isinstance(ticket, Reservation):
+                # The turn runs on its event loop, which releases the narrator when it's done
+                ticket._grant()
+                continue
+
+            try:
+                ticket._finish(result=ticket.fn(*ticket.args, **ticket.kwargs))
+            except BaseException as e:
+                ticket._finish(error=e)
+            self._release(key)
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> NarratorScheduler:
+    """Return the process-wide narrator scheduler, creating it on first use"""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = NarratorScheduler()
+        return _default_scheduler
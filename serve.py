@@ -0,0 +1,119 @@
+"""
+Production entry point for the web app.
+
+    python serve.py [--host 0.0.0.0] [--port 5000] [--workers 4] [--threads 8]
+
+Runs the ASGI app (asgi.py) under uvicorn with several worker processes. The chat,
+narrator, direct and suggest endpoints run on each worker's event loop, so a slow
+generation costs a coroutine rather than a thread; the other routes are served by
+the Flask app on --threads threads. Without uvicorn, or with --server gunicorn or
+--server waitress, the Flask app alone runs under gunicorn (several processes,
+each with a pool of threads) or waitress (one process, many threads).
+
+Module globals are per process, so with more than one worker the characters,
+narrators, personas, sessions and background jobs move to the shared SQLite
+state store (TALKBOT_STATE_BACKEND=sqlite, file TALKBOT_STATE_DB). Each worker
+picks up the others' changes at the start of every request. Turns of one story
+are still ordered by the narrator scheduler within a worker, not across them.
+"""
+import argparse
+import os
+import sys
+
+
+def default_workers():
+    # Generation happens on the Ollama server, so workers mostly wait; two per core is plenty
+    return max(2, min(8, (os.cpu_count() or 1) * 2))
+
+
+def serve_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class TalkBotApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Imported in each worker after the fork, so every worker gets its own threads and connections
+            from app import app
+            return app
+
+    TalkBotApplication({
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+        "timeout": args.timeout,  # A worker may be busy this long on one slow generation
+        "graceful_timeout": 30,
+        "keepalive": 5,
+        "accesslog": "-" if args.access_log else None
+    }).run()
+
+
+def serve_uvicorn(args):
+    import uvicorn
+
+    # Read by asgi.py in each worker: threads for the routes still served by Flask
+    os.environ["TALKBOT_THREADS"] = str(args.threads)
+    uvicorn.run("asgi:app", host=args.host, port=args.port, workers=args.workers, timeout_keep_alive=5,
+                timeout_graceful_shutdown=30, access_log=args.access_log)
+
+
+def serve_waitress(args):
+    from waitress import serve
+    from app import app
+
+    if args.workers > 1:
+        print("waitress runs a single process; using threads only")
+    serve(app, host=args.host, port=args.port, threads=args.threads, channel_timeout=args.timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run TalkBot with a production server")
+    parser.add_argument("--host", default=os.environ.get("TALKBOT_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("TALKBOT_PORT", 5000)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("TALKBOT_WORKERS", default_workers())),
+                        help="Worker processes (uvicorn and gunicorn)")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("TALKBOT_THREADS", 8)),
+                        help="Request threads per worker; under uvicorn, only for the routes served by Flask")
+    parser.add_argument("--timeout", type=int, default=180,
+                        help="Seconds before a stuck request is abandoned (gunicorn and waitress)")
+    parser.add_argument("--server", choices=("auto", "uvicorn", "gunicorn", "waitress"), default="auto")
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args()
+
+    server = args.server
+    if server == "auto":
+        try:
+            import uvicorn  # noqa: F401
+            server = "uvicorn"
+        except ImportError:
+            server = "waitress" if sys.platform == "win32" else "gunicorn"
+    if server == "waitress":
+        args.workers = 1
+
+    if args.workers > 1:
+        # Workers must not each keep their own copy of the state
+        os.environ.setdefault("TALKBOT_STATE_BACKEND", "sqlite")
+        if os.environ["TALKBOT_STATE_BACKEND"] != "sqlite":
+            parser.error("several workers need TALKBOT_STATE_BACKEND=sqlite")
+
+    try:
+        if server == "uvicorn":
+            serve_uvicorn(args)
+        elif server == "gunicorn":
+            serve_gunicorn(args)
+        else:
+            serve_waitress(args)
+    except ImportError as e:
+        print(f"{server} is not installed ({e}); install it with 'pip install {server}'")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from executors import TurnLock
+from memory import ShortTermMemory
+
+VALID_TIMES = ["early_morning", "morning", "afternoon", "evening", "night"]
+
+
+SAFE_FILENAME = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]{0,99}")
+
+
+def safe_filename(name):
+    """
+    Make an id usable as a file name
+    Ids that aren't safe as they are (including "." and "..") are sanitized and given
+    a short hash of the original, so distinct ids never share a file
+    """
+    name = str(name)
+    if SAFE_FILENAME.fullmatch(name):
+        return name
+    digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+    return f"{re.sub(r'[^A-Za-z0-9_-]', '_', name)[:50]}_{digest}"
+
+
+class ConversationSession:
+    """
+    Mutable state of one conversation with one character: who the user is, the
+    story clock and the short-term memory. The Character itself only holds the
+    shared, read-only definition, so any number of sessions can talk to it at once.
+    """
+
+    def __init__(self, session_id, character_name, user_name="Guest", user_persona="A curious visitor to the website.",
+                 current_day=1, time_of_day="morning", msgs_per_time_change=1, message_count=0, spill_path=None):
+        self.session_id = session_id
+        self.character_name = character_name
+        self.user_name = user_name
+        self.user_persona = user_persona
+        self.current_day = current_day
+        self.time_of_day = time_of_day
+        self.msgs_per_time_change = msgs_per_time_change
+        self.message_count = message_count
+        self.short_term_memory = ShortTermMemory(spill_path=spill_path)
+        self.context_usage = None  # Tokens per prompt section in the last turn
+        self.rng = random.Random()  # For tools; never reseeds the global generator
+        self.revision = 0  # Revision of this session in a shared store, assigned by the store
+        self.saved_messages = 0  # short_term_memory.total_added as of the last save to or load from the store
+        self.lock = TurnLock()  # Serializes turns within this conversation, from threads and async tasks alike
+        self.last_used = time.monotonic()
+
+    def set_time(self, day, time_of_day):
+        if time_of_day not in VALID_TIMES:
+            raise ValueError(f"Invalid time_of_day. Must be one of: {', '.join(VALID_TIMES)}")
+        self.current_day = day
+        self.time_of_day = time_of_day
+
+    def advance_time(self):
+        current_index = VALID_TIMES.index(self.time_of_day)
+        if current_index < len(VALID_TIMES) - 1:
+            self.time_of_day = VALID_TIMES[current_index + 1]
+        else:
+            self.time_of_day = VALID_TIMES[0]
+            self.current_day += 1
+
+    def rewind_time(self):
+        current_index = VALID_TIMES.index(self.time_of_day)
+        if current_index > 0:
+            self.time_of_day = VALID_TIMES[current_index - 1]
+        else:
+            self.time_of_day = VALID_TIMES[-1]
+            if self.current_day > 1:
+                self.current_day -= 1
+
+    def next_day(self):
+        self.current_day += 1
+        self.time_of_day = VALID_TIMES[0]
+
+    def to_dict(self):
+        return {
+            "session_id": self.session_id,
+            "character_name": self.character_name,
+            "user_name": self.user_name,
+            "user_persona": self.user_persona,
+            "current_day": self.current_day,
+            "time_of_day": self.time_of_day,
+            "msgs_per_time_change": self.msgs_per_time_change,
+            "message_count": self.message_count
+        }
+
+    @staticmethod
+    def from_dict(data):
+        return ConversationSession(**data)
+
+
+class SessionStore:
+    """
+    Registry of live conversation sessions keyed by (session id, character name).
+    Idle sessions are dropped once more than max_sessions are held. With a spill_dir
+    (or TALKBOT_SHORT_TERM_DIR) each session's short-term memory is journaled to
+    disk, so dropped sessions and restarts pick the conversation back up.
+    With a shared store (see state_store.open_shared_store) sessions are saved there
+    after every turn and reloaded whenever another worker process saved them since.
+    Saves are compare-and-set on the session's revision: when another worker saved
+    a turn first, its state is taken and this worker's new messages are added on top.
+    """
+    SAVE_ATTEMPTS = 5
+
+    def __init__(self, max_sessions=1000, spill_dir=None, store=None):
+        self.max_sessions = max_sessions
+        self.spill_dir = spill_dir or os.environ.get("TALKBOT_SHORT_TERM_DIR")
+        self.store = store
+        self.sessions = OrderedDict()  # (session id, character name) -> ConversationSession
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    def spill_path(self, session_id, character_name):
+        """Short-term memory journal of a session, or None when spilling is off"""
+        if not self.spill_dir:
+            return None
+        return os.path.join(self.spill_dir, safe_filename(character_name), safe_filename(session_id) + ".jsonl")
+
+    @staticmethod
+    def store_key(session_id, character_name):
+        return f"{character_name}\x1f{session_id}"
+
+    def get(self, session_id, character_name):
+        with self.lock:
+            session = self.sessions.get((session_id, character_name))
+            if session:
+                self.sessions.move_to_end((session_id, character_name))
+                session.last_used = time.monotonic()
+                self._refresh(session)
+            elif self.store is not None:
+                session = self._load(session_id, character_name)
+            return session
+
+    def get_or_create(self, session_id, character):
+        """Return the session for this user and character, starting it from the character's defaults"""
+        with self.lock:
+            key = (session_id, character.name)
+            session = self.sessions.get(key)
+            if session is None and self.store is not None:
+                session = self._load(session_id, character.name)
+            if session is None:
+                defaults = character.session
+                session = ConversationSession(
+                    session_id,
+                    character.name,
+                    user_name=defaults.user_name,
+                    user_persona=defaults.user_persona,
+                    current_day=defaults.current_day,
+                    time_of_day=defaults.time_of_day,
+                    msgs_per_time_change=defaults.msgs_per_time_change,
+                    spill_path=self.spill_path(session_id, character.name)
+                )
+                self.sessions[key] = session
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            else:
+                self.sessions.move_to_end(key)
+                self._refresh(session)
+            session.last_used = time.monotonic()
+            return session
+
+    def save(self, session):
+        """Persist a session after a turn; without a shared store, in-process sessions are already up to date"""
+        if self.store is None:
+            return True
+        key = self.store_key(session.session_id, session.character_name)
+        for _ in range(self.SAVE_ATTEMPTS):
+            record = dict(session.to_dict(), short_term=session.short_term_memory.to_dict())
+            revision = self.store.put_versioned("sessions", key, record, session.revision)
+            if revision is not None:
+                session.revision = revision
+                session.saved_messages = session.short_term_memory.total_added
+                return True
+            self._merge(session, self.store.get("sessions", key))
+        print(f"Error saving session {session.session_id} with {session.character_name}: "
+              f"another worker keeps saving it first")
+        return False
+
+    def remove(self, session_id, character_name=None):
+        with self.lock:
+            for key in [k for k in self.sessions if k[0] == session_id and character_name in (None, k[1])]:
+                del self.sessions[key]
+                path = self.spill_path(*key)
+                if path and os.path.exists(path):
+                    os.remove(path)
+            if self.store is not None:
+                # Including the ones only other workers have loaded
+                for key in list(self.store.collection("sessions")):
+                    name, _, stored_id = key.partition("\x1f")
+                    if stored_id == session_id and character_name in (None, name):
+                        self.store.delete("sessions", key)
+
+    def _load(self, session_id, character_name):
+        """Rebuild a session another worker saved; called with the lock held"""
+        record = self.store.get("sessions", self.store_key(session_id, character_name))
+        if record is None:
+            return None
+        session = ConversationSession(session_id, character_name,
+                                      spill_path=self.spill_path(session_id, character_name))
+        self._apply(session, record)
+        self.sessions[(session_id, character_name)] = session
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return session
+
+    def _refresh(self, session):
+        """Catch up with a newer save of this session by another worker"""
+        if self.store is None:
+            return
+        record = self.store.get("sessions", self.store_key(session.session_id, session.character_name))
+        if record is not None and record.get("revision", 0) != session.revision:
+            self._apply(session, record)
+
+    def _merge(self, session, record):
+        """Rebase a session on another worker's newer save, keeping the messages added here since"""
+        memory = session.short_term_memory
+        unsaved = min(memory.total_added - session.saved_messages, len(memory))
+        entries = list(memory.iter_recent(unsaved)) if unsaved > 0 else []
+        if record is None:
+            session.revision = 0  # Removed by another worker; save it afresh
+        else:
+            self._apply(session, record)
+        for entry in entries:
+            memory.add(entry.message, entry.time_delta, entry.day, entry.time_of_day)
+
+    @staticmethod
+    def _apply(session, record):
+        for name in ("user_name", "user_persona", "current_day", "time_of_day", "msgs_per_time_change",
+                     "message_count", "revision"):
+            if name in record:
+                setattr(session, name, record[name])
+        session.short_term_memory.restore(record.get("short_term", {}))
+        session.saved_messages = session.short_term_memory.total_added
@@ -0,0 +1,414 @@
+import atexit
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def apply_record(state, record):
+    """Apply one journal record to a state dictionary"""
+    op = record["op"]
+    entities = state.setdefault(record["c"], {})
+    key = record["k"]
+
+    if op == "put":
+        entities[key] = record["v"]
+    elif op == "delete":
+        entities.pop(key, None)
+    elif op in ("set", "append"):
+        target = entities.setdefault(key, {})
+        *parents, last = record["p"]
+        for part in parents:
+            target = target.setdefault(part, {})
+        if op == "set":
+            target[last] = record["v"]
+        else:
+            target.setdefault(last, []).append(record["v"])
+    else:
+        raise ValueError(f"Unknown journal operation '{op}'")
+
+
+class JournalStore:
+    """
+    Persistent state kept as a snapshot plus an append-only journal of small deltas.
+    Each change costs one short line in the journal, fsyncs are batched, and the
+    journal is folded into a fresh snapshot once it grows past compact_after records.
+    A torn final line from a crash is discarded when the journal is replayed.
+
+    State is organised as collections of entities: {collection: {key: value}}.
+    """
+    SNAPSHOT_FILE = "snapshot.json"
+    JOURNAL_FILE = "journal.log"
+    shared = False  # State lives in this process only
+
+    def __init__(self, directory, fsync_batch=32, fsync_interval=1.0, compact_after=1000):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, self.SNAPSHOT_FILE)
+        self.journal_path = os.path.join(directory, self.JOURNAL_FILE)
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+        self.lock = threading.RLock()
+        self.state = {}
+        self.seq = 0
+        self.records_since_snapshot = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._stop = threading.Event()
+        self._syncer = threading.Thread(target=self._sync_periodically, name="journal-sync", daemon=True)
+        self._syncer.start()
+        atexit.register(self.close)
+
+    def is_empty(self) -> bool:
+        return not any(self.state.values())
+
+    def collection(self, name):
+        """Return the entities of a collection; treat the result as read-only"""
+        with self.lock:
+            return self.state.get(name, {})
+
+    def get(self, collection, key):
+        """Return one entity, or None; treat the result as read-only"""
+        with self.lock:
+            return self.state.get(collection, {}).get(key)
+
+    def changed(self) -> bool:
+        """Whether another process changed the state since we last looked; never, for a journal"""
+        return False
+
+    def put(self, collection, key, value) -> None:
+        """Store a whole entity"""
+        self._write({"op": "put", "c": collection, "k": key, "v": value})
+
+    def set(self, collection, key, path, value) -> None:
+        """Set one (possibly nested) field of an entity; path is a list of keys"""
+        self._write({"op": "set", "c": collection, "k": key, "p": list(path), "v": value})
+
+    def append(self, collection, key, path, value) -> None:
+        """Append a value to a list field of an entity"""
+        self._write({"op": "append", "c": collection, "k": key, "p": list(path), "v": value})
+
+    def delete(self, collection, key) -> None:
+        self._write({"op": "delete", "c": collection, "k": key})
+
+    def put_versioned(self, collection, key, value, revision):
+        """
+        Store a whole entity only if its stored "revision" (0 when absent) is still
+        revision; returns the entity's new revision, or None if it was saved since
+        """
+        with self.lock:
+            stored = self.get(collection, key)
+            if (stored or {}).get("revision", 0) != revision:
+                return None
+            self.put(collection, key, dict(value, revision=revision + 1))
+            return revision + 1
+
+    def sync(self) -> None:
+        """Force buffered journal records to disk"""
+        with self.lock:
+            if self.closed or not self.unsynced:
+                return
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self.unsynced = 0
+            self.last_sync = time.monotonic()
+
+    def compact(self) -> None:
+        """Fold the journal into a new snapshot and start an empty journal"""
+        with self.lock:
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"seq": self.seq, "state": self.state}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            # Records up to seq are now in the snapshot, so replay skips them even if
+            # we crash before the journal is truncated
+            self._journal.close()
+            self._journal = open(self.journal_path, "w", encoding="utf-8")
+            self.records_since_snapshot = 0
+            self.unsynced = 0
+
+    def close(self) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            self.sync()
+            self._stop.set()
+            self._journal.close()
+            self.closed = True
+
+    def _write(self, record) -> None:
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Journal store is closed")
+            self.seq += 1
+            record["seq"] = self.seq
+            line = json.dumps(record, ensure_ascii=False)
+            # Apply a copy so later mutations by the caller can't leak into our state
+            apply_record(self.state, copy.deepcopy(record))
+            self._journal.write(line + "\n")
+            self._journal.flush()
+            self.unsynced += 1
+            self.records_since_snapshot += 1
+            if self.unsynced >= self.fsync_batch or time.monotonic() - self.last_sync >= self.fsync_interval:
+                self.sync()
+            if self.records_since_snapshot >= self.compact_after:
+                self.compact()
+
+    def _load(self) -> None:
+        """Read the snapshot and replay the journal on top of it"""
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            self.state = snapshot.get("state", {})
+            self.seq = snapshot.get("seq", 0)
+
+        if not os.path.exists(self.journal_path):
+            return
+
+        valid_length = 0
+        with open(self.journal_path, "rb") as f:
+            for raw_line in f:
+                if not raw_line.endswith(b"\n"):
+                    break  # Torn write from a crash
+                try:
+                    record = json.loads(raw_line)
+                except ValueError:
+                    break
+                valid_length += len(raw_line)
+                if record.get("seq", 0) <= self.seq:
+                    continue  # Already part of the snapshot
+                apply_record(self.state, record)
+                self.seq = record["seq"]
+                self.records_since_snapshot += 1
+
+        if valid_length < os.path.getsize(self.journal_path):
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(valid_length)
+
+    def _sync_periodically(self) -> None:
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except (OSError, ValueError):
+                return
+
+
+class SQLiteStore:
+    """
+    State shared by every worker process, kept in one SQLite database in WAL mode.
+    Offers the same interface as JournalStore. Each store is a namespace of the
+    database, so the character pool, narrators, personas and sessions can share one
+    file. Every write is its own short transaction, so readers never block and
+    writers from different processes are serialized by SQLite; changed() tells a
+    process when another one has written, so it can refresh what it caches.
+    """
+    shared = True
+
+    def __init__(self, path, namespace, timeout=30.0):
+        self.path = path
+        self.namespace = namespace
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.connections = []
+        self.seq = 0  # Namespace write counter as of our last read or write
+        self._cache = {}  # Collection -> (seq, entities)
+        self.closed = False
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS entities (
+                namespace TEXT NOT NULL, collection TEXT NOT NULL, key TEXT NOT NULL,
+                value TEXT NOT NULL, PRIMARY KEY (namespace, collection, key))""")
+            db.execute("CREATE TABLE IF NOT EXISTS changes (namespace TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+        self.seq = self._current_seq()
+        atexit.register(self.close)
+
+    def is_empty(self) -> bool:
+        row = self._connection().execute("SELECT 1 FROM entities WHERE namespace = ? LIMIT 1",
+                                         (self.namespace,)).fetchone()
+        return row is None
+
+    def collection(self, name):
+        """Return the entities of a collection; treat the result as read-only"""
+        seq = self._current_seq()
+        with self.lock:
+            cached = self._cache.get(name)
+            if cached and cached[0] == seq:
+                return cached[1]
+        rows = self._connection().execute("SELECT key, value FROM entities WHERE namespace = ? AND collection = ?",
+                                          (self.namespace, name)).fetchall()
+        entities = {key: json.loads(value) for key, value in rows}
+        with self.lock:
+            self._cache[name] = (seq, entities)
+        return entities
+
+    def get(self, collection, key):
+        """Return one entity, or None"""
+        row = self._connection().execute(
+            "SELECT value FROM entities WHERE namespace = ? AND collection = ? AND key = ?",
+            (self.namespace, collection, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def changed(self) -> bool:
+        """Whether any process wrote to this namespace since we last looked"""
+        seq = self._current_seq()
+        with self.lock:
+            changed, self.seq = seq != self.seq, seq
+        return changed
+
+    def put(self, collection, key, value) -> None:
+        """Store a whole entity"""
+        self._write({"op": "put", "c": collection, "k": key, "v": value})
+
+    def set(self, collection, key, path, value) -> None:
+        """Set one (possibly nested) field of an entity; path is a list of keys"""
+        self._write({"op": "set", "c": collection, "k": key, "p": list(path), "v": value})
+
+    def append(self, collection, key, path, value) -> None:
+        """Append a value to a list field of an entity"""
+        self._write({"op": "append", "c": collection, "k": key, "p": list(path), "v": value})
+
+    def delete(self, collection, key) -> None:
+        self._write({"op": "delete", "c": collection, "k": key})
+
+    def put_versioned(self, collection, key, value, revision):
+        """
+        Store a whole entity only if its stored "revision" (0 when absent) is still
+        revision; the check and the bump share one write transaction, so of two
+        processes saving the same revision exactly one wins. Returns the entity's new
+        revision, or None if another process saved it first
+        """
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM entities WHERE namespace = ? AND collection = ? AND key = ?",
+                             (self.namespace, collection, key)).fetchone()
+            if (json.loads(row[0]) if row else {}).get("revision", 0) != revision:
+                return None
+            db.execute("INSERT OR REPLACE INTO entities (namespace, collection, key, value) VALUES (?, ?, ?, ?)",
+                       (self.namespace, collection, key, json.dumps(dict(value, revision=revision + 1),
+                                                                    ensure_ascii=False)))
+            seq = self._bump(db)
+        self._wrote(seq)
+        return revision + 1
+
+    def sync(self) -> None:
+        """Every write is committed on its own; nothing is buffered"""
+        pass
+
+    def compact(self) -> None:
+        """Fold the write-ahead log back into the database file"""
+        self._connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for connection in self.connections:
+                try:
+                    connection.close()
+                except sqlite3.ProgrammingError:
+                    pass  # Owned by a thread that has exited
+            self.connections.clear()
+
+    def _connection(self):
+        """One connection per thread; sqlite3 connections can't be shared between threads"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.closed:
+                raise RuntimeError("SQLite store is closed")
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")  # Durable at checkpoints, safe against corruption
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    def _current_seq(self) -> int:
+        row = self._connection().execute("SELECT seq FROM changes WHERE namespace = ?", (self.namespace,)).fetchone()
+        return row[0] if row else 0
+
+    def _write(self, record) -> None:
+        collection, key = record["c"], record["k"]
+        with self._transaction() as db:
+            if record["op"] == "delete":
+                db.execute("DELETE FROM entities WHERE namespace = ? AND collection = ? AND key = ?",
+                           (self.namespace, collection, key))
+            else:
+                state = {}
+                if record["op"] != "put":
+                    # Nested updates read the current value inside the write transaction
+                    row = db.execute("SELECT value FROM entities WHERE namespace = ? AND collection = ? AND key = ?",
+                                     (self.namespace, collection, key)).fetchone()
+                    if row:
+                        state = {collection: {key: json.loads(row[0])}}
+                apply_record(state, record)
+                db.execute("INSERT OR REPLACE INTO entities (namespace, collection, key, value) VALUES (?, ?, ?, ?)",
+                           (self.namespace, collection, key, json.dumps(state[collection][key], ensure_ascii=False)))
+            seq = self._bump(db)
+        self._wrote(seq)
+
+    def _bump(self, db) -> int:
+        """Count a write to this namespace inside its transaction; returns the new count"""
+        db.execute("INSERT INTO changes (namespace, seq) VALUES (?, 1) "
+                   "ON CONFLICT(namespace) DO UPDATE SET seq = seq + 1", (self.namespace,))
+        return db.execute("SELECT seq FROM changes WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+
+    def _wrote(self, seq) -> None:
+        with self.lock:
+            # Our own write doesn't count as a change from another process, unless one slipped in before it
+            if seq == self.seq + 1:
+                self.seq = seq
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on error"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+DEFAULT_SQLITE_PATH = os.path.join("state", "talkbot.db")
+
+
+def open_store(namespace, directory):
+    """
+    Open the state store for one part of the app. By default that is a JournalStore
+    in directory; with TALKBOT_STATE_BACKEND=sqlite it is a namespace of the SQLite
+    database at TALKBOT_STATE_DB, which every worker process shares.
+    """
+    backend = os.environ.get("TALKBOT_STATE_BACKEND", "journal").lower()
+    if backend == "sqlite":
+        return SQLiteStore(os.environ.get("TALKBOT_STATE_DB", DEFAULT_SQLITE_PATH), namespace)
+    if backend != "journal":
+        raise ValueError(f"Unknown TALKBOT_STATE_BACKEND '{backend}'; use 'journal' or 'sqlite'")
+    return JournalStore(directory)
+
+
+def open_shared_store(namespace):
+    """The SQLite store for a namespace when state is shared between workers, else None"""
+    if os.environ.get("TALKBOT_STATE_BACKEND", "journal").lower() != "sqlite":
+        return None
+    return open_store(namespace, None)
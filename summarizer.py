@@ -0,0 +1,147 @@
+import atexit
+import queue
+import threading
+import time
+from collections import deque
+
+
+class SummaryJob:
+    def __init__(self, character, entries, day, time_of_day):
+        self.character = character
+        self.entries = entries
+        self.day = day
+        self.time_of_day = time_of_day
+        self.enqueued_at = time.monotonic()
+
+
+class SummarizationWorker:
+    """
+    Background thread that turns snapshots of short-term memory into long-term memories.
+    Chat requests only enqueue a snapshot, so they never wait on the summary LLM call
+    or the Chroma insert.
+    """
+
+    def __init__(self, max_queue_size=32):
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.pending_since = deque()  # Enqueue times of jobs not yet finished
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.last_lag = 0.0
+        self.stopped = False
+
+    def start(self):
+        """Start the worker thread if it isn't running yet"""
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.stopped = False
+            self.thread = threading.Thread(target=self._run, name="summarization-worker", daemon=True)
+            self.thread.start()
+
+    def submit(self, character, entries, day, time_of_day):
+        """
+        Queue a snapshot of short-term memory entries for summarization
+        Returns False without blocking if the worker is stopped or the queue is full
+        """
+        if self.stopped:
+            return False
+        self.start()
+        job = SummaryJob(character, entries, day, time_of_day)
+        with self.lock:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                self.rejected += 1
+                return False
+            self.pending_since.append(job.enqueued_at)
+        return True
+
+    def stats(self):
+        """Report queue depth and how far behind the worker is running"""
+        with self.lock:
+            oldest = self.pending_since[0] if self.pending_since else None
+            return {
+                "queue_depth": self.queue.qsize(),
+                "pending": len(self.pending_since),
+                "oldest_pending_seconds": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+                "last_lag_seconds": round(self.last_lag, 3),
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected
+            }
+
+    def shutdown(self, flush=True, timeout=None):
+        """
+        Stop the worker
+        With flush=True every queued snapshot is summarized before the thread exits,
+        otherwise queued work is discarded
+        """
+        self.stopped = True
+        if not flush:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                with self.lock:
+                    if self.pending_since:
+                        self.pending_since.popleft()
+                self.queue.task_done()
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+    def _run(self):
+        dirty = {}  # Long-term memories with buffered summaries, written once the queue drains
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    self._flush(dirty)
+                    return
+                try:
+                    job.character.summarize_entries(job.entries, job.day, job.time_of_day)
+                    dirty[id(job.character.long_term_memory)] = job.character.long_term_memory
+                    if self.queue.empty():
+                        self._flush(dirty)
+                    succeeded = True
+                except Exception as e:
+                    print(f"Error summarizing memories for {job.character.name}: {e}")
+                    succeeded = False
+                with self.lock:
+                    if self.pending_since:
+                        self.pending_since.popleft()
+                    self.last_lag = time.monotonic() - job.enqueued_at
+                    if succeeded:
+                        self.processed += 1
+                    else:
+                        self.failed += 1
+            finally:
+                self.queue.task_done()
+
+    @staticmethod
+    def _flush(dirty):
+        """Write buffered summaries, batching everything produced while a backlog was drained"""
+        for memory in dirty.values():
+            try:
+                memory.flush()
+            except Exception:
+                pass  # flush logged it and keeps the batch for its next flush
+        dirty.clear()
+
+
+_default_worker = None
+_default_worker_lock = threading.Lock()
+
+
+def get_summarizer():
+    """Return the process-wide summarization worker, creating it on first use"""
+    global _default_worker
+    with _default_worker_lock:
+        if _default_worker is None:
+            _default_worker = SummarizationWorker()
+            atexit.register(_default_worker.shutdown, flush=True, timeout=30)
+        return _default_worker
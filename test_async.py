@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import time
+
+import llm
+from character import Character
+from executors import TurnLock, locked
+from fake_ollama import FakeOllamaServer
+from narrator import Narrator
+from router import ResponderRouter
+from session import ConversationSession
+
+
+def make_character(name):
+    character = Character(name, "", f"{name}'s background", name.lower(), f"{name.lower()}_memories_test",
+                          "Tester", "A visitor")
+    character.query_long_term_memory = lambda prompt: []
+    return character
+
+
+def test_many_turns_share_one_event_loop_without_a_thread_each(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lyra = make_character("Lyra")
+    with FakeOllamaServer(reply="Rolling [tool:random_number:4:4]!", first_token_latency=0.3) as server:
+        gateway = llm.LLMGateway(host=server.url, max_concurrency=100, max_connections=100, retries=0)
+        monkeypatch.setattr(llm, "_default_gateway", gateway)
+        sessions = [ConversationSession(f"user-{i}", "Lyra") for i in range(100)]
+
+        async def main():
+            threads_before = threading.active_count()
+            turns = [lyra.atalk("roll a die", session=session) for session in sessions]
+            replies = await asyncio.gather(*turns)
+            # Only the bounded memory pool; the fake server's handlers are the rest
+            return replies, threading.active_count() - threads_before - server.max_active
+
+        started = time.perf_counter()
+        replies, extra_threads = asyncio.run(main())
+        elapsed = time.perf_counter() - started
+        gateway.close()
+
+    assert replies == ["Rolling 4!"] * 100
+    assert server.max_active > 50
+    assert elapsed < 5  # Far from 100 turns one after another
+    assert extra_threads <= 8
+    assert all(s.short_term_memory.get_recent()[-1]["content"] == "Rolling 4!" for s in sessions)
+
+
+def test_async_ensemble_and_direction_match_the_sync_versions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    narrator = Narrator(router=ResponderRouter())
+    for name in ("Lyra", "Bram"):
+        narrator.add_character(make_character(name))
+    with FakeOllamaServer(reply="Well met.", first_token_latency=0.2) as server:
+        gateway = llm.LLMGateway(host=server.url, max_concurrency=4, retries=0)
+        monkeypatch.setattr(llm, "_default_gateway", gateway)
+
+        async def main():
+            events = [event async for event in narrator.aprocess_ensemble_stream("hello", max_concurrency=2)]
+            direction = await narrator.adirect_scene()
+            return events, direction
+
+        started = time.perf_counter()
+        events, direction = asyncio.run(main())
+        elapsed = time.perf_counter() - started
+        gateway.close()
+
+    assert elapsed < 0.6  # Both replies generate at once, then the direction
+    assert events[0] == {"event": "start", "characters": ["Lyra", "Bram"]}
+    assert [r["character"] for r in events[-1]["replies"]] == ["Lyra", "Bram"]
+    assert all(r["response"] == "Well met." for r in events[-1]["replies"])
+    assert direction == narrator._direction_result("Well met.")
+    assert narrator.last_speaking_character == "Bram"
+
+
+def test_turn_lock_is_handed_over_in_order_between_threads_and_tasks():
+    lock = TurnLock()
+    order = []
+
+    def thread_turn():
+        with lock:
+            order.append("thread")
+
+    async def task_turn(name):
+        async with locked(lock):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    async def main():
+        lock.acquire()
+        first = asyncio.create_task(task_turn("first"))
+        cancelled = asyncio.create_task(task_turn("cancelled"))
+        await asyncio.sleep(0)
+        thread = threading.Thread(target=thread_turn)
+        thread.start()
+        while len(lock.waiters) < 3:
+            await asyncio.sleep(0.001)
+        last = asyncio.create_task(task_turn("last"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        started = time.perf_counter()
+        lock.release()
+        await asyncio.gather(first, last, asyncio.to_thread(thread.join), return_exceptions=True)
+        return time.perf_counter() - started
+
+    elapsed = asyncio.run(main())
+    assert order == ["first", "thread", "last"]
+    assert elapsed < 0.05
+    assert not lock.locked()
@@ -0,0 +1,57 @@
+import json
+
+from character_pool import CharacterPool
+from narrator import Narrator
+from state_store import JournalStore
+
+
+def write_roster(tmp_path, monkeypatch, count):
+    monkeypatch.chdir(tmp_path)
+    records = [
+        {
+            "name": f"Character {i}",
+            "intro": f"Intro {i}",
+            "background": f"Background {i}",
+            "profile": f"page/image/character{i}.png",
+            "db_name": "",
+            "current_day": 2,
+            "time_of_day": "evening",
+        }
+        for i in range(count)
+    ]
+    (tmp_path / CharacterPool.CHARACTERS_FILE).write_text(json.dumps(records), encoding="utf-8")
+
+
+def test_characters_are_loaded_on_first_use_and_evicted_lru(tmp_path, monkeypatch):
+    write_roster(tmp_path, monkeypatch, 3)
+    pool = CharacterPool(max_resident=2, store=JournalStore(str(tmp_path / "state")))
+
+    assert [record["name"] for record in pool.list_records()] == ["Character 0", "Character 1", "Character 2"]
+    assert not pool.resident
+
+    first = pool.get_character("Character 0")
+    assert first.current_day == 2 and first.time_of_day == "evening"
+    first.advance_time()
+    pool.get_character("Character 1")
+    pool.get_character("Character 2")
+
+    # The least recently used character is unloaded but keeps its state
+    assert list(pool.resident) == ["Character 1", "Character 2"]
+    assert pool.get_record("Character 0")["time_of_day"] == "night"
+    assert pool.get_character("Character 0").time_of_day == "night"
+
+
+def test_narrator_resolves_characters_through_the_pool(tmp_path, monkeypatch):
+    write_roster(tmp_path, monkeypatch, 2)
+    pool = CharacterPool(max_resident=1, store=JournalStore(str(tmp_path / "state")))
+    narrator = Narrator(character_pool=pool)
+    narrator.add_character_name("Character 0")
+    narrator.add_character_name("Character 1")
+
+    assert not pool.resident
+    narrator.advance_time()
+    assert not pool.resident
+
+    assert narrator.characters["Character 1"].name == "Character 1"
+    assert narrator.characters.get("Missing") is None
+    assert list(pool.resident) == ["Character 1"]
@@ -0,0 +1,71 @@
+import character as character_module
+from character import Character
+from context_builder import ContextBuilder, TokenEstimator, context_budget
+
+
+def message(role, words):
+    return {"role": role, "content": " ".join(["word"] * words)}
+
+
+def test_estimator_counts_words_and_punctuation():
+    estimator = TokenEstimator()
+    assert estimator.count("") == 0
+    assert estimator.count("Hello, world!") == 4
+    assert estimator.count("antidisestablishmentarianism") > 1
+    text = "The quick brown fox jumps over the lazy dog. " * 50
+    shortened = estimator.truncate(text, 40)
+    assert estimator.count(shortened) <= 45
+    assert shortened.startswith("The quick") and shortened.endswith("dog. ")
+
+
+def test_budget_is_filled_by_priority():
+    builder = ContextBuilder(budget=200)
+    system = [message("system", 50)]
+    history = [message("user", 40), message("assistant", 40), message("user", 40)]
+    memories = [message("system", 40), message("system", 10)]
+    user = message("user", 20)
+
+    messages, usage = builder.build(system, history, memories, user)
+
+    # System and user always fit, then the newest turns, then whichever memories still fit
+    assert messages[0] == system[0] and messages[-1] == user
+    assert usage["dropped_history"] == 1
+    assert messages[1:3] == history[1:]
+    assert usage["dropped_memories"] == 1
+    assert messages[3] == memories[1]
+    assert usage["total"] <= 200
+    assert usage["total"] == usage["system"] + usage["history"] + usage["memories"] + usage["user"]
+
+
+def test_long_pastes_are_truncated():
+    builder = ContextBuilder(budget=300)
+    paste = message("user", 2000)
+    messages, usage = builder.build([message("system", 20)], [message("assistant", 2000)], [], paste)
+    assert usage["user"] <= 300 * 0.35
+    assert usage["total"] <= 300
+    assert usage["truncated"] == 2
+    assert "[...]" in messages[-1]["content"]
+
+
+def test_the_current_turn_is_sent_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sent = []
+    monkeypatch.setattr(character_module.llm, "chat", lambda **kwargs: sent.append(kwargs["messages"]) or
+                        {"message": {"content": "That is a lot of text."}})
+    lyra = Character("Lyra", "", "A guardian of the archives.", "lyra", "lyra_context_test", "Guest", "A visitor")
+    lyra.query_long_term_memory = lambda prompt: []
+    lyra.talk("Hello there.")
+    paste = " ".join(f"line{i}" for i in range(5000))
+    lyra.talk(paste)
+
+    messages = sent[-1]
+    assert sum("line0 " in m["content"] for m in messages) == 1
+    assert messages[-1]["content"].startswith("Guest: line0")
+    assert [m["content"] for m in messages[2:4]] == ["Guest: Hello there.", "That is a lot of text."]
+    assert lyra.session.context_usage["history"] < 50
+
+
+def test_budget_comes_from_the_model_window(monkeypatch):
+    assert context_budget("dolphin3", reply_tokens=250) == 4096 - 250
+    monkeypatch.setenv("TALKBOT_MODEL_CONTEXT_TOKENS", "dolphin3=8192")
+    assert context_budget("dolphin3") == 8192
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from embeddings import BatchedEmbedder, Embedder, HashingEmbedder
+from memory import ChromaStore, LongTermMemory
+
+
+class RecordingEmbedder(Embedder):
+    name = "recording"
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, input):
+        self.batches.append(list(input))
+        time.sleep(0.01)
+        return [[float(len(text)), 1.0] for text in input]
+
+
+def test_hashing_embedder_is_deterministic_and_normalized():
+    embedder = HashingEmbedder(dimension=64)
+    first, second, other = embedder(["Lyra told me about the stars", "Lyra told me about the stars", "Bananas!"])
+    assert first == second
+    assert abs(sum(v * v for v in first) - 1.0) < 1e-9
+    assert first != other
+    assert len(embedder([""])[0]) == 64
+
+
+def test_hashing_embedder_ranks_shared_topics_first(tmp_path):
+    store = ChromaStore(db_path=str(tmp_path / "memories_chroma"), embedding_function=HashingEmbedder())
+    memory = LongTermMemory("lyra_memories", store=store)
+    memory.bulk_import([
+        {"summary": "Lyra showed the user the constellations above the archive tower."},
+        {"summary": "The user and Lyra argued about the best recipe for mushroom soup."},
+        {"summary": "A storm flooded the market square and the merchants fled."}
+    ])
+    assert memory.query("tell me again about the constellations", n_results=1) == [
+        "Lyra showed the user the constellations above the archive tower."
+    ]
+
+
+def test_batched_embedder_splits_large_inputs():
+    inner = RecordingEmbedder()
+    embedder = BatchedEmbedder(inner, max_batch_size=4)
+    vectors = embedder([f"text {i}" for i in range(10)])
+    assert len(vectors) == 10
+    assert [len(batch) for batch in inner.batches] == [4, 4, 2]
+
+
+def test_batched_embedder_coalesces_concurrent_queries():
+    inner = RecordingEmbedder()
+    embedder = BatchedEmbedder(inner, max_batch_size=16, max_wait=0.05)
+    results = {}
+
+    def embed(i):
+        results[i] = embedder([f"q{'x' * i}"])[0]
+
+    threads = [threading.Thread(target=embed, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every caller gets its own vector back, from far fewer model calls
+    assert all(results[i] == [float(i + 1), 1.0] for i in range(8))
+    assert len(inner.batches) < 8
+    assert embedder.texts == 8
+
+
+def test_a_lone_query_is_embedded_without_waiting():
+    inner = RecordingEmbedder()
+    embedder = BatchedEmbedder(inner, max_wait=5)
+    started = time.perf_counter()
+    assert embedder(["qx"]) == [[2.0, 1.0]]
+    assert time.perf_counter() - started < 1
+
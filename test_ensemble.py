@@ -0,0 +1,51 @@
+import time
+
+from character import Character
+from narrator import Narrator
+from router import ResponderRouter
+
+
+class SlowCharacter(Character):
+    def __init__(self, name, delay):
+        super().__init__(name, "", f"{name}'s background", name.lower(), "", "Guest", "A visitor")
+        self.delay = delay
+
+    def talk(self, user_message, time_since_last="unknown", auto_advance=True, session=None):
+        time.sleep(self.delay)
+        session.short_term_memory.add({"role": "assistant", "content": user_message}, "0s", 1, "morning")
+        return f"{self.name} answers {user_message}"
+
+
+def test_ensemble_replies_run_concurrently_and_keep_scene_order(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    narrator = Narrator(router=ResponderRouter())
+    for name, delay in (("Lyra", 0.3), ("Bram", 0.1), ("Iris", 0.2)):
+        narrator.add_character(SlowCharacter(name, delay))
+
+    started = time.perf_counter()
+    events = list(narrator.process_ensemble_stream("hello", max_concurrency=3))
+    elapsed = time.perf_counter() - started
+
+    # Close to the slowest reply rather than the 0.6s sum
+    assert elapsed < 0.5
+    assert events[0] == {"event": "start", "characters": ["Lyra", "Bram", "Iris"]}
+    # Replies stream as they finish...
+    assert [e["character"] for e in events if e["event"] == "reply"] == ["Bram", "Iris", "Lyra"]
+    # ...and are returned in scene order
+    done = events[-1]
+    assert [r["character"] for r in done["replies"]] == ["Lyra", "Bram", "Iris"]
+    assert done["replies"][0]["response"] == "Lyra answers hello"
+    assert all(len(narrator.get_session(name).short_term_memory.entries) == 1 for name in ("Lyra", "Bram", "Iris"))
+
+
+def test_ensemble_respects_concurrency_limit_and_selection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    narrator = Narrator(router=ResponderRouter())
+    for name in ("Lyra", "Bram", "Iris"):
+        narrator.add_character(SlowCharacter(name, 0.1))
+
+    started = time.perf_counter()
+    result = narrator.process_ensemble("hello", character_names=["Iris", "Lyra"], max_concurrency=1)
+    assert time.perf_counter() - started >= 0.2
+    assert [r["character"] for r in result["replies"]] == ["Lyra", "Iris"]
+    assert narrator.last_speaking_character == "Iris"
@@ -0,0 +1,65 @@
+import threading
+
+from jobs import Job, JobManager
+from scheduler import NarratorScheduler
+from state_store import SQLiteStore
+
+
+def test_job_results_are_kept_until_their_ttl_expires():
+    jobs = JobManager(workers=2, ttl=60)
+    job = jobs.submit("suggest_character", lambda prompt: {"response": f"A {prompt}"}, "smith")
+    assert jobs.wait(job.id, 5).to_dict()["result"] == {"response": "A smith"}
+    assert job.status == Job.SUCCEEDED
+
+    failing = jobs.submit("direct_scene", lambda: 1 / 0)
+    assert jobs.wait(failing.id, 5).status == Job.FAILED
+    assert "division" in failing.error
+
+    jobs.ttl = 0
+    job.finished_at -= 1
+    assert jobs.get(job.id) is None
+
+
+def test_narrator_jobs_keep_their_place_and_can_be_cancelled():
+    scheduler = NarratorScheduler(workers=2)
+    jobs = JobManager(scheduler=scheduler)
+    gate = threading.Event()
+    order = []
+
+    blocker = jobs.submit("chat", gate.wait, key="story")
+    first = jobs.submit("direct_scene", order.append, "first", key="story")
+    second = jobs.submit("direct_scene", order.append, "second", key="story")
+    assert jobs.cancel(first.id)
+    gate.set()
+
+    assert jobs.wait(second.id, 5).status == Job.SUCCEEDED
+    assert jobs.wait(blocker.id, 5).status == Job.SUCCEEDED
+    assert first.status == Job.CANCELLED
+    assert order == ["second"]
+    assert not jobs.cancel(second.id)
+
+
+def test_jobs_queued_in_another_worker_can_be_cancelled(tmp_path):
+    path = str(tmp_path / "state.db")
+    owner = JobManager(scheduler=NarratorScheduler(workers=2), store=SQLiteStore(path, "jobs"))
+    other = JobManager(store=SQLiteStore(path, "jobs"))
+    started, gate = threading.Event(), threading.Event()
+    ran = []
+
+    def block():
+        started.set()
+        gate.wait()
+
+    blocker = owner.submit("chat", block, key="story")
+    queued = owner.submit("direct_scene", ran.append, "queued", key="story")
+    assert started.wait(5)
+    assert not other.cancel(blocker.id)  # Already running in its worker
+    assert other.cancel(queued.id)
+    assert other.get(queued.id).status == Job.CANCELLED
+    gate.set()
+
+    assert owner.wait(queued.id, 5).status == Job.CANCELLED
+    assert owner.wait(blocker.id, 5).status == Job.SUCCEEDED
+    assert ran == []
+    assert other.get(queued.id).status == Job.CANCELLED
+
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+
+import pytest
+
+from context_builder import context_tokens
+from fake_ollama import FakeOllamaServer
+from llm import LLMGateway
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def test_chat_and_stream_reuse_one_connection():
+    with FakeOllamaServer(reply="One two three") as server:
+        gateway = LLMGateway(host=server.url, retries=0)
+        response = gateway.chat("dolphin3", MESSAGES, options={"num_predict": 10})
+        chunks = list(gateway.chat("dolphin3", MESSAGES, stream=True))
+        gateway.close()
+
+    assert response["message"]["content"] == "One two three"
+    assert "".join(chunk["message"]["content"] for chunk in chunks) == "One two three"
+    assert server.requests[0]["options"] == {"num_predict": 10}
+    assert len(server.connections) == 1
+
+
+def test_transient_failures_are_retried():
+    with FakeOllamaServer(fail_first=2) as server:
+        gateway = LLMGateway(host=server.url, retries=2, backoff=0.01)
+        response = gateway.chat("dolphin3", MESSAGES)
+
+    assert response["message"]["content"] == "Hello there, traveler."
+    assert len(server.requests) == 3
+
+
+def test_failures_surface_once_retries_are_exhausted():
+    with FakeOllamaServer(fail_first=5) as server:
+        gateway = LLMGateway(host=server.url, retries=1, backoff=0.01)
+        with pytest.raises(Exception):
+            gateway.chat("dolphin3", MESSAGES)
+
+    assert len(server.requests) == 2
+
+
+def test_per_model_concurrency_is_shared_by_sync_and_async_callers():
+    with FakeOllamaServer(first_token_latency=0.05) as server:
+        gateway = LLMGateway(host=server.url, max_concurrency=2)
+
+        threads = [threading.Thread(target=gateway.chat, args=("dolphin3", MESSAGES)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        async def run_async():
+            replies = await asyncio.gather(*(gateway.achat("dolphin3", MESSAGES) for _ in range(4)))
+            stream = await gateway.achat("dolphin3", MESSAGES, stream=True)
+            chunks = [chunk async for chunk in stream]
+            return replies, chunks
+
+        replies, chunks = asyncio.run(run_async())
+        for thread in threads:
+            thread.join()
+
+    assert server.max_active <= 2
+    assert len(server.requests) == 9
+    assert all(reply["message"]["content"] == "Hello there, traveler." for reply in replies)
+    assert "".join(chunk["message"]["content"] for chunk in chunks) == "Hello there, traveler."
+
+
+def test_keep_alive_is_configured_per_model():
+    with FakeOllamaServer() as server:
+        gateway = LLMGateway(host=server.url, keep_alive="30m", model_keep_alive={"llama3": "2h"})
+        gateway.chat("dolphin3", MESSAGES)
+        gateway.chat("llama3", MESSAGES)
+        gateway.chat("llama3", MESSAGES, keep_alive=0)
+
+    assert [request.get("keep_alive") for request in server.requests] == ["30m", "2h", 0]
+
+
+def test_every_request_runs_with_the_budgeted_context_window():
+    with FakeOllamaServer() as server:
+        gateway = LLMGateway(host=server.url, context_window=context_tokens)
+        gateway.chat("dolphin3", MESSAGES, options={"num_predict": 10})
+        gateway.chat("llama3", MESSAGES)
+        gateway.chat("dolphin3", MESSAGES, options={"num_ctx": 8192})
+
+    assert [request["options"].get("num_ctx") for request in server.requests] == [4096, 2048, 8192]
+    assert server.requests[0]["options"]["num_predict"] == 10
+
@@ -0,0 +1,222 @@
+import time
+
+import chromadb
+import pytest
+
+from memory import ChromaStore, LongTermMemory, ShortTermMemory
+from state_store import SQLiteStore
+
+
+class LetterCountEmbedding:
+    """Deterministic offline embedding for tests"""
+
+    def __call__(self, input):
+        return [[float(text.lower().count(letter)) + 0.01 for letter in "abcdefghijklmnopqrstuvwxyz"] for text in input]
+
+
+def test_collection_names_are_valid_and_unique():
+    assert ChromaStore.collection_name("lyra_memories") == "lyra_memories"
+    spaced = ChromaStore.collection_name("ungga bunga_memories")
+    underscored = ChromaStore.collection_name("ungga_bunga_memories")
+    assert spaced != underscored
+    assert 3 <= len(spaced) <= 63
+    assert 3 <= len(ChromaStore.collection_name("x" * 200)) <= 63
+    assert 3 <= len(ChromaStore.collection_name("a")) <= 63
+
+
+def test_shared_store_opens_lazily_and_evicts(tmp_path):
+    store = ChromaStore(db_path=str(tmp_path / "memories_chroma"), max_open_collections=2)
+    memories = [LongTermMemory(f"character_{i}_memories", store=store) for i in range(3)]
+    assert store.open_collections() == []
+
+    for memory in memories:
+        assert memory.collection.count() == 0
+    # Only the most recently used handles stay open, all in one client
+    assert store.open_collections() == ["character_1_memories", "character_2_memories"]
+    assert len(store.client.list_collections()) == 3
+
+    assert store.evict_idle(idle_timeout=0) == 2
+    assert store.open_collections() == []
+
+
+def test_memory_ids_are_unique_and_ordered():
+    ids = [LongTermMemory.new_memory_id() for _ in range(1000)]
+    assert len(set(ids)) == 1000
+    assert ids == sorted(ids)
+
+
+def test_buffered_adds_and_bulk_import(tmp_path):
+    store = ChromaStore(db_path=str(tmp_path / "memories_chroma"), embedding_function=LetterCountEmbedding())
+    memory = LongTermMemory("lyra_memories", store=store, batch_size=3)
+
+    # Two summaries in the same time slot used to collide on one ID
+    memory.add("We talked about the stars.", 1, "morning")
+    memory.add("We talked about the sea.", 1, "morning")
+    assert memory.collection.count() == 0
+    memory.add("We talked about zebras.", 1, "morning")
+    assert memory.collection.count() == 3
+
+    memory.add("Pending until the next query.", 2, "night")
+    assert len(memory.query("zebras", n_results=4)) == 4
+
+    started = time.perf_counter()
+    imported = memory.bulk_import(
+        {"summary": f"Historical memory number {i}", "day": i, "time_of_day": "evening"} for i in range(2000)
+    )
+    assert imported == 2000
+    assert memory.collection.count() == 2004
+    assert time.perf_counter() - started < 30
+
+
+class CountingEmbedding(LetterCountEmbedding):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, input):
+        self.calls += 1
+        return super().__call__(input)
+
+
+def test_query_embeddings_and_results_are_cached(tmp_path):
+    embedding = CountingEmbedding()
+    store = ChromaStore(db_path=str(tmp_path / "memories_chroma"), embedding_function=embedding)
+    lyra = LongTermMemory("lyra_memories", store=store, batch_size=1)
+    bunga = LongTermMemory("bunga_memories", store=store, batch_size=1)
+    lyra.add("We watched the stars together.", 1, "night")
+    bunga.add("We ate bananas.", 1, "morning")
+    calls_after_writes = embedding.calls
+
+    assert lyra.query("Hi  there") == ["We watched the stars together."]
+    assert lyra.query("hi there") == ["We watched the stars together."]
+    # The embedding is shared with other characters
+    assert bunga.query("HI THERE") == ["We ate bananas."]
+    assert embedding.calls == calls_after_writes + 1
+    assert store.embedding_cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+    assert lyra.cache_stats()["hits"] == 1
+
+    # A new write invalidates only that character's cached results
+    lyra.add("We talked about the moon.", 2, "night")
+    assert len(lyra.query("hi there")) == 2
+    assert lyra.cache_stats()["misses"] == 2
+    bunga.query("hi there")
+    assert bunga.cache_stats()["hits"] == 1
+
+
+def test_documents_missing_from_a_racing_read_are_skipped(tmp_path, monkeypatch):
+    store = ChromaStore(db_path=str(tmp_path / "memories_chroma"), embedding_function=LetterCountEmbedding())
+    lyra = LongTermMemory("lyra_memories", store=store, batch_size=1)
+    lyra.add("We watched the stars together.", 1, "night")
+    collection = lyra.collection
+
+    class RacingCollection:
+        def query(self, **kwargs):
+            return {"documents": [["We watched the stars together.", None]]}
+
+    monkeypatch.setattr(LongTermMemory, "collection", property(lambda self: RacingCollection()))
+    assert lyra.query("stars") == ["We watched the stars together."]
+    monkeypatch.setattr(LongTermMemory, "collection", property(lambda self: collection))
+    assert lyra.query("stars") == ["We watched the stars together."]
+    assert lyra.cache_stats()["misses"] == 2
+
+
+def test_cached_results_see_writes_from_other_workers(tmp_path):
+    db_path, state_path = str(tmp_path / "memories_chroma"), str(tmp_path / "state.db")
+    mine, theirs = (ChromaStore(db_path=db_path, embedding_function=LetterCountEmbedding(),
+                                version_store=SQLiteStore(state_path, "memories")) for _ in range(2))
+    lyra = LongTermMemory("lyra_memories", store=mine, batch_size=1)
+    lyra.add("We watched the stars together.", 1, "night")
+    assert lyra.query("stars") == ["We watched the stars together."]
+    assert lyra.query("stars") == ["We watched the stars together."]
+    assert lyra.cache_stats()["hits"] == 1
+
+    LongTermMemory("lyra_memories", store=theirs, batch_size=1).add("We talked about the moon.", 2, "night")
+    assert len(lyra.query("stars")) == 2
+    assert lyra.cache_stats()["misses"] == 2
+
+
+def test_failed_writes_are_kept_and_retried(tmp_path):
+    store = ChromaStore(db_path=str(tmp_path / "memories_chroma"), embedding_function=LetterCountEmbedding())
+    lyra = LongTermMemory("lyra_memories", store=store, batch_size=10)
+    lyra.add("We watched the stars together.", 1, "night")
+    lyra.add("We talked about the moon.", 2, "night")
+    upsert = lyra._upsert
+
+    def failing_upsert(batch):
+        lyra._upsert = upsert
+        raise RuntimeError("database is locked")
+
+    lyra._upsert = failing_upsert
+    with pytest.raises(RuntimeError):
+        lyra.flush()
+    lyra.add("We ate bananas.", 3, "morning")
+    assert [document for _, document, _ in lyra.pending] == [
+        "We watched the stars together.", "We talked about the moon.", "We ate bananas."]
+    assert lyra.flush() == 3
+    assert lyra.collection.count() == 3
+
+
+def test_query_still_reads_when_writes_fail(tmp_path):
+    store = ChromaStore(db_path=str(tmp_path / "memories_chroma"), embedding_function=LetterCountEmbedding())
+    lyra = LongTermMemory("lyra_memories", store=store, batch_size=10)
+    lyra.add("We watched the stars together.", 1, "night")
+    lyra.flush()
+    lyra.add("We talked about the moon.", 2, "night")
+
+    def failing_upsert(batch):
+        raise RuntimeError("database is locked")
+
+    lyra._upsert = failing_upsert
+    assert lyra.query("stars") == ["We watched the stars together."]
+    assert [document for _, document, _ in lyra.pending] == ["We talked about the moon."]
+
+
+def test_old_per_character_databases_are_imported_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    legacy = chromadb.PersistentClient(path=str(tmp_path / "lyra_memories_chroma")).get_or_create_collection(
+        "memories", embedding_function=LetterCountEmbedding())
+    legacy.add(ids=["mem_1", "mem_2"], documents=["We watched the stars together.", "We talked about the moon."],
+               metadatas=[{"day": 1, "time_of_day": "night"}, {"day": 2, "time_of_day": "night"}])
+    store = ChromaStore(db_path=str(tmp_path / "memories_chroma"), embedding_function=LetterCountEmbedding())
+
+    lyra = LongTermMemory("lyra_memories", store=store)
+    assert sorted(lyra.query("stars")) == ["We talked about the moon.", "We watched the stars together."]
+    assert lyra.collection.get(ids=["mem_2"])["metadatas"] == [{"day": 2, "time_of_day": "night"}]
+    assert LongTermMemory("lyra_memories", store=store).import_legacy() == 0  # Already imported
+    assert lyra.collection.count() == 2
+
+
+def test_short_term_memory_is_a_ring_buffer():
+    memory = ShortTermMemory(max_length=3)
+    for i in range(5):
+        memory.add({"role": "user", "content": str(i)}, "0s", 1, "morning")
+    assert len(memory) == 3 and memory.total_added == 5
+    assert [e.message["content"] for e in memory] == ["2", "3", "4"]
+    assert [m["content"] for m in memory.get_recent(2)] == ["3", "4"]
+    assert memory.entries[0]["message"]["content"] == "2"
+    memory.clear()
+    assert len(memory) == 0 and memory.get_recent() == []
+
+
+def test_short_term_memory_spill_survives_restart(tmp_path):
+    path = str(tmp_path / "lyra" / "alice.jsonl")
+    memory = ShortTermMemory(max_length=4, spill_path=path)
+    for i in range(30):
+        memory.add({"role": "user", "content": str(i)}, "1m", 2, "evening")
+
+    # The log is compacted instead of growing with the conversation
+    with open(path, encoding="utf-8") as f:
+        assert len(f.readlines()) <= 4 * 4 + 1
+    restored = ShortTermMemory(max_length=4, spill_path=path)
+    assert [e.message["content"] for e in restored] == ["26", "27", "28", "29"]
+    assert restored.total_added == 30
+    assert restored.get_window(n=2, step=8) == memory.get_window(n=2, step=8)
+
+    # A write torn by a crash loses only that line
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"message": {"role": "us')
+    restored = ShortTermMemory(max_length=4, spill_path=path)
+    restored.add({"role": "user", "content": "30"}, "1m", 2, "evening")
+    assert [e.message["content"] for e in ShortTermMemory(max_length=4, spill_path=path)] == ["27", "28", "29", "30"]
+
+    restored.clear()
+    assert len(ShortTermMemory(max_length=4, spill_path=path)) == 0
@@ -0,0 +1,47 @@
+import metrics
+from fake_ollama import FakeOllamaServer
+from llm import LLMGateway
+from metrics import NOOP_SPAN, MetricsRegistry
+
+
+def test_disabled_registry_records_nothing():
+    registry = MetricsRegistry(enabled=False)
+    assert registry.span("generate", model="dolphin3") is NOOP_SPAN
+    with registry.context(narrator="story"), registry.span("route"):
+        pass
+    registry.observe_generation("dolphin3", {"eval_count": 10, "eval_duration": 1e9})
+    assert "talkbot_stage_seconds_count" not in registry.render()
+
+
+def test_spans_take_labels_from_their_context():
+    registry = MetricsRegistry(enabled=True)
+    with registry.context(narrator="story"):
+        with registry.span("route"):
+            pass
+        with registry.span("memory_query", character="Lyra"):
+            pass
+    with registry.span("route"):
+        pass
+
+    assert set(registry.stage_seconds.series) == {
+        ("route", "", "story", ""), ("memory_query", "Lyra", "story", ""), ("route", "", "", "")
+    }
+    text = registry.render()
+    assert "# TYPE talkbot_stage_seconds histogram" in text
+    assert 'talkbot_stage_seconds_count{stage="memory_query",character="Lyra",narrator="story",model=""} 1' in text
+    assert 'talkbot_stage_seconds_bucket{stage="route",character="",narrator="",model="",le="+Inf"} 1' in text
+
+
+def test_model_calls_record_generation_and_token_rates(monkeypatch):
+    registry = MetricsRegistry(enabled=True)
+    monkeypatch.setattr(metrics, "_default_registry", registry)
+    with FakeOllamaServer(reply="One two three four") as server:
+        gateway = LLMGateway(host=server.url, retries=0)
+        gateway.chat("dolphin3", [{"role": "user", "content": "Hello there"}])
+        list(gateway.chat("dolphin3", [{"role": "user", "content": "Hello there"}], stream=True))
+        gateway.close()
+
+    assert registry.stage_seconds.series[("generate", "", "", "dolphin3")][-1] == 2
+    assert registry.completion_tokens.series[("dolphin3",)][-1] == 2
+    assert registry.completion_tokens.series[("dolphin3",)][-2] == 8
+    assert registry.tokens_per_second.series[("dolphin3",)][-1] == 2
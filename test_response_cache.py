@@ -0,0 +1,55 @@
+import narrator as narrator_module
+from narrator import Narrator
+from response_cache import ResponseCache
+from router import ResponderRouter
+
+
+def test_entries_are_bounded_and_expire(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr("response_cache.time.monotonic", lambda: clock[0])
+    cache = ResponseCache(max_entries=2, ttl=10)
+    keys = [cache.key("dolphin3", [{"role": "user", "content": str(i)}]) for i in range(3)]
+    assert keys[0] == cache.key("dolphin3", [{"content": "0", "role": "user"}], {})
+    assert keys[0] != cache.key("dolphin3", [{"role": "user", "content": "0"}], {"temperature": 0.7})
+
+    for key in keys:
+        cache.put(key, f"reply for {key}")
+    assert cache.get(keys[0]) is None  # Evicted, least recently used
+    assert cache.get(keys[2]) == f"reply for {keys[2]}"
+    clock[0] += 11
+    assert cache.get(keys[2]) is None
+    assert cache.stats()["evictions"] == 1
+
+    disabled = ResponseCache(max_entries=0)
+    disabled.put(keys[0], "reply")
+    assert disabled.get(keys[0]) is None
+
+
+def test_direction_is_reused_until_the_story_changes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls = []
+
+    def fake_chat(model, messages, options=None, stream=False, keep_alive=None):
+        calls.append(messages)
+        return {"message": {"role": "assistant", "content": f"Narration {len(calls)}"}}
+
+    monkeypatch.setattr(narrator_module.llm, "chat", fake_chat)
+    cache = ResponseCache()
+    narrator = Narrator(router=ResponderRouter(), response_cache=cache)
+    other = Narrator(router=ResponderRouter(), response_cache=cache)
+
+    assert narrator.direct_scene()["response"] == "Narration 1"
+    assert narrator.direct_scene()["response"] == "Narration 1"
+    assert narrator.direct_scene("Describe the sky")["response"] == "Narration 2"
+    assert narrator.direct_scene(fresh=True)["response"] == "Narration 3"
+    assert narrator.direct_scene()["response"] == "Narration 3"  # Fresh prose replaces the cached one
+    other.direct_scene()
+    assert len(calls) == 3  # Same story state, same address
+
+    for change in (lambda: narrator.set_scene("the river", []), lambda: narrator.add_plot_point("A storm rolls in"),
+                   narrator.advance_time):
+        before = len(calls)
+        change()
+        assert narrator.direct_scene()["response"] == f"Narration {before + 1}"
+    assert cache.stats()["invalidations"] > 0
+    assert other.direct_scene()["response"] == "Narration 3"  # Other stories keep their entries
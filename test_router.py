@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+
+import narrator as narrator_module
+from character import Character
+from narrator import Narrator
+from response_cache import ResponseCache
+from router import ResponderRouter
+
+
+def make_narrator(tmp_path, monkeypatch, threshold=0.6):
+    monkeypatch.chdir(tmp_path)
+    narrator = Narrator(router=ResponderRouter(confidence_threshold=threshold))
+    narrator.add_character(Character("Lyra", "*A shimmer in the air.*",
+                                     "Guardian of the celestial archives who studies stars, constellations and old books.",
+                                     "lyra", "", "Guest", "A visitor"))
+    narrator.add_character(Character("Bram", "*A smell of bread drifts from the oven.*",
+                                     "A village baker who loves bread, soup, cooking and recipes.",
+                                     "bram", "", "Guest", "A visitor"))
+    return narrator
+
+
+def test_router_skips_the_llm_when_confident(tmp_path, monkeypatch):
+    narrator = make_narrator(tmp_path, monkeypatch)
+    calls = []
+    monkeypatch.setattr(narrator_module.llm, "chat", lambda **kwargs: calls.append(kwargs))
+
+    assert narrator.select_responding_character("Which constellations can we see tonight?")[0] == "Lyra"
+    assert narrator.select_responding_character("What recipe do you use for your bread?")[0] == "Bram"
+    assert calls == []
+    stats = narrator.router.stats()
+    assert stats["decisions"] == {"router": 2}
+    assert stats["llm_skipped_ratio"] == 1.0
+
+
+def test_router_asks_the_llm_when_unsure(tmp_path, monkeypatch):
+    narrator = make_narrator(tmp_path, monkeypatch)
+    monkeypatch.setattr(narrator_module.llm, "chat",
+                        lambda **kwargs: {"message": {"content": "Bram should answer."}})
+
+    assert narrator.select_responding_character("Hmm.") == ("Bram", 0.8)
+    assert narrator.router.stats()["decisions"] == {"llm": 1}
+
+
+def test_likely_responders_recall_memories_while_the_llm_decides(tmp_path, monkeypatch):
+    narrator = make_narrator(tmp_path, monkeypatch)
+    narrator.response_cache = ResponseCache()
+    queries, routed, contexts = [], [], []
+    for name in ("Lyra", "Bram"):
+        def query(prompt, name=name):
+            queries.append((name, threading.current_thread().name))
+            return [f"{name} remembers: {prompt}"]
+        narrator.characters[name].query_long_term_memory = query
+
+    def fake_chat(model, messages, options=None, **kwargs):
+        if options == Narrator.ROUTING_OPTIONS:
+            time.sleep(0.2)
+            routed.append(sorted(name for name, _ in queries))
+            return {"message": {"content": "Bram should answer."}}
+        contexts.append(messages)
+        return {"message": {"content": "Fresh bread for everyone!"}}
+
+    async def fake_achat(model, messages, options=None, **kwargs):
+        return await asyncio.to_thread(fake_chat, model, messages, options)
+
+    monkeypatch.setattr(narrator_module.llm, "chat", fake_chat)
+    monkeypatch.setattr(narrator_module.llm, "achat", fake_achat)
+
+    result = narrator.process_user_message("Hmm.")
+    assert result["character"] == "Bram"
+    assert routed == [["Bram", "Lyra"]]  # Both were recalled before the LLM answered
+    assert len(queries) == 2 and all(thread.startswith("talkbot-memory") for _, thread in queries)
+    assert {"role": "system", "content": "Bram remembers: Hmm."} in contexts[0]  # Not queried a second time
+
+    queries.clear()
+    result = asyncio.run(narrator.aprocess_user_message("Hmm..."))
+    assert result["character"] == "Bram"
+    assert len(queries) == 2
+    assert {"role": "system", "content": "Bram remembers: Hmm..."} in contexts[1]
+
+
+def test_router_balances_turns_between_characters():
+    router = ResponderRouter()
+    candidates = {"Lyra": ("Lyra. A wanderer.", []), "Bram": ("Bram. A wanderer.", [])}
+    scores, _ = router.score("Hello there!", candidates, last_speaker="Lyra")
+    assert scores["Bram"] > scores["Lyra"]
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from scheduler import Cancelled, NarratorScheduler, SchedulerFull, SchedulerTimeout
+
+
+def test_requests_for_one_narrator_run_in_order_without_overlap():
+    scheduler = NarratorScheduler(workers=4)
+    log = []
+    active = []
+
+    def turn(i):
+        active.append(i)
+        assert len(active) == 1
+        time.sleep(0.005)
+        log.append(i)
+        active.remove(i)
+        return i
+
+    tickets = [scheduler.submit("story", turn, i) for i in range(10)]
+    assert [ticket.result(5) for ticket in tickets] == list(range(10))
+    assert log == list(range(10))
+
+
+def test_narrators_are_served_round_robin():
+    scheduler = NarratorScheduler(workers=1)
+    gate = threading.Event()
+    order = []
+    blocker = scheduler.submit("busy", gate.wait)
+    tickets = [scheduler.submit("busy", order.append, f"busy {i}") for i in range(3)]
+    tickets += [scheduler.submit("quiet", order.append, "quiet")]
+    gate.set()
+    for ticket in [blocker] + tickets:
+        ticket.result(5)
+    # The quiet story doesn't wait behind the whole backlog of the busy one
+    assert order == ["quiet", "busy 0", "busy 1", "busy 2"]
+
+
+def test_waiting_is_bounded_and_queued_requests_can_be_cancelled():
+    scheduler = NarratorScheduler(workers=1, max_pending=2)
+    gate = threading.Event()
+    running = scheduler.submit("story", gate.wait)
+    while running.state != running.RUNNING:
+        time.sleep(0.001)
+
+    first = scheduler.submit("story", lambda: "first")
+    second = scheduler.submit("story", lambda: "second")
+    with pytest.raises(SchedulerFull):
+        scheduler.submit("story", lambda: "third")
+
+    assert first.cancel()
+    with pytest.raises(Cancelled):
+        first.result(1)
+    with pytest.raises(SchedulerTimeout):
+        second.result(0.01)
+    assert second.state == second.CANCELLED
+
+    gate.set()
+    running.result(5)
+    assert scheduler.stats()["cancelled"] == 2
+
+
+def test_streams_hold_the_narrator_until_finished():
+    scheduler = NarratorScheduler(workers=2)
+    events = []
+
+    def reply(name):
+        for i in range(3):
+            time.sleep(0.005)
+            yield f"{name} {i}"
+
+    def consume(name):
+        events.extend(scheduler.stream("story", reply, name, timeout=5))
+
+    threads = [threading.Thread(target=consume, args=(name,)) for name in ("a", "b")]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.002)
+    for thread in threads:
+        thread.join()
+    assert events == ["a 0", "a 1", "a 2", "b 0", "b 1", "b 2"]
+
+
+def test_async_reservations_keep_their_place_in_line():
+    scheduler = NarratorScheduler(workers=1)
+    gate = threading.Event()
+    order = []
+
+    async def main():
+        blocker = scheduler.submit("story", gate.wait)
+        while blocker.state != blocker.RUNNING:
+            await asyncio.sleep(0.001)
+
+        async def turn(name):
+            async with scheduler.reserve("story", timeout=5):
+                order.append(f"{name} start")
+                await asyncio.sleep(0.01)
+                order.append(f"{name} end")
+
+        turns = [asyncio.ensure_future(turn("a")), asyncio.ensure_future(turn("b"))]
+        await asyncio.sleep(0.01)
+        later = scheduler.submit("story", order.append, "sync")
+        assert order == []  # Nothing overtakes the running request
+        gate.set()
+        await asyncio.gather(*turns)
+        await asyncio.get_running_loop().run_in_executor(None, later.result, 5)
+
+        # A reservation that can't get the narrator in time gives up its place
+        gate.clear()
+        scheduler.submit("story", gate.wait)
+        with pytest.raises(SchedulerTimeout):
+            async with scheduler.reserve("story", timeout=0.05):
+                pass
+        assert scheduler.pending("story") == 0
+        gate.set()
+
+    asyncio.run(main())
+    assert order == ["a start", "a end", "b start", "b end", "sync"]
@@ -0,0 +1,105 @@
+import os
+
+import character as character_module
+from character import Character
+from session import SessionStore, safe_filename
+
+
+def test_sessions_keep_separate_state_for_one_character(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lyra = Character(
+        name="Lyra",
+        intro="*A shimmer in the air coalesces into a glowing figure.*",
+        background="Once a guardian of ancient celestial archives.",
+        profile="lyra",
+        db_name="lyra_memories_test",
+        user_name="Guest",
+        user_persona="A curious visitor to the website.",
+        msgs_per_time_change=1
+    )
+    monkeypatch.setattr(lyra, "query_long_term_memory", lambda prompt: [])
+    prompts = []
+
+    def fake_chat(model, messages, options=None, stream=False, keep_alive=None):
+        prompts.append(messages)
+        return {"message": {"role": "assistant", "content": "Welcome."}}
+
+    monkeypatch.setattr(character_module.llm, "chat", fake_chat)
+
+    store = SessionStore()
+    alice = store.get_or_create("alice", lyra)
+    bob = store.get_or_create("bob", lyra)
+    alice.user_name = "Alice"
+    bob.user_name = "Bob"
+
+    lyra.talk("Hello from Alice", session=alice)
+    lyra.talk("Hello from Bob", session=bob)
+    lyra.talk("/day next", session=bob)
+
+    assert [m["content"] for m in alice.short_term_memory.get_recent()] == ["Alice: Hello from Alice", "Welcome."]
+    assert "Alice" not in str(prompts[1])
+    assert (alice.current_day, alice.time_of_day) == (1, "afternoon")
+    assert (bob.current_day, bob.time_of_day) == (2, "early_morning")
+    # The character's own state is untouched by either conversation
+    assert (lyra.current_day, lyra.time_of_day, lyra.user_name) == (1, "morning", "Guest")
+    assert not lyra.short_term_memory.entries
+    assert store.get_or_create("alice", lyra) is alice
+
+
+def test_prompt_prefix_is_stable_across_turns_and_sessions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lyra = Character("Lyra", "", "Once a guardian of ancient celestial archives.", "lyra", "", "Guest", "A visitor")
+    recalled = iter([["Memory one."], ["Memory two."], ["Memory three."]] * 4)
+    monkeypatch.setattr(lyra, "query_long_term_memory", lambda prompt: next(recalled))
+    alice = SessionStore().get_or_create("alice", lyra)
+
+    contexts = []
+    for i in range(3):
+        alice.short_term_memory.add({"role": "user", "content": f"Alice: message {i}"}, "1m", 1, "morning")
+        contexts.append(lyra.build_context(f"message {i}", alice))
+
+    # Everything before the recalled memories is carried over unchanged from the previous turn
+    for previous, current in zip(contexts, contexts[1:]):
+        assert current[:len(previous) - 2] == previous[:-2]
+    assert contexts[2][-2] == {"role": "system", "content": "Memory three."}
+    assert lyra.system_prompt() is lyra.system_prompt()
+
+    # Editing the character rebuilds the cached prompt
+    lyra.background = "Now a wandering storyteller."
+    assert "wandering storyteller" in lyra.build_context("hi", alice)[0]["content"]
+
+
+def test_history_window_advances_in_steps():
+    from memory import ShortTermMemory
+    memory = ShortTermMemory(max_length=20)
+    windows = []
+    for i in range(30):
+        memory.add(i, "0s", 1, "morning")
+        windows.append(memory.get_window(n=8, step=4))
+    assert windows[9] == list(range(0, 10))
+    assert windows[12] == list(range(4, 13))
+    assert windows[13][0] == windows[14][0] == 4
+    assert windows[29] == list(range(20, 30))
+
+
+def test_store_reloads_spilled_short_term_memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lyra = Character("Lyra", "", "Keeper of the archives.", "lyra", "lyra_memories", "Guest", "A visitor")
+    store = SessionStore(spill_dir=str(tmp_path / "short_term"))
+    session = store.get_or_create("alice/../1", lyra)
+    session.short_term_memory.add({"role": "user", "content": "Hello"}, "0s", 1, "morning")
+    assert os.path.dirname(store.spill_path("alice/../1", "Lyra")) == str(tmp_path / "short_term" / "Lyra")
+
+    # A fresh store, as after a restart, picks the conversation back up
+    restarted = SessionStore(spill_dir=str(tmp_path / "short_term"))
+    assert restarted.get_or_create("alice/../1", lyra).short_term_memory.get_recent() == [{"role": "user", "content": "Hello"}]
+    restarted.remove("alice/../1")
+    assert not os.path.exists(store.spill_path("alice/../1", "Lyra"))
+
+
+def test_ids_map_to_distinct_files_inside_the_spill_directory():
+    assert safe_filename("alice") == "alice"
+    assert safe_filename("3f2a.v1") == "3f2a.v1"
+    names = [safe_filename(name) for name in (".", "..", "a/b", "a_b", "a\\b", "Lyra Moon", "")]
+    assert len(set(names)) == len(names)
+    assert all(name and not name.startswith(".") and "/" not in name and "\\" not in name for name in names)
@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+
+from character import Character
+from character_pool import CharacterPool
+from narrator_manager import NarratorManager
+from scheduler import NarratorScheduler
+from session import SessionStore
+from state_store import JournalStore, SQLiteStore
+
+
+def test_journal_replays_after_restart_and_drops_torn_writes(tmp_path):
+    directory = str(tmp_path / "state")
+    store = JournalStore(directory, compact_after=1000)
+    store.put("narrators", "story", {"story_state": {"scene": "start", "plot_points": []}})
+    store.set("narrators", "story", ["story_state", "scene"], "tavern")
+    store.append("narrators", "story", ["story_state", "plot_points"], "A stranger arrives")
+    store.put("meta", "active", "story")
+    store.close()
+
+    with open(os.path.join(directory, JournalStore.JOURNAL_FILE), "a", encoding="utf-8") as f:
+        f.write('{"op": "put", "c": "meta", "k": "act')
+
+    reopened = JournalStore(directory)
+    assert reopened.collection("narrators")["story"]["story_state"] == {"scene": "tavern", "plot_points": ["A stranger arrives"]}
+    assert reopened.collection("meta") == {"active": "story"}
+
+    # New records still land on their own line after the torn one was discarded
+    reopened.delete("meta", "active")
+    reopened.close()
+    assert JournalStore(directory).collection("meta") == {}
+
+
+def test_compaction_writes_snapshot_and_empties_journal(tmp_path):
+    directory = str(tmp_path / "state")
+    store = JournalStore(directory, compact_after=3)
+    for i in range(4):
+        store.append("narrators", "story", ["plot_points"], i)
+    store.close()
+
+    with open(os.path.join(directory, JournalStore.JOURNAL_FILE), encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+    assert JournalStore(directory).collection("narrators")["story"]["plot_points"] == [0, 1, 2, 3]
+
+
+def test_narrator_saves_append_small_deltas(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "narrators.json").write_text(json.dumps({
+        "active_narrator_id": "story",
+        "narrators": {"story": {"story_state": {"plot_points": ["Old"] * 500, "scene": "start",
+                                                "characters_present": [], "themes": [],
+                                                "day": 1, "time_of_day": "morning"}}}
+    }), encoding="utf-8")
+    pool = CharacterPool(store=JournalStore(str(tmp_path / "characters")))
+    narrator_store = JournalStore(str(tmp_path / "narrators"))
+    manager = NarratorManager(pool, store=narrator_store)
+
+    narrator = manager.get_active_narrator()
+    assert len(narrator.story_state["plot_points"]) == 500
+    narrator.add_plot_point("The gate opens")
+    narrator.advance_time()
+    seq = narrator_store.seq
+    manager.save_narrator("story")
+    manager.save_narrator("story")
+
+    with open(narrator_store.journal_path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert narrator_store.seq == seq + 2
+    assert {record["op"] for record in records} == {"append", "set"}
+    narrator_store.close()
+
+    restored = NarratorManager(pool, store=JournalStore(str(tmp_path / "narrators")))
+    story_state = restored.get_narrator("story").story_state
+    assert story_state["plot_points"][-1] == "The gate opens"
+    assert story_state["time_of_day"] == "afternoon"
+
+
+def test_sqlite_store_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "state.db")
+    first = SQLiteStore(path, "narrators")
+    second = SQLiteStore(path, "narrators")  # As opened by another worker process
+    other = SQLiteStore(path, "characters")
+
+    first.put("narrators", "story", {"story_state": {"scene": "start", "plot_points": []}})
+    assert not first.changed()
+    assert second.changed() and not second.changed()
+    second.set("narrators", "story", ["story_state", "scene"], "tavern")
+    second.append("narrators", "story", ["story_state", "plot_points"], "A stranger arrives")
+
+    assert first.changed()
+    assert first.collection("narrators")["story"]["story_state"] == {"scene": "tavern", "plot_points": ["A stranger arrives"]}
+    assert other.is_empty() and not other.changed()
+    first.delete("narrators", "story")
+    assert second.get("narrators", "story") is None
+
+
+def test_workers_pick_up_each_others_narrators_and_sessions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "state.db")
+    pool = CharacterPool(store=SQLiteStore(path, "characters"))
+    pool.add_character(Character("Lyra", "", "Keeper of the archives.", "lyra", "lyra_memories", "Guest", "A visitor"))
+    mine = NarratorManager(pool, store=SQLiteStore(path, "narrators"))
+    theirs = NarratorManager(CharacterPool(store=SQLiteStore(path, "characters")), store=SQLiteStore(path, "narrators"))
+
+    mine.create_narrator("story").add_character_name("Lyra")
+    mine.save_narrator("story")
+    theirs.refresh()
+    narrator = theirs.get_narrator("story")
+    assert list(narrator.characters) == ["Lyra"]
+    narrator.add_plot_point("The gate opens")
+    theirs.save_narrator("story")
+    mine.refresh()
+    assert mine.get_narrator("story").story_state["plot_points"] == ["The gate opens"]
+
+    sessions, other_sessions = SessionStore(store=SQLiteStore(path, "sessions")), SessionStore(store=SQLiteStore(path, "sessions"))
+    lyra = pool.get_character("Lyra")
+    session = sessions.get_or_create("alice", lyra)
+    session.short_term_memory.add({"role": "user", "content": "Hello"}, "0s", 1, "morning")
+    session.advance_time()
+    sessions.save(session)
+    elsewhere = other_sessions.get_or_create("alice", lyra)
+    assert elsewhere.time_of_day == "afternoon"
+    elsewhere.short_term_memory.add({"role": "assistant", "content": "Welcome"}, "0s", 1, "afternoon")
+    other_sessions.save(elsewhere)
+    assert len(sessions.get_or_create("alice", lyra).short_term_memory) == 2
+
+
+def test_concurrent_session_saves_keep_both_turns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "state.db")
+    lyra = Character("Lyra", "", "Keeper of the archives.", "lyra", "lyra_memories", "Guest", "A visitor")
+    mine, theirs = SessionStore(store=SQLiteStore(path, "sessions")), SessionStore(store=SQLiteStore(path, "sessions"))
+    session = mine.get_or_create("alice", lyra)
+    session.short_term_memory.add({"role": "user", "content": "Hello"}, "0s", 1, "morning")
+    mine.save(session)
+    elsewhere = theirs.get_or_create("alice", lyra)
+    assert session.revision == elsewhere.revision == 1
+
+    # Both workers answer a turn from revision 1
+    session.short_term_memory.add({"role": "user", "content": "Mine"}, "0s", 1, "morning")
+    elsewhere.short_term_memory.add({"role": "user", "content": "Theirs"}, "0s", 1, "morning")
+    assert theirs.save(elsewhere) and elsewhere.revision == 2
+    assert mine.save(session) and session.revision == 3  # Rebased on their save instead of overwriting it
+
+    contents = [m["content"] for m in session.short_term_memory.get_recent()]
+    assert contents == ["Hello", "Theirs", "Mine"]
+    assert [m["content"] for m in theirs.get_or_create("alice", lyra).short_term_memory.get_recent()] == contents
+
+    store = SQLiteStore(path, "sessions")
+    assert store.put_versioned("sessions", "new", {"value": 1}, 0) == 1
+    assert store.put_versioned("sessions", "new", {"value": 2}, 0) is None
+    assert store.get("sessions", "new") == {"value": 1, "revision": 1}
+
+
+def test_story_conversations_are_shared_between_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("character.llm.chat", lambda **kwargs: {"message": {"content": "Welcome, traveler."}})
+    path = str(tmp_path / "state.db")
+    managers = []
+    for _ in range(2):  # One per worker process
+        pool = CharacterPool(store=SQLiteStore(path, "characters"))
+        managers.append(NarratorManager(pool, store=SQLiteStore(path, "narrators"),
+                                        session_store=SessionStore(store=SQLiteStore(path, "sessions"))))
+    mine, theirs = managers
+    mine.character_pool.add_character(Character("Lyra", "", "Keeper of the archives.", "lyra", "lyra_memories",
+                                                "Guest", "A visitor"))
+    narrator = mine.create_narrator("story")
+    narrator.add_character_name("Lyra")
+    narrator.set_scene("the archives", ["Lyra"])
+    narrator.characters["Lyra"].query_long_term_memory = lambda prompt: []
+    assert narrator.process_user_message("Hello")["character"] == "Lyra"
+    mine.save_narrator("story")
+
+    theirs.character_pool.refresh()
+    theirs.refresh()
+    session = theirs.get_narrator("story").get_session("Lyra")
+    assert session.session_id == "narrator:story"
+    assert [m["content"] for m in session.short_term_memory.get_recent()] == ["Guest: Hello", "Welcome, traveler."]
+
+    mine.session_store.sessions.clear()  # Evicted here; only the other worker holds it
+    mine.delete_narrator("story")
+    assert SQLiteStore(path, "sessions").collection("sessions") == {}
+
+
+def test_narrators_reload_between_their_turns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "state.db")
+    mine, theirs = (NarratorManager(CharacterPool(store=SQLiteStore(path, "characters")),
+                                    store=SQLiteStore(path, "narrators")) for _ in range(2))
+    mine.create_narrator("story")
+    theirs.refresh()
+    scheduler = NarratorScheduler(workers=2)
+    turn_started, finish_turn = threading.Event(), threading.Event()
+
+    def turn():
+        turn_started.set()
+        finish_turn.wait(5)
+        return list(mine.get_narrator("story").story_state["plot_points"])
+
+    ticket = scheduler.submit("story", turn)
+    assert turn_started.wait(5)
+    theirs.get_narrator("story").add_plot_point("The gate opens")
+    theirs.save_narrator("story")
+    mine.refresh(scheduler)  # Another request arrives mid-turn
+    assert mine.get_narrator("story").story_state["plot_points"] == []
+    finish_turn.set()
+    assert ticket.result(5) == []  # The turn never saw its story change under it
+    assert scheduler.run("story", lambda: mine.get_narrator("story").story_state["plot_points"],
+                         timeout=5) == ["The gate opens"]
@@ -0,0 +1,152 @@
+import random
+
+import pytest
+
+import character as character_module
+import metrics
+from character import Character, StreamingToolParser
+from metrics import MetricsRegistry
+from tools import ToolRegistry, simulated_weather
+
+
+def make_character(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lyra = Character(
+        name="Lyra",
+        intro="*A shimmer in the air coalesces into a glowing figure. She smiles.*",
+        background="Once a guardian of ancient celestial archives.",
+        profile="lyra",
+        db_name="lyra_memories_test",
+        user_name="Tester",
+        user_persona="A software developer testing streaming.",
+        msgs_per_time_change=5
+    )
+    lyra.set_time(day=1, time_of_day="morning")
+    return lyra
+
+
+def stream_through_parser(character, reply, chunk_size):
+    parser = StreamingToolParser(character)
+    chunks = [reply[i:i + chunk_size] for i in range(0, len(reply), chunk_size)]
+    return "".join(parser.feed(chunk) for chunk in chunks) + parser.flush()
+
+
+def test_streamed_tags_match_process_tool_calls(tmp_path, monkeypatch):
+    lyra = make_character(tmp_path, monkeypatch)
+    reply = "Hello [not a tag] there. [tool:get_weather:Tokyo] and [tool:unknown] [change_time:next_time]done [tool:get_weather"
+
+    expected = lyra.process_tool_calls(reply)
+    for chunk_size in (1, 3, 7, len(reply)):
+        lyra.set_time(day=1, time_of_day="morning")
+        streamed = stream_through_parser(lyra, reply, chunk_size)
+        assert " ".join(streamed.split()) == " ".join(expected.split())
+        assert lyra.time_of_day == "afternoon"
+
+
+def test_talk_stream_remembers_full_reply(tmp_path, monkeypatch):
+    lyra = make_character(tmp_path, monkeypatch)
+    monkeypatch.setattr(lyra, "query_long_term_memory", lambda prompt: [])
+
+    def fake_chat(model, messages, options=None, stream=False, keep_alive=None):
+        assert stream
+        for token in ["Rolling ", "[tool:rand", "om_number:4:4]", "!"]:
+            yield {"message": {"role": "assistant", "content": token}, "done": False}
+
+    monkeypatch.setattr(character_module.llm, "chat", fake_chat)
+
+    tokens = list(lyra.talk_stream("roll a die", auto_advance=False))
+
+    assert "".join(tokens) == "Rolling 4!"
+    assert lyra.short_term_memory.get_recent()[-1] == {"role": "assistant", "content": "Rolling 4!"}
+
+
+def test_a_stream_closed_early_still_finishes_the_turn(tmp_path, monkeypatch):
+    lyra = make_character(tmp_path, monkeypatch)
+    monkeypatch.setattr(lyra, "query_long_term_memory", lambda prompt: [])
+    closed = []
+
+    def fake_chat(model, messages, options=None, stream=False, keep_alive=None):
+        try:
+            for token in ["The stars ", "are bright ", "tonight."]:
+                yield {"message": {"role": "assistant", "content": token}, "done": False}
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(character_module.llm, "chat", fake_chat)
+
+    tokens = lyra.talk_stream("What do you see?")
+    assert next(tokens) == "The stars "
+    tokens.close()  # The client disconnected
+
+    assert closed == [True]
+    assert lyra.short_term_memory.get_recent()[-2:] == [
+        {"role": "user", "content": "Tester: What do you see?"},
+        {"role": "assistant", "content": "The stars"}
+    ]
+    assert lyra.session.message_count == 1
+
+
+def test_streamed_turns_are_labelled_with_the_character(tmp_path, monkeypatch):
+    lyra = make_character(tmp_path, monkeypatch)
+    monkeypatch.setattr(lyra, "query_long_term_memory", lambda prompt: [])
+    registry = MetricsRegistry(enabled=True)
+    monkeypatch.setattr(metrics, "_default_registry", registry)
+    labels = []
+
+    def fake_chat(model, messages, options=None, stream=False, keep_alive=None):
+        try:
+            for token in ["The stars ", "are bright."]:
+                labels.append(registry.context_labels.get())
+                yield {"message": {"role": "assistant", "content": token}, "done": False}
+        finally:
+            labels.append(registry.context_labels.get())
+
+    monkeypatch.setattr(character_module.llm, "chat", fake_chat)
+
+    tokens = lyra.talk_stream("What do you see?")
+    next(tokens)
+    assert registry.context_labels.get() is None  # Not leaked to the caller between chunks
+    tokens.close()
+    assert labels == [{"character": "Lyra"}, {"character": "Lyra"}]
+
+
+def test_registered_tools_are_dispatched_and_timed(tmp_path, monkeypatch):
+    lyra = make_character(tmp_path, monkeypatch)
+    lyra.tools = ToolRegistry()
+    lyra.tools.register("echo", lambda character, session, args: "/".join(args), min_args=1)
+
+    @lyra.tools.register("boom")
+    def boom(character, session, args):
+        raise RuntimeError("broken")
+
+    reply = "[tool:echo:a:b] [tool:echo] [tool:boom] [tool:echo:c] [change_time:next_day]"
+    assert lyra.process_tool_calls(reply) == "a/b *Tool 'echo' not found or missing parameters* " \
+                                             "*Error executing tool 'boom': broken* c"
+    assert lyra.current_day == 2
+    stats = lyra.tools.stats()
+    assert stats["echo"]["calls"] == 2 and stats["boom"]["errors"] == 1
+    # The decorator leaves the function itself in place
+    with pytest.raises(RuntimeError):
+        boom(lyra, None, [])
+
+    parser = lyra.tools.stream_parser(lyra)
+    assert parser.feed("x [tool:ec") == "x "
+    assert parser.feed("ho:d] [tool:echo:e") == "d "
+    assert parser.flush() == "[tool:echo:e"
+
+
+def test_weather_is_cached_and_leaves_global_random_alone(tmp_path, monkeypatch):
+    lyra = make_character(tmp_path, monkeypatch)
+    simulated_weather.cache_clear()
+    random.seed(7)
+    expected = random.random()
+    random.seed(7)
+    first = lyra.tool_get_weather("Tokyo")
+    assert random.random() == expected
+    assert lyra.tool_get_weather("Tokyo") == first
+    assert simulated_weather.cache_info().hits == 1
+
+    lyra.session.rng.seed(1)
+    rolls = [lyra.tool_random_number(1, 6) for _ in range(5)]
+    lyra.session.rng.seed(1)
+    assert [lyra.execute_tool_call("random_number:1:6") for _ in range(5)] == rolls
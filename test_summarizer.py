@@ -0,0 +1,71 @@
+import threading
+
+from summarizer import SummarizationWorker
+
+
+class FakeMemory:
+    def __init__(self, error=None):
+        self.flushes = 0
+        self.error = error
+
+    def flush(self):
+        self.flushes += 1
+        if self.error:
+            raise self.error
+
+
+class SlowCharacter:
+    name = "Slow"
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.summaries = []
+        self.long_term_memory = FakeMemory()
+
+    def summarize_entries(self, entries, day, time_of_day):
+        self.started.set()
+        self.release.wait(5)
+        self.summaries.append((len(entries), day, time_of_day))
+        return "summary"
+
+
+def test_submit_never_blocks_and_rejects_when_full():
+    worker = SummarizationWorker(max_queue_size=1)
+    character = SlowCharacter()
+
+    assert worker.submit(character, [{}] * 8, 1, "morning")
+    # Wait until the first job is being processed so the queue slot is free again
+    assert character.started.wait(5)
+    assert worker.submit(character, [{}] * 8, 1, "evening")
+    assert not worker.submit(character, [{}] * 8, 2, "morning")
+
+    stats = worker.stats()
+    assert stats["pending"] == 2
+    assert stats["rejected"] == 1
+
+    character.release.set()
+    worker.shutdown(flush=True, timeout=5)
+
+    assert character.summaries == [(8, 1, "morning"), (8, 1, "evening")]
+    assert worker.stats()["processed"] == 2
+    assert character.long_term_memory.flushes >= 1
+    assert worker.stats()["queue_depth"] == 0
+    assert not worker.submit(character, [{}], 3, "night")
+
+
+def test_a_failed_write_does_not_stop_the_worker():
+    worker = SummarizationWorker()
+    broken, healthy = SlowCharacter(), SlowCharacter()
+    broken.long_term_memory = FakeMemory(RuntimeError("database is locked"))
+    broken.release.set()
+    healthy.release.set()
+
+    assert worker.submit(broken, [{}] * 8, 1, "morning")
+    assert worker.submit(healthy, [{}] * 8, 1, "morning")
+    worker.shutdown(flush=True, timeout=5)
+
+    assert not worker.thread.is_alive()
+    assert worker.stats()["processed"] == 2
+    assert broken.long_term_memory.flushes >= 1 and healthy.long_term_memory.flushes >= 1
+
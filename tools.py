@@ -0,0 +1,219 @@
+import functools
+import logging
+import random
+import re
+import threading
+import time
+
+logger = logging.getLogger("talkbot.tools")
+
+MAX_TAG_LENGTH = 200
+TAG_PREFIXES = ("[tool:", "[change_time:")
+# One pass finds every tag; a tag ends at the first ']' and can't span lines or nest
+TAG_PATTERN = re.compile(r"\[(tool|change_time):([^\[\]\n]{0,%d})\]" % MAX_TAG_LENGTH)
+
+
+class Tool:
+    def __init__(self, name, handler, min_args=0, description=""):
+        self.name = name
+        self.handler = handler  # handler(character, session, args) -> str or None
+        self.min_args = min_args
+        self.description = description
+
+
+class ToolRegistry:
+    """
+    The tools characters can call with [tool:name:arg:...] tags in their replies.
+    Tools are registered by name, so adding one doesn't touch the dispatch code,
+    and every call is timed per tool.
+    """
+
+    def __init__(self):
+        self.tools = {}
+        self.lock = threading.Lock()
+        self.timings = {}  # Tool name -> {"calls", "errors", "total_ms", "max_ms"}
+
+    def register(self, name, handler=None, min_args=0, description=""):
+        """Register a tool; without a handler this returns a decorator"""
+        if handler is None:
+            def decorator(func):
+                self.register(name, func, min_args, description)
+                return func
+            return decorator
+        self.tools[name] = Tool(name, handler, min_args, description)
+        return self.tools[name]
+
+    def unregister(self, name):
+        self.tools.pop(name, None)
+
+    def execute(self, character, tool_call, session=None):
+        """Run one tool call ("name:arg:...") and return the text that replaces its tag"""
+        parts = tool_call.split(':')
+        tool_name = parts[0].strip()
+        args = parts[1:]
+        tool = self.tools.get(tool_name)
+        if tool is None or len(args) < tool.min_args:
+            return f"*Tool '{tool_name}' not found or missing parameters*"
+
+        started = time.perf_counter()
+        failed = False
+        try:
+            return tool.handler(character, session, args)
+        except Exception as e:
+            failed = True
+            return f"*Error executing tool '{tool_name}': {str(e)}*"
+        finally:
+            self._record(tool_name, (time.perf_counter() - started) * 1000, failed)
+
+    def process(self, character, reply, session=None):
+        """
+        Resolve every tag in a complete reply in a single pass. Only the first
+        time command is executed; the others are just removed.
+        """
+        state = {"time_command_done": False}
+        processed = TAG_PATTERN.sub(lambda match: self._resolve(character, session, match, state), reply)
+        return processed.strip() if state["time_command_done"] else processed
+
+    def stream_parser(self, character, session=None):
+        return StreamingToolParser(character, session, self)
+
+    def stats(self):
+        with self.lock:
+            return {
+                name: dict(t, total_ms=round(t["total_ms"], 2), max_ms=round(t["max_ms"], 2),
+                           average_ms=round(t["total_ms"] / t["calls"], 3))
+                for name, t in self.timings.items()
+            }
+
+    def _resolve(self, character, session, match, state):
+        kind, body = match.group(1), match.group(2)
+        if kind == "change_time":
+            if not state["time_command_done"]:
+                character.execute_time_command(body.strip(), session)
+                state["time_command_done"] = True
+            return ""
+        result = character.execute_tool_call(body, session)
+        return result if result is not None else ""
+
+    def _record(self, name, elapsed_ms, failed):
+        with self.lock:
+            timing = self.timings.setdefault(name, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            timing["calls"] += 1
+            timing["errors"] += failed
+            timing["total_ms"] += elapsed_ms
+            timing["max_ms"] = max(timing["max_ms"], elapsed_ms)
+        logger.debug("Tool %s took %.2f ms", name, elapsed_ms)
+
+
+class StreamingToolParser:
+    """Resolves [tool:...] and [change_time:...] tags in a reply that arrives in pieces.
+
+    Plain text is passed straight through. From a '[' on, text is held back only
+    while it could still be the start of a tag, so streaming latency is unaffected
+    for ordinary replies. Tags resolve exactly as ToolRegistry.process would.
+    """
+
+    def __init__(self, character, session=None, registry=None):
+        self.character = character
+        self.session = session
+        self.registry = registry or get_tool_registry()
+        self.buffer = ""
+        self.state = {"time_command_done": False}
+
+    @property
+    def time_command_done(self):
+        return self.state["time_command_done"]
+
+    def feed(self, text):
+        """Feed the next chunk of model output and return the text that is safe to emit"""
+        if not self.buffer and "[" not in text:
+            return text
+        text = self.buffer + text
+        self.buffer = ""
+        output = []
+        pos = 0
+        while True:
+            start = text.find("[", pos)
+            if start < 0:
+                output.append(text[pos:])
+                break
+            output.append(text[pos:start])
+            match = TAG_PATTERN.match(text, start)
+            if match:
+                output.append(self.registry._resolve(self.character, self.session, match, self.state))
+                pos = match.end()
+            elif self.could_be_tag(text[start:]):
+                self.buffer = text[start:]
+                break
+            else:
+                output.append("[")
+                pos = start + 1
+        return "".join(output)
+
+    def flush(self):
+        """Return any held-back text once the stream has finished"""
+        text, self.buffer = self.buffer, ""
+        return text
+
+    @staticmethod
+    def could_be_tag(text):
+        """Whether text, starting at a '[', may still turn into a complete tag"""
+        if len(text) > MAX_TAG_LENGTH + len(TAG_PREFIXES[-1]) or "]" in text or "\n" in text or "[" in text[1:]:
+            return False
+        return any(prefix.startswith(text) or text.startswith(prefix) for prefix in TAG_PREFIXES)
+
+
+WEATHER_TEMPERATURES = {"sunny": (75, 95), "cloudy": (60, 80), "rainy": (50, 70),
+                        "stormy": (55, 75), "windy": (50, 70), "snowy": (20, 35), "foggy": (45, 65)}
+
+
+@functools.lru_cache(maxsize=1024)
+def simulated_weather(location, day):
+    """
+    (weather, temperature) for a location on a story day: varied across places and
+    days but always the same for the same pair. It uses its own seeded Random, so it
+    never touches the global generator other threads draw from.
+    """
+    rng = random.Random(sum(ord(c) for c in location) + day)
+    weather = rng.choice(list(WEATHER_TEMPERATURES))
+    low, high = WEATHER_TEMPERATURES[weather]
+    return weather, rng.randint(low, high)
+
+
+def _get_current_time(character, session, args):
+    return character.tool_get_current_time()
+
+
+def _random_number(character, session, args):
+    try:
+        min_val, max_val = int(args[0]), int(args[1])
+    except ValueError:
+        return "*Error: random_number tool requires integer values*"
+    return character.tool_random_number(min_val, max_val, session)
+
+
+def _get_weather(character, session, args):
+    # Locations may contain ':'
+    return character.tool_get_weather(":".join(args).strip(), session)
+
+
+def default_tools():
+    """A registry with the built-in tools"""
+    registry = ToolRegistry()
+    registry.register("get_current_time", _get_current_time, description="The current real-world time")
+    registry.register("random_number", _random_number, min_args=2, description="A random integer between min and max")
+    registry.register("get_weather", _get_weather, min_args=1, description="Simulated weather for a location")
+    return registry
+
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def get_tool_registry():
+    """Return the process-wide tool registry, creating it on first use"""
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = default_tools()
+        return _default_registry